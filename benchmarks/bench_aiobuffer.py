@@ -0,0 +1,65 @@
+"""
+Compare the field by field async parsing of aiobuffer schemas with the
+compiled synchronous fast path used by ``reader.pull``.
+
+    python -m benchmarks.bench_aiobuffer
+"""
+import asyncio
+import time
+
+from shadowproxy2.aiobuffer import socks5
+from shadowproxy2.aiobuffer.buffer import create_buffer
+from shadowproxy2.parsers.trojan import TrojanSchema
+
+ROUNDS = 50_000
+
+CASES = [
+    (
+        "socks5 handshake",
+        socks5.Handshake,
+        socks5.Handshake(5, [socks5.AuthMethod.no_auth]).binary,
+    ),
+    (
+        "socks5 request",
+        socks5.ClientRequest,
+        socks5.ClientRequest(
+            5, socks5.Cmd.connect, 0, socks5.Addr(3, "example.com", 443)
+        ).binary,
+    ),
+    ("socks5 addr ipv4", socks5.Addr, socks5.Addr(1, "10.0.0.1", 80).binary),
+    (
+        "trojan request",
+        TrojanSchema,
+        TrojanSchema(
+            b"0" * 56,
+            b"\r\n",
+            socks5.Cmd.connect,
+            socks5.Addr(3, "example.com", 443),
+            b"\r\n",
+        ).binary,
+    ),
+]
+
+
+async def run(parse, data):
+    reader = create_buffer()
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        reader.feed_data(data)
+        await parse(reader)
+    return time.perf_counter() - start
+
+
+async def main():
+    print(f"{'schema':<20}{'get_value':>14}{'pull':>14}{'speedup':>10}")
+    for name, cls, data in CASES:
+        old = await run(cls.get_value, data)
+        new = await run(lambda reader: reader.pull(cls), data)
+        print(
+            f"{name:<20}{old / ROUNDS * 1e6:>11.2f} us"
+            f"{new / ROUNDS * 1e6:>11.2f} us{old / new:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
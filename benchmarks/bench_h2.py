@@ -0,0 +1,102 @@
+"""
+Connection setup latency of the h2 transport against wss over loopback TLS:
+every round opens a proxied connection, echoes one byte and closes it. wss
+pays a TCP, TLS and websocket handshake each time, h2 opens an extended
+CONNECT stream on a connection kept from the first round, so only ``cold``
+includes its handshakes.
+
+    python -m benchmarks.bench_h2
+"""
+import asyncio
+import ssl
+import statistics
+import time
+from pathlib import Path
+
+import websockets
+
+from shadowproxy2.transport.h2 import H2Client, H2Connection
+
+ROUNDS = 200
+CERTS = Path(__file__).parent.parent / "certs"
+
+
+async def echo(reader, writer):
+    while data := await reader.read(65536):
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+async def ws_echo(ws, path=None):
+    async for message in ws:
+        await ws.send(message)
+
+
+async def run(open_close):
+    latencies = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        await open_close()
+        latencies.append(time.perf_counter() - start)
+    cold, latencies = latencies[0], sorted(latencies[1:])
+    return (
+        cold * 1000,
+        statistics.median(latencies) * 1000,
+        latencies[int(len(latencies) * 0.95)] * 1000,
+    )
+
+
+def report(name, result):
+    cold, median, p95 = result
+    print(f"{name:<8}{cold:>10.2f} ms{median:>10.2f} ms{p95:>10.2f} ms")
+
+
+async def main():
+    loop = asyncio.get_running_loop()
+    server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_context.load_cert_chain(CERTS / "ssl_cert.pem", CERTS / "ssl_key.pem")
+    client_context = ssl.create_default_context()
+    client_context.check_hostname = False
+    client_context.verify_mode = ssl.CERT_NONE
+    print(f"{'':<8}{'cold':>13}{'p50':>13}{'p95':>13}")
+
+    async with websockets.serve(ws_echo, "127.0.0.1", 0, ssl=server_context) as ws:
+        port = ws.sockets[0].getsockname()[1]
+
+        async def wss_round():
+            async with websockets.connect(
+                f"wss://127.0.0.1:{port}/ws", ssl=client_context, compression=None
+            ) as client:
+                await client.send(b"x")
+                await client.recv()
+
+        report("wss", await run(wss_round))
+
+    server_context.set_alpn_protocols(["h2"])
+    client_context.set_alpn_protocols(["h2"])
+    server = await loop.create_server(
+        lambda: H2Connection(
+            client_side=False, on_stream=lambda r, w: loop.create_task(echo(r, w))
+        ),
+        "127.0.0.1",
+        0,
+        ssl=server_context,
+    )
+    client = H2Client(server.sockets[0].getsockname()[:2], client_context)
+
+    async def h2_round():
+        stream = await client.open_stream()
+        stream.write(b"x")
+        await stream.reader.readexactly(1)
+        stream.write_eof()
+        await stream.reader.read()
+        stream.close()
+
+    report("h2", await run(h2_round))
+    client.close()
+    server.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
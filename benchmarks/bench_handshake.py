@@ -0,0 +1,98 @@
+"""
+Server side handshakes per second of the inbound parsers, driven without
+sockets: the sans-IO generators through an iofree parser, and the stream
+based ``server()`` coroutines through an in-memory StreamReader.
+
+    python -m benchmarks.bench_handshake
+"""
+import asyncio
+import time
+
+from shadowproxy2.aiobuffer import socks5 as s5
+from shadowproxy2.aiobuffer.buffer import create_buffer
+from shadowproxy2.parsers import aead, http, socks4, socks5, trojan
+from shadowproxy2.parsers.base import NullParser
+from shadowproxy2.sansio import HandshakeEngine
+
+ROUNDS = 20_000
+
+CASES = [
+    (
+        "socks5",
+        socks5.Socks5Parser,
+        s5.Handshake(5, [s5.AuthMethod.no_auth]).binary
+        + s5.ClientRequest(5, s5.Cmd.connect, 0, s5.Addr(3, "example.com", 443)).binary,
+    ),
+    ("socks4a", socks4.Socks4Parser, b"\x04\x01\x01\xbb\x00\x00\x00\x01\x00a.com\x00"),
+    (
+        "http",
+        lambda: http.HTTPParser(None, None),
+        b"CONNECT example.com:443 HTTP/1.1\r\nHost: example.com:443\r\n\r\n",
+    ),
+    (
+        "trojan",
+        trojan.TrojanParser,
+        trojan.TrojanSchema(
+            b"0" * 56, ..., s5.Cmd.connect, s5.Addr(3, "example.com", 443), ...
+        ).binary,
+    ),
+    ("plain", aead.PlainParser, s5.Addr(3, "example.com", 443).binary),
+]
+
+
+class Writer:
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+
+class Context:
+    def check_quota(self, user):
+        pass
+
+    async def create_client(self, target_addr):
+        return NullParser()
+
+    async def connect_remote(self, parser, target_addr):
+        remote_parser = await self.create_client(target_addr)
+        await parser._write(parser.server_reply())
+        return remote_parser
+
+
+def bench_sansio(factory, data):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        engine = HandshakeEngine(factory().server_handshake(), Writer())
+        engine.data_received(data)
+        engine.get_result()
+    return ROUNDS / (time.perf_counter() - start)
+
+
+async def bench_stream(factory, data):
+    ctx = Context()
+    writer = Writer()
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        parser = factory()
+        reader = create_buffer()
+        reader.feed_data(data)
+        parser.set_rw(reader, writer)
+        await parser.server(ctx)
+    return ROUNDS / (time.perf_counter() - start)
+
+
+async def main():
+    print(f"{'protocol':<10}{'sans-IO':>14}{'stream':>14}")
+    for name, factory, data in CASES:
+        sansio = bench_sansio(factory, data)
+        stream = await bench_stream(factory, data)
+        print(f"{name:<10}{sansio:>10.0f} h/s{stream:>10.0f} h/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
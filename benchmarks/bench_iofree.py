@@ -0,0 +1,50 @@
+"""
+Parse a stream of small length-prefixed records with an iofree parser and
+report how many parser steps (traps) are processed per second.
+
+    python -m benchmarks.bench_iofree
+"""
+import time
+from struct import Struct
+
+from shadowproxy2 import iofree
+
+RECORDS = 200_000
+CHUNK = 4096
+header = Struct(">H")
+
+
+def make_stream():
+    records = [bytes([i % 256]) * (i % 64 + 1) for i in range(RECORDS)]
+    return b"".join(header.pack(len(r)) + r for r in records)
+
+
+def records(read):
+    count = 0
+    while count < RECORDS:
+        (length,) = yield from iofree.read_struct(header)
+        yield from read(length)
+        count += 1
+    return count
+
+
+def bench(read, stream):
+    parser = iofree.Parser(records(read))
+    view = memoryview(stream)
+    start = time.perf_counter()
+    for i in range(0, len(stream), CHUNK):
+        parser.data_received(view[i : i + CHUNK])
+    assert parser.get_result() == RECORDS
+    return time.perf_counter() - start
+
+
+def main():
+    stream = make_stream()
+    steps = RECORDS * 2
+    for name, read in [("read", iofree.read), ("read_view", iofree.read_view)]:
+        elapsed = bench(read, stream)
+        print(f"{name:<10}{steps / elapsed / 1e6:6.2f}M steps/s")
+
+
+if __name__ == "__main__":
+    main()
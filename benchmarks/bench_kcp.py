@@ -0,0 +1,157 @@
+"""
+KCP over a lossy, high latency link emulated by a local udp relay that
+drops a share of the datagrams both ways and delays the rest by ``DELAY``.
+Reports the time to upload ``SIZE`` bytes and the round trip times of
+small pings. TCP goes through a relay with the same delay, but without
+loss, which needs kernel help (tc qdisc ... netem loss 5%); with loss its
+upload is estimated by the Mathis model, MSS / RTT * 1.22 / sqrt(loss).
+
+    python -m benchmarks.bench_kcp
+"""
+import asyncio
+import math
+import random
+import socket
+import statistics
+import time
+
+from shadowproxy2.transport.kcp import SOCKET_BUFFER, KCPEndpoint
+
+SIZE = 1 << 20
+PINGS = 50
+DELAY = 0.02  # seconds, one way
+LOSSES = [0, 0.01, 0.05, 0.1]
+OPTIONS = dict(nodelay=True, interval=10, resend=2, wnd=1024)
+
+
+async def handler(reader, writer):
+    "T: count the bytes until eof and report them, P: echo"
+    mode = await reader.readexactly(1)
+    if mode == b"T":
+        total = 0
+        while data := await reader.read(65536):
+            total += len(data)
+        writer.write(total.to_bytes(8, "big"))
+    else:
+        while data := await reader.read(65536):
+            writer.write(data)
+    await writer.drain()
+    writer.close()
+
+
+class LossyRelay(asyncio.DatagramProtocol):
+    def __init__(self, server_addr, loss):
+        self.server_addr = server_addr
+        self.loss = loss
+        self.client_addr = None
+        self.random = random.Random(1)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        sock = transport.get_extra_info("socket")
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+
+    def datagram_received(self, data, addr):
+        if addr == self.server_addr:
+            target = self.client_addr
+        else:
+            self.client_addr = addr
+            target = self.server_addr
+        if self.random.random() >= self.loss:
+            self.loop.call_later(DELAY, self.transport.sendto, data, target)
+
+
+async def delay_pipe(reader, writer):
+    loop = asyncio.get_running_loop()
+    while data := await reader.read(65536):
+        loop.call_later(DELAY, writer.write, data)
+    loop.call_later(DELAY, writer.write_eof)
+
+
+async def run(open_stream):
+    reader, writer = await open_stream()
+    payload = b"x" * 65536
+    start = time.perf_counter()
+    writer.write(b"T")
+    for _ in range(SIZE // len(payload)):
+        writer.write(payload)
+        await writer.drain()
+    writer.write_eof()
+    assert int.from_bytes(await reader.readexactly(8), "big") == SIZE
+    elapsed = time.perf_counter() - start
+    writer.close()
+
+    reader, writer = await open_stream()
+    writer.write(b"P")
+    rtts = []
+    for _ in range(PINGS):
+        start = time.perf_counter()
+        writer.write(b"p" * 32)
+        await reader.readexactly(32)
+        rtts.append(time.perf_counter() - start)
+    writer.close()
+    rtts.sort()
+    return (
+        SIZE / elapsed / 1024,
+        statistics.median(rtts) * 1000,
+        rtts[int(len(rtts) * 0.95)] * 1000,
+    )
+
+
+def report(name, result):
+    kbps, median, p95 = result
+    print(f"{name:<12}{kbps:>10.0f} KB/s{median:>10.1f} ms{p95:>10.1f} ms")
+
+
+async def main():
+    loop = asyncio.get_running_loop()
+    print(f"{'link':<12}{'upload':>15}{'rtt p50':>13}{'rtt p95':>13}")
+
+    async def tcp_relay(reader, writer):
+        up_reader, up_writer = await asyncio.open_connection(*tcp_addr)
+        await asyncio.gather(
+            delay_pipe(reader, up_writer), delay_pipe(up_reader, writer)
+        )
+
+    server = await asyncio.start_server(handler, "127.0.0.1", 0)
+    tcp_addr = server.sockets[0].getsockname()
+    relay = await asyncio.start_server(tcp_relay, "127.0.0.1", 0)
+    relay_addr = relay.sockets[0].getsockname()
+    report("tcp 0%", await run(lambda: asyncio.open_connection(*relay_addr)))
+    relay.close()
+    server.close()
+    for loss in LOSSES[1:]:
+        estimate = 1460 / (2 * DELAY) * 1.22 / math.sqrt(loss) / 1024
+        print(f"{f'tcp {loss:.0%}':<12}{estimate:>10.0f} KB/s  (estimated)")
+
+    kcp_server, _ = await loop.create_datagram_endpoint(
+        lambda: KCPEndpoint(
+            OPTIONS, on_stream=lambda r, w: loop.create_task(handler(r, w))
+        ),
+        local_addr=("127.0.0.1", 0),
+    )
+    server_addr = kcp_server.get_extra_info("sockname")
+    for loss in LOSSES:
+        udp_relay, _ = await loop.create_datagram_endpoint(
+            lambda: LossyRelay(server_addr, loss), local_addr=("127.0.0.1", 0)
+        )
+        client, endpoint = await loop.create_datagram_endpoint(
+            lambda: KCPEndpoint(
+                OPTIONS, remote_addr=udp_relay.get_extra_info("sockname")
+            ),
+            local_addr=("127.0.0.1", 0),
+        )
+
+        async def open_stream():
+            return endpoint.open_stream()
+
+        report(f"kcp {loss:.0%}", await run(open_stream))
+        client.close()
+        udp_relay.close()
+    kcp_server.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,66 @@
+"""
+Measure the memory allocated by the aiobuffer schemas during a server side
+SOCKS5 handshake: parse the handshake, reply the server selection, parse the
+request and reply success, the same way as the socks5 parser does.
+
+    python -m benchmarks.bench_socks5_alloc
+"""
+import asyncio
+import time
+import tracemalloc
+
+from shadowproxy2.aiobuffer import socks5
+from shadowproxy2.aiobuffer.buffer import create_buffer
+from shadowproxy2.parsers.socks5 import NO_AUTH, SUCCEEDED
+
+ROUNDS = 20_000
+
+HANDSHAKE = socks5.Handshake(5, [socks5.AuthMethod.no_auth]).binary
+REQUEST = socks5.ClientRequest(
+    5, socks5.Cmd.connect, 0, socks5.Addr(3, "example.com", 443)
+).binary
+
+
+async def handshake(reader):
+    await reader.pull(socks5.Handshake)
+    selection = NO_AUTH.binary
+    request = await reader.pull(socks5.ClientRequest)
+    return request, selection + SUCCEEDED.binary
+
+
+async def main():
+    reader = create_buffer()
+    for _ in range(100):  # warm up caches
+        reader.feed_data(HANDSHAKE + REQUEST)
+        await handshake(reader)
+
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        reader.feed_data(HANDSHAKE + REQUEST)
+        await handshake(reader)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    peaks = []
+    for _ in range(1000):
+        reader.feed_data(HANDSHAKE + REQUEST)
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        await handshake(reader)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+
+    kept = []
+    base = tracemalloc.get_traced_memory()[0]
+    for _ in range(1000):
+        reader.feed_data(HANDSHAKE + REQUEST)
+        kept.append(await handshake(reader))
+    retained = (tracemalloc.get_traced_memory()[0] - base) / len(kept)
+    tracemalloc.stop()
+
+    print(f"time per handshake:      {elapsed / ROUNDS * 1e6:8.2f} us")
+    print(f"peak bytes per handshake: {sorted(peaks)[len(peaks) // 2]:7d}")
+    print(f"retained bytes per parsed request and replies: {retained:7.0f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,59 @@
+"""
+Handshake cost of a multi-user shadowsocks inbound: identify the user of a
+stream by trial-decrypting its first length chunk.
+
+    python -m benchmarks.bench_ss_multiuser
+"""
+import random
+import time
+
+from shadowproxy2.ciphers import ChaCha20IETFPoly1305, KeyRing
+
+SOURCES = 256
+
+
+def make_handshakes(users, count):
+    "returns [(source ip, user, salt, first length chunk)]"
+    ciphers = {user: ChaCha20IETFPoly1305(password) for user, password in users}
+    # every source ip always uses the same user, like a real client
+    source_users = [random.choice(users)[0] for _ in range(SOURCES)]
+    handshakes = []
+    for _ in range(count):
+        i = random.randrange(SOURCES)
+        user = source_users[i]
+        salt, encrypt = ciphers[user].make_encrypter()
+        chunk0 = encrypt(b"x" * 64)[: 2 + KeyRing.TAG_SIZE]
+        handshakes.append((f"10.0.{i // 256}.{i % 256}", user, salt, chunk0))
+    return handshakes
+
+
+def bench(n_users, count=2000):
+    users = [(f"user{i}", f"password{i}") for i in range(n_users)]
+    ring = KeyRing(dict(users))
+    handshakes = make_handshakes(users, count)
+
+    # cold: nothing cached, every handshake searches the key ring
+    cold = handshakes[: max(1, min(count, 200_000 // n_users))]
+    t = time.perf_counter()
+    for source, user, salt, chunk0 in cold:
+        ring.cache.clear()
+        assert ring.identify(salt, chunk0, source)[0] == user
+    cold_cost = (time.perf_counter() - t) / len(cold)
+
+    # warm: clients reconnect from the same source ips
+    ring.cache.clear()
+    for source, user, salt, chunk0 in handshakes:
+        ring.identify(salt, chunk0, source)
+    t = time.perf_counter()
+    for source, user, salt, chunk0 in handshakes:
+        assert ring.identify(salt, chunk0, source)[0] == user
+    warm_cost = (time.perf_counter() - t) / len(handshakes)
+    print(
+        f"{n_users:>6} users: cold {cold_cost * 1e6:>12,.1f} us/handshake, "
+        f"warm {warm_cost * 1e6:>8,.1f} us/handshake"
+    )
+
+
+if __name__ == "__main__":
+    for n in (1, 100, 10_000):
+        bench(n)
@@ -0,0 +1,104 @@
+"""
+Simulate 1k concurrent flows through the hierarchical throttle with a virtual
+clock, check the accuracy of the enforced rates and the fairness between
+users and flows.
+
+    python -m benchmarks.bench_throttle
+"""
+import heapq
+import time
+
+from shadowproxy2.throttle import HierarchicalThrottle, Shaper
+
+CHUNK = 4096
+LINE_RATE = 125_000_000  # 1Gbit/s, how fast a flow can go when not throttled
+MBIT = 125_000
+WARMUP = 1.0  # seconds, initial buckets are not counted
+
+
+def jain(values):
+    values = list(values)
+    return sum(values) ** 2 / (len(values) * sum(v * v for v in values))
+
+
+def simulate(shaper, demands, duration):
+    """
+    demands: {user: [max bytes per second of every flow, ...]}
+    returns ({user: bytes}, {(user, index): bytes}, number of charges),
+    bytes are counted after the warmup
+    """
+    start = time.monotonic()
+    flows = {}
+    heap = []
+    for user, rates in demands.items():
+        for i, rate in enumerate(rates):
+            node = shaper.connection(user)
+            flows[(user, i)] = [node, min(rate, LINE_RATE), 0]
+            heap.append((start, (user, i)))
+    heapq.heapify(heap)
+    charges = 0
+    counting = start + WARMUP
+    end = counting + duration
+    while heap:
+        now, key = heapq.heappop(heap)
+        if now >= end:
+            break
+        flow = flows[key]
+        node, rate, _ = flow
+        if now >= counting:
+            flow[2] += CHUNK
+        delay = node.charge(CHUNK, now)
+        charges += 1
+        heapq.heappush(heap, (now + max(delay, CHUNK / rate), key))
+    per_user = {}
+    for (user, _), (_, _, sent) in flows.items():
+        per_user[user] = per_user.get(user, 0) + sent
+    return per_user, {k: v[2] for k, v in flows.items()}, charges
+
+
+def report(title, expected, per_user, per_flow, duration, charges, elapsed):
+    total = sum(per_user.values()) / duration
+    print(f"== {title}")
+    print(f"flows: {len(per_flow)}, users: {len(per_user)}")
+    print(f"aggregate: {total / MBIT:.2f} Mbit/s, expected {expected / MBIT:.2f}")
+    print(f"accuracy: {total / expected:.2%}")
+    print(f"user fairness(jain): {jain(per_user.values()):.4f}")
+    print(f"flow fairness(jain): {jain(per_flow.values()):.4f}")
+    print(f"charges: {charges}, {charges / elapsed:,.0f} charges/s")
+
+
+def bench_saturated(duration=10):
+    "40 users x 25 flows, all greedy: the inbound rate is the bottleneck"
+    inbound = 100 * MBIT
+    shaper = Shaper(inbound, 5 * MBIT, parent=HierarchicalThrottle())
+    demands = {f"user{i}": [LINE_RATE] * 25 for i in range(40)}
+    t = time.perf_counter()
+    per_user, per_flow, charges = simulate(shaper, demands, duration)
+    elapsed = time.perf_counter() - t
+    report("saturated", inbound, per_user, per_flow, duration, charges, elapsed)
+
+
+def bench_borrowing(duration=10):
+    "half of the users are slow, greedy users borrow up to their own ceil"
+    inbound = 100 * MBIT
+    user_rate = 10 * MBIT
+    shaper = Shaper(inbound, user_rate, parent=HierarchicalThrottle())
+    demands = {}
+    for i in range(40):
+        if i % 2:
+            demands[f"user{i}"] = [LINE_RATE] * 25
+        else:
+            demands[f"user{i}"] = [MBIT // 50] * 25  # 0.5Mbit/s per user
+    t = time.perf_counter()
+    per_user, per_flow, charges = simulate(shaper, demands, duration)
+    elapsed = time.perf_counter() - t
+    greedy = {u: v for u, v in per_user.items() if int(u[4:]) % 2}
+    report("borrowing", inbound, per_user, per_flow, duration, charges, elapsed)
+    ceil = max(greedy.values()) / duration
+    print(f"greedy user fairness(jain): {jain(greedy.values()):.4f}")
+    print(f"max greedy user: {ceil / MBIT:.2f} Mbit/s, ceil {user_rate / MBIT:.2f}")
+
+
+if __name__ == "__main__":
+    bench_saturated()
+    bench_borrowing()
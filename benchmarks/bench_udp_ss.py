@@ -0,0 +1,81 @@
+"""
+Datagrams per second through the shadowsocks udp relay over loopback:
+an `SSClient` sends to an `SSUDPRelay` in front of a udp echo server and
+waits for the echoes, ``WINDOW`` datagrams in flight. ``direct`` sends to the
+echo server without the relay.
+
+    python -m benchmarks.bench_udp_ss
+"""
+import asyncio
+import time
+
+from shadowproxy2.ciphers import ChaCha20IETFPoly1305
+from shadowproxy2.udp import DirectClient, SSClient, SSUDPRelay
+
+COUNT = 20_000
+WINDOW = 64
+SIZES = [("small", 64), ("mtu", 1400)]
+
+
+class Echo(asyncio.DatagramProtocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.transport.sendto(data, addr)
+
+
+async def run(make_client, echo_addr, size):
+    loop = asyncio.get_running_loop()
+    payload = b"x" * size
+    received = 0
+    window_done = None
+
+    def on_received(data, addr):
+        nonlocal received
+        received += 1
+        if received % WINDOW == 0 or received == COUNT:
+            window_done.set_result(None)
+
+    client = make_client(on_received).open()
+    sent = 0
+    start = time.perf_counter()
+    while sent < COUNT:
+        window_done = loop.create_future()
+        burst = min(WINDOW, COUNT - sent)
+        for _ in range(burst):
+            client.send(payload, echo_addr)
+        sent += burst
+        try:
+            await asyncio.wait_for(window_done, 1)
+        except asyncio.TimeoutError:  # lost on loopback, move on
+            received = sent
+    elapsed = time.perf_counter() - start
+    client.close()
+    return COUNT / elapsed
+
+
+async def main():
+    loop = asyncio.get_running_loop()
+    echo, _ = await loop.create_datagram_endpoint(Echo, local_addr=("127.0.0.1", 0))
+    echo_addr = echo.get_extra_info("sockname")
+    cipher = ChaCha20IETFPoly1305("password")
+    relay, _ = await loop.create_datagram_endpoint(
+        lambda: SSUDPRelay(cipher, lambda cb: DirectClient(cb).open()),
+        local_addr=("127.0.0.1", 0),
+    )
+    relay_addr = relay.get_extra_info("sockname")
+
+    print(f"{'datagram':<16}{'direct':>14}{'udp+ss':>14}")
+    for name, size in SIZES:
+        direct = await run(DirectClient, echo_addr, size)
+        ss = await run(
+            lambda cb: SSClient(cb, cipher, relay_addr), echo_addr, size
+        )
+        print(f"{f'{name} ({size} B)':<16}{direct:>10.0f} p/s{ss:>10.0f} p/s")
+    relay.close()
+    echo.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
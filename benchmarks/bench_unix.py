@@ -0,0 +1,92 @@
+"""
+A unix socket against loopback TCP, the two ways of chaining shadowproxy
+processes on one host: the latency of connecting and echoing one byte,
+the round trip of small messages on an open connection and the upload
+throughput of ``SIZE`` bytes.
+
+    python -m benchmarks.bench_unix
+"""
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+ROUNDS = 2000
+SIZE = 256 << 20
+
+
+async def handler(reader, writer):
+    "T: count the bytes until eof and report them, P: echo"
+    mode = await reader.readexactly(1)
+    if mode == b"T":
+        total = 0
+        while data := await reader.read(65536):
+            total += len(data)
+        writer.write(total.to_bytes(8, "big"))
+    else:
+        while data := await reader.read(65536):
+            writer.write(data)
+    await writer.drain()
+    writer.close()
+
+
+async def run(open_connection):
+    connects = []
+    for _ in range(ROUNDS // 10):
+        start = time.perf_counter()
+        reader, writer = await open_connection()
+        writer.write(b"Pp")
+        await reader.readexactly(1)
+        connects.append(time.perf_counter() - start)
+        writer.close()
+
+    reader, writer = await open_connection()
+    writer.write(b"P")
+    rtts = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        writer.write(b"p" * 64)
+        await reader.readexactly(64)
+        rtts.append(time.perf_counter() - start)
+    writer.close()
+
+    reader, writer = await open_connection()
+    payload = b"x" * 65536
+    start = time.perf_counter()
+    writer.write(b"T")
+    for _ in range(SIZE // len(payload)):
+        writer.write(payload)
+        await writer.drain()
+    writer.write_eof()
+    assert int.from_bytes(await reader.readexactly(8), "big") == SIZE
+    elapsed = time.perf_counter() - start
+    writer.close()
+    return (
+        statistics.median(connects) * 1e6,
+        statistics.median(rtts) * 1e6,
+        SIZE / elapsed / 1e6,
+    )
+
+
+def report(name, result):
+    connect, rtt, mbps = result
+    print(f"{name:<8}{connect:>10.1f} us{rtt:>10.1f} us{mbps:>10.0f} MB/s")
+
+
+async def main():
+    print(f"{'':<8}{'connect':>13}{'rtt':>13}{'upload':>15}")
+    server = await asyncio.start_server(handler, "127.0.0.1", 0)
+    addr = server.sockets[0].getsockname()
+    report("tcp", await run(lambda: asyncio.open_connection(*addr)))
+    server.close()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.sock")
+        server = await asyncio.start_unix_server(handler, path)
+        report("unix", await run(lambda: asyncio.open_unix_connection(path)))
+        server.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
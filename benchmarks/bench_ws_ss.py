@@ -0,0 +1,70 @@
+"""
+Upload throughput of ss over websocket on loopback: an `AEADParser` client
+relays ``SIZE`` bytes in 4 KiB chunks, like `NullParser.relay`, to an
+`AEADParser` server that decrypts and counts them. ``frame per write``
+replays the former adapter, one frame per chunk with permessage-deflate
+negotiated, against the coalescing `WebsocketWriter`.
+
+    python -m benchmarks.bench_ws_ss
+"""
+import asyncio
+import time
+
+import websockets
+
+from shadowproxy2.ciphers import ChaCha20IETFPoly1305
+from shadowproxy2.parsers.aead import AEADParser
+from shadowproxy2.transport.ws import WebsocketReader, WebsocketWriter
+
+SIZE = 64 << 20
+CHUNK = 4096
+
+
+class FrameWriter(WebsocketWriter):
+    "the former adapter: a frame for every write"
+
+    async def write(self, data):
+        await self.ws.send(data)
+
+
+async def run(writer_class, compression):
+    cipher = ChaCha20IETFPoly1305("password")
+    received = asyncio.get_running_loop().create_future()
+
+    async def handler(ws, path):
+        parser = AEADParser(cipher)
+        parser.set_rw(WebsocketReader(ws), writer_class(ws))
+        await parser.reader.readexactly(7)  # the target address
+        total = 0
+        while data := await parser.read_func(65536):
+            total += len(data)
+        received.set_result(total)
+
+    async with websockets.serve(
+        handler, "127.0.0.1", 0, compression=compression
+    ) as server:
+        port = server.sockets[0].getsockname()[1]
+        ws = await websockets.connect(
+            f"ws://127.0.0.1:{port}/ws", compression=compression
+        )
+        parser = AEADParser(cipher)
+        parser.set_rw(WebsocketReader(ws), writer_class(ws))
+        chunk = b"x" * CHUNK
+        start = time.perf_counter()
+        await parser.init_client(("127.0.0.1", 80))
+        for _ in range(SIZE // CHUNK):
+            await parser.write(chunk)
+        await parser.writer.close()
+        assert await received == SIZE
+        return SIZE / (time.perf_counter() - start) / 1e6
+
+
+async def main():
+    former = await run(FrameWriter, "deflate")
+    coalesced = await run(WebsocketWriter, None)
+    print(f"{'frame per write':<18}{former:>8.1f} MB/s")
+    print(f"{'coalesced':<18}{coalesced:>8.1f} MB/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
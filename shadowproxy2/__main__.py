@@ -8,9 +8,13 @@ import uvloop
 from . import app
 from .context import ProxyContext
 from .server import run_server
+from .throttle import global_download, global_upload, kbps
 from .urlparser import URLVisitor, grammar
 
-url_format = "[transport+]proxy://[username:password@][host]:port[#key1=value1,...]"
+url_format = (
+    "[transport+]proxy://[username:password@][host]:port[#key1=value1,...]"
+    " or unix+proxy://[username:password@]/socket/path[#key1=value1,...]"
+)
 base_path = abspath(join(dirname(__file__), ".."))
 ssl_cert_path = join(base_path, "certs", "ssl_cert.pem")
 ssl_key_path = join(base_path, "certs", "ssl_key.pem")
@@ -101,6 +105,34 @@ def validate_urls(ctx, param, urls):
 @click.option(
     "--enable-health-check", is_flag=True, help="enable ws health check function"
 )
+@click.option(
+    "--tier-api-token",
+    metavar="TOKEN",
+    help="enable ws api to change tiers of named inbounds: /tier?name=x&dl=720p"
+    ", with an Authorization: Bearer TOKEN header",
+)
+@click.option(
+    "--traffic-db",
+    type=click.Path(dir_okay=False),
+    help="sqlite database to record traffic per user and to enforce quotas",
+)
+@click.option(
+    "--flush-interval",
+    default=5.0,
+    help="seconds between flushes of traffic counters, default to 5",
+)
+@click.option(
+    "--cut-over-quota",
+    is_flag=True,
+    help="close existing connections of users who exceeded their quotas",
+)
+@click.option("--ul", type=int, help="global max upload traffic speed(KB/s)")
+@click.option("--dl", type=int, help="global max download traffic speed(KB/s)")
+@click.option(
+    "--fast-open",
+    is_flag=True,
+    help="reply socks/http connect success before the outbound is connected",
+)
 @click.option("-v", "--verbose", count=True)
 def main(
     inbound_list,
@@ -112,6 +144,13 @@ def main(
     blacklist,
     block_internal_ips,
     enable_health_check,
+    tier_api_token,
+    traffic_db,
+    flush_interval,
+    cut_over_quota,
+    ul,
+    dl,
+    fast_open,
 ):
     try:
         resource.setrlimit(resource.RLIMIT_NOFILE, (50000, 50000))
@@ -125,7 +164,16 @@ def main(
         verbose=verbose,
         block_internal_ips=block_internal_ips,
         enable_health_check=enable_health_check,
+        tier_api_token=tier_api_token,
+        traffic_db=traffic_db,
+        flush_interval=flush_interval,
+        cut_over_quota=cut_over_quota,
+        ul=ul,
+        dl=dl,
+        fast_open=fast_open,
     )
+    global_upload.update_rate(kbps(ul))
+    global_download.update_rate(kbps(dl))
     if blacklist:
         with open(blacklist, "r") as f:
             app.settings.blacklist = set(line.strip() for line in f)
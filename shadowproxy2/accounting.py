@@ -0,0 +1,160 @@
+import asyncio
+import sqlite3
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from inspect import isawaitable
+from typing import Dict, Set, Tuple
+
+import click
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS traffic (
+    inbound TEXT NOT NULL,
+    user TEXT NOT NULL,
+    upload INTEGER NOT NULL DEFAULT 0,
+    download INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (inbound, user)
+);
+CREATE TABLE IF NOT EXISTS quota (
+    user TEXT PRIMARY KEY,
+    limit_bytes INTEGER NOT NULL
+);
+"""
+UPSERT = """
+INSERT INTO traffic (inbound, user, upload, download) VALUES (?, ?, ?, ?)
+ON CONFLICT (inbound, user) DO UPDATE SET
+    upload = upload + excluded.upload,
+    download = download + excluded.download
+"""
+OVER_QUOTA = """
+SELECT quota.user FROM quota JOIN (
+    SELECT user, SUM(upload + download) AS total FROM traffic GROUP BY user
+) AS t ON quota.user = t.user WHERE t.total >= quota.limit_bytes
+"""
+
+
+class QuotaExceeded(Exception):
+    ...
+
+
+class Counter:
+    __slots__ = ("nbytes",)
+
+    def __init__(self):
+        self.nbytes = 0
+
+
+class Usage:
+    "in-memory traffic counters of one user on one inbound"
+
+    __slots__ = ("upload", "download", "flushed", "parsers")
+
+    def __init__(self):
+        self.upload = Counter()
+        self.download = Counter()
+        self.flushed = (0, 0)
+        self.parsers = weakref.WeakSet()
+
+
+class Accounting:
+    """
+    Count traffic per user and per inbound in memory, flush the counters to
+    a SQLite database in one transaction every ``interval`` seconds.
+
+    >>> accounting = Accounting(":memory:")
+    >>> usage = accounting.usage("socks5", "alice")
+    >>> usage.upload.nbytes += 100
+    >>> usage.download.nbytes += 2000
+    >>> accounting._write(accounting._collect())
+    >>> accounting.db.execute("SELECT * FROM traffic").fetchall()
+    [('socks5', 'alice', 100, 2000)]
+    >>> _ = accounting.db.execute("INSERT INTO quota VALUES ('alice', 2000)")
+    >>> accounting._write(accounting._collect())
+    >>> accounting.blocked
+    {'alice'}
+    """
+
+    def __init__(self, path: str, interval: float = 5.0, cut: bool = False):
+        self.interval = interval
+        self.cut = cut
+        self.usages: Dict[Tuple[str, str], Usage] = {}
+        self.blocked: Set[str] = set()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._write([])
+
+    def usage(self, inbound: str, user: str) -> Usage:
+        key = (inbound, user)
+        usage = self.usages.get(key)
+        if usage is None:
+            usage = self.usages[key] = Usage()
+        return usage
+
+    def check(self, user: str):
+        if user in self.blocked:
+            raise QuotaExceeded(f"{user} exceeded the quota")
+
+    def start(self, inbound: str, user: str, parser, remote_parser):
+        "count the traffic of a new connection"
+        self.check(user)
+        usage = self.usage(inbound, user)
+        parser.counter = usage.upload
+        remote_parser.counter = usage.download
+        usage.parsers.add(parser)
+
+    def start_meter(self, inbound: str, user: str, meter):
+        "count the datagrams of a new udp session, see `DatagramMeter`"
+        self.check(user)
+        usage = self.usage(inbound, user)
+        meter.upload = usage.upload
+        meter.download = usage.download
+        usage.parsers.add(meter)
+
+    def _collect(self):
+        rows = []
+        for (inbound, user), usage in self.usages.items():
+            upload, download = usage.upload.nbytes, usage.download.nbytes
+            flushed_upload, flushed_download = usage.flushed
+            if upload == flushed_upload and download == flushed_download:
+                continue
+            usage.flushed = (upload, download)
+            rows.append(
+                (inbound, user, upload - flushed_upload, download - flushed_download)
+            )
+        return rows
+
+    def _write(self, rows):
+        with self.db:
+            self.db.executemany(UPSERT, rows)
+        self.blocked = {user for (user,) in self.db.execute(OVER_QUOTA)}
+
+    async def flush(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._write, self._collect())
+        for key, usage in list(self.usages.items()):
+            if self.cut and key[1] in self.blocked:
+                for parser in list(usage.parsers):
+                    r = parser.close()
+                    if isawaitable(r):
+                        await r
+            if not usage.parsers and usage.flushed == (
+                usage.upload.nbytes,
+                usage.download.nbytes,
+            ):
+                del self.usages[key]
+
+    async def run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                try:
+                    await self.flush()
+                except Exception as e:
+                    click.secho(f"flush traffic failed: {e}", fg="red")
+        finally:
+            await self.flush()
+
+    def close(self):
+        self._executor.shutdown()
+        self.db.close()
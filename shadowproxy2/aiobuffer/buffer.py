@@ -4,15 +4,33 @@ import enum
 import types
 from asyncio import exceptions
 from collections import deque
+from operator import attrgetter
 from struct import Struct, pack
 from typing import Any, Callable, Dict, List, Mapping, Optional, Type, Union
 
 _parent_stack: deque["BinarySchema"] = deque()
+_mapping_stack: deque[dict] = deque()  # fields parsed so far, for `Switch`
+
+
+class StarvingException(Exception):
+    "not enough bytes to parse"
 
 
 class Unit(abc.ABC):
     """Unit is the base class of all units. \
-    If you can build your own unit class, you must inherit from it"""
+    If you can build your own unit class, you must inherit from it
+
+    A unit that can not be parsed synchronously is refused when it is made,
+    not when a schema using it is parsed:
+
+    >>> class Opaque(Unit):
+    ...     async def get_value(self, buffer): ...
+    ...     def __call__(self, obj): ...
+    >>> Opaque()  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    TypeError: Can't instantiate abstract class Opaque...
+    """
 
     @abc.abstractmethod
     async def get_value(self, buffer):
@@ -22,6 +40,82 @@ class Unit(abc.ABC):
     def __call__(self, obj) -> bytes:
         "convert user-given object to bytes"
 
+    def _struct_code(self) -> Optional[tuple]:
+        """
+        (byte order, struct code, decode function) if the unit is a fixed-size
+        struct field, byte order is None if it does not matter
+        """
+        return None
+
+    @abc.abstractmethod
+    def parse_from(self, data, offset: int = 0) -> tuple:
+        """
+        parse the unit from bytes-like ``data`` (bytes, bytearray or
+        memoryview) at ``offset`` without an event loop, return
+        (value, new offset), raise `StarvingException` if more bytes are needed
+        """
+
+
+def _compose(first: Optional[Callable], second: Callable) -> Callable:
+    if first is None:
+        return second
+    return lambda value: second(first(value))
+
+
+def _struct_step(order: Optional[str], run: list) -> Callable:
+    struct = Struct((order or ">") + "".join(code for _, code, _ in run))
+    size = struct.size
+    items = [(name, decode) for name, _, decode in run]
+
+    def step(data, offset: int, mapping: dict) -> int:
+        end = offset + size
+        if len(data) < end:
+            raise StarvingException
+        for (name, decode), value in zip(items, struct.unpack_from(data, offset)):
+            mapping[name] = value if decode is None else decode(value)
+        return end
+
+    return step
+
+
+def _field_step(name: str, field: "FieldType") -> Callable:
+    parse = field.parse_from
+
+    def step(data, offset: int, mapping: dict) -> int:
+        mapping[name], offset = parse(data, offset)
+        return offset
+
+    return step
+
+
+def _compile(fields: Dict[str, "FieldType"]) -> List[Callable]:
+    """
+    compile the fields of a schema into a list of synchronous parse steps,
+    runs of fixed-size fields are merged into one `Struct`
+    """
+    steps: List[Callable] = []
+    run: list = []
+    run_order: Optional[str] = None
+    for name, field in fields.items():
+        code = field._struct_code() if isinstance(field, Unit) else None
+        if code is not None:
+            order, fmt, decode = code
+            if order is None or run_order is None or order == run_order:
+                run.append((name, fmt, decode))
+                run_order = run_order or order
+                continue
+        if run:
+            steps.append(_struct_step(run_order, run))
+            run, run_order = [], None
+        if code is not None:
+            run.append((name, fmt, decode))
+            run_order = order
+        else:
+            steps.append(_field_step(name, field))
+    if run:
+        steps.append(_struct_step(run_order, run))
+    return steps
+
 
 class BinarySchemaMetaclass(type):
     def __new__(mcls, name, bases, namespace, **kwargs):
@@ -29,8 +123,20 @@ class BinarySchemaMetaclass(type):
         for key, member in namespace.items():
             if isinstance(member, (Unit, BinarySchemaMetaclass)):
                 fields[key] = member
-                namespace[key] = MemberDescriptor(key, member)
+        for index, (key, member) in enumerate(fields.items()):
+            namespace[key] = MemberDescriptor(key, member, index)
         namespace["_fields"] = fields
+        namespace["_defaults"] = tuple(
+            (index, member.value)
+            for index, member in enumerate(fields.values())
+            if isinstance(member, MustEqual)
+        )
+        namespace["_encoders"] = tuple(
+            _get_binary if isinstance(member, BinarySchemaMetaclass) else member
+            for member in fields.values()
+        )
+        namespace["_steps"] = _compile(fields)
+        namespace.setdefault("__slots__", ())
         return super().__new__(mcls, name, bases, namespace)
 
     def __str__(cls):
@@ -51,41 +157,85 @@ class BinarySchemaMetaclass(type):
             buffer._mapping_stack.pop()
         return cls(*mapping.values())
 
+    def parse_from(cls, data, offset: int = 0) -> tuple:
+        """
+        parse a `BinarySchema` object from bytes-like ``data`` at ``offset``,
+        return (object, new offset)
+
+        >>> from .socks5 import UDPRelay
+        >>> header = b"\\x00\\x00\\x00\\x01\\x7f\\x00\\x00\\x01\\x00\\x35"
+        >>> packet = memoryview(header + b"hello")
+        >>> relay, offset = UDPRelay.parse_from(packet)
+        >>> relay.addr.host, relay.addr.port, relay.data, offset
+        ('127.0.0.1', 53, b'hello', 15)
+        >>> UDPRelay.parse_from(packet[:6])
+        Traceback (most recent call last):
+        ...
+        shadowproxy2.aiobuffer.buffer.StarvingException
+        """
+        mapping: Dict[str, Any] = {}
+        _mapping_stack.append(mapping)
+        try:
+            for step in cls._steps:
+                offset = step(data, offset, mapping)
+        finally:
+            _mapping_stack.pop()
+        return cls(*mapping.values()), offset
+
+
+_get_binary = attrgetter("binary")
+
 
 class BinarySchema(metaclass=BinarySchemaMetaclass):
-    """The main class for users to define their own binary structures"""
+    """
+    The main class for users to define their own binary structures.
+
+    Instances only keep the field values, the binary is encoded on first
+    access and memoized until a field is assigned again, so constant packets
+    can be built once and reused:
+
+    >>> class Pair(BinarySchema):
+    ...     first = u8
+    ...     second = MustEqual(u8, 2)
+    >>> pair = Pair(1, ...)
+    >>> pair.binary
+    b'\\x01\\x02'
+    >>> pair.binary is pair.binary
+    True
+    >>> pair.first = 3
+    >>> pair.binary
+    b'\\x03\\x02'
+    """
+
+    __slots__ = ("_values", "_binary")
 
     def __init__(self, *args):
-        self._modified = True
-        if len(args) != len(self.__class__._fields):
-            raise ValueError(
-                f"need {len(self.__class__._fields)} args, got {len(args)}"
-            )
-        self.values = {}
-        self.bins = {}
-        _parent_stack.append(self)
-        try:
-            for arg, (name, field) in zip(args, self.__class__._fields.items()):
-                setattr(self, name, arg)
-        finally:
-            _parent_stack.pop()
+        cls = self.__class__
+        if len(args) != len(cls._fields):
+            raise ValueError(f"need {len(cls._fields)} args, got {len(args)}")
+        values = list(args)
+        for index, value in cls._defaults:
+            if values[index] is ...:
+                values[index] = value
+        self._values = values
+        self._binary = None
 
         if hasattr(self, "__post_init__"):
             self.__post_init__()
 
-    def member_get(self, name):
-        return self.values[name]
-
-    def member_set(self, name, value, binary):
-        self.bins[name] = binary
-        self.values[name] = value
-        self._modified = True
-
     @property
     def binary(self) -> bytes:
-        if self._modified:
-            self._binary = b"".join(self.bins.values())
-            self._modified = False
+        if self._binary is None:
+            _parent_stack.append(self)
+            try:
+                self._binary = b"".join(
+                    [
+                        encode(value)
+                        for encode, value in zip(self.__class__._encoders, self._values)
+                    ]
+                )
+            finally:
+                _parent_stack.pop()
         return self._binary
 
     def __str__(self):
@@ -102,10 +252,7 @@ class BinarySchema(metaclass=BinarySchemaMetaclass):
     def __eq__(self, other) -> bool:
         if not isinstance(other, self.__class__):
             return False
-        for name in self.__class__._fields:
-            if getattr(self, name) != getattr(other, name):
-                return False
-        return True
+        return self._values == other._values
 
 
 FieldType = Union[Type[BinarySchema], Unit]
@@ -116,26 +263,24 @@ class Placeholder(BinarySchema):
 
 
 class MemberDescriptor:
-    __slots__ = ("key", "member")
+    __slots__ = ("key", "member", "index")
 
-    def __init__(self, key: str, member: FieldType):
+    def __init__(self, key: str, member: FieldType, index: int):
         self.key = key
         self.member = member
+        self.index = index
 
     def __get__(self, obj: Optional[BinarySchema], owner):
         if obj is None:
             return self.member
-        return obj.member_get(self.key)
+        return obj._values[self.index]
 
     def __set__(self, obj: BinarySchema, value):
-        if isinstance(self.member, BinarySchemaMetaclass):
-            binary = value.binary
-        elif isinstance(self.member, Unit):
-            binary = self.member(value)
         if value is ...:
             assert isinstance(self.member, MustEqual)
             value = self.member.value
-        obj.member_set(self.key, value, binary)
+        obj._values[self.index] = value
+        obj._binary = None
 
 
 # class AioBuffer:
@@ -271,6 +416,28 @@ class MemberDescriptor:
 #         return res
 
 
+async def _pull_compiled(self, obj):
+    """
+    parse straight from the buffered bytes, wait for more data only when
+    starving; fall back to field by field parsing for oversized objects
+    """
+    while True:
+        try:
+            value, offset = obj.parse_from(self._buffer, 0)
+        except StarvingException:
+            if self._exception is not None:
+                raise self._exception
+            if self._eof:
+                raise exceptions.IncompleteReadError(bytes(self._buffer), None)
+            if len(self._buffer) >= self._limit:
+                return await obj.get_value(self)
+            await self._wait_for_data("pull")
+        else:
+            del self._buffer[:offset]
+            self._maybe_resume_transport()
+            return value
+
+
 async def _pull(self, obj):
     if isinstance(obj, int):
         if obj > 0:
@@ -284,7 +451,7 @@ async def _pull(self, obj):
     elif isinstance(obj, str):
         return await self.pull(Struct(obj))
     elif isinstance(obj, (Unit, BinarySchemaMetaclass)):
-        return await obj.get_value(self)
+        return await _pull_compiled(self, obj)
     else:
         raise TypeError(f"unknown object type: {type(obj)}")
 
@@ -340,6 +507,26 @@ class SingleStructUnit(Unit):
     def __call__(self, obj) -> bytes:
         return self._struct.pack(obj)
 
+    def _struct_code(self):
+        fmt = self._struct.format
+        if fmt[0] in "@=<>!":
+            order, code = fmt[0], fmt[1:]
+        else:
+            order, code = "@", fmt
+        if self._struct.size == 1 or code.endswith("s"):
+            return None, code, None
+        if order == "@":
+            # native alignment would insert padding into a merged struct
+            return None
+        return (">" if order == "!" else order), code, None
+
+
+    def parse_from(self, data, offset=0):
+        end = offset + self._struct.size
+        if len(data) < end:
+            raise StarvingException
+        return self._struct.unpack_from(data, offset)[0], end
+
 
 class IntUnit(Unit):
     def __init__(self, length: int, byteorder: str, signed: bool = False):
@@ -355,6 +542,19 @@ class IntUnit(Unit):
     def __call__(self, obj: int) -> bytes:
         return obj.to_bytes(self.length, self.byteorder, signed=self.signed)
 
+    def _decode(self, data: bytes) -> int:
+        return int.from_bytes(data, self.byteorder, signed=self.signed)
+
+    def _struct_code(self):
+        return None, f"{self.length}s", self._decode
+
+
+    def parse_from(self, data, offset=0):
+        end = offset + self.length
+        if len(data) < end:
+            raise StarvingException
+        return self._decode(data[offset:end]), end
+
 
 i8 = SingleStructUnit("b")
 u8 = SingleStructUnit("B")
@@ -398,6 +598,19 @@ class Bytes(Unit):
     def __call__(self, obj) -> bytes:
         return bytes(obj)
 
+    def _struct_code(self):
+        if self.length >= 0:
+            return None, f"{self.length}s", None
+
+
+    def parse_from(self, data, offset=0):
+        if self.length < 0:
+            return bytes(data[offset:]), len(data)
+        end = offset + self.length
+        if len(data) < end:
+            raise StarvingException
+        return bytes(data[offset:end]), end
+
 
 class MustEqual(Unit):
     def __init__(self, unit: Unit, value):
@@ -408,10 +621,7 @@ class MustEqual(Unit):
         return f"{self.__class__.__name__}({self.unit}, {self.value})"
 
     async def get_value(self, buffer):
-        result = await self.unit.get_value(buffer)
-        if self.value != result:
-            raise ValueError(f"expect {self.value}, got {result}")
-        return result
+        return self._check(await self.unit.get_value(buffer))
 
     def __call__(self, obj) -> bytes:
         if obj is not ...:
@@ -419,6 +629,22 @@ class MustEqual(Unit):
                 raise ValueError(f"expect {self.value}, got {obj}")
         return self.unit(self.value)
 
+    def _check(self, result):
+        if self.value != result:
+            raise ValueError(f"expect {self.value}, got {result}")
+        return result
+
+    def _struct_code(self):
+        code = self.unit._struct_code()
+        if code is not None:
+            order, fmt, decode = code
+            return order, fmt, _compose(decode, self._check)
+
+
+    def parse_from(self, data, offset=0):
+        result, offset = self.unit.parse_from(data, offset)
+        return self._check(result), offset
+
 
 class EndWith(Unit):
     def __init__(self, bytes_: bytes):
@@ -434,6 +660,18 @@ class EndWith(Unit):
         return obj + self.bytes_
 
 
+    def parse_from(self, data, offset=0):
+        if isinstance(data, memoryview):
+            # memoryview has no find, search a copy of the remaining bytes
+            index = data[offset:].tobytes().find(self.bytes_)
+            index = index if index == -1 else index + offset
+        else:
+            index = data.find(self.bytes_, offset)
+        if index == -1:
+            raise StarvingException
+        return bytes(data[offset:index]), index + len(self.bytes_)
+
+
 class LengthPrefixedBytes(Unit):
     def __init__(self, length_unit: Union[SingleStructUnit, IntUnit]):
         self.length_unit = length_unit
@@ -450,6 +688,14 @@ class LengthPrefixedBytes(Unit):
         return self.length_unit(length) + pack(f"{length}s", obj)
 
 
+    def parse_from(self, data, offset=0):
+        length, offset = self.length_unit.parse_from(data, offset)
+        end = offset + length
+        if len(data) < end:
+            raise StarvingException
+        return bytes(data[offset:end]), end
+
+
 class Switch(Unit):
     def __init__(self, ref: str, cases: Mapping[Any, FieldType]):
         self.ref = ref
@@ -468,6 +714,10 @@ class Switch(Unit):
         real_field = self.cases[getattr(parent, self.ref)]
         return real_field(obj) if isinstance(real_field, Unit) else obj.binary
 
+    def parse_from(self, data, offset=0):
+        "only as a field of a schema, whose fields parsed so far hold ``ref``"
+        return self.cases[_mapping_stack[-1][self.ref]].parse_from(data, offset)
+
 
 class SizedIntEnum(Unit):
     def __init__(
@@ -488,6 +738,17 @@ class SizedIntEnum(Unit):
     def __call__(self, obj: enum.IntEnum) -> bytes:
         return self.size_unit(obj.value)
 
+    def _struct_code(self):
+        code = self.size_unit._struct_code()
+        if code is not None:
+            order, fmt, decode = code
+            return order, fmt, _compose(decode, self.enum_class)
+
+
+    def parse_from(self, data, offset=0):
+        v, offset = self.size_unit.parse_from(data, offset)
+        return self.enum_class(v), offset
+
 
 class Convert(Unit):
     def __init__(self, unit: Unit, *, encode: Callable, decode: Callable):
@@ -508,6 +769,17 @@ class Convert(Unit):
     def __call__(self, obj: Any) -> bytes:
         return self.unit(self.encode(obj))
 
+    def _struct_code(self):
+        code = self.unit._struct_code()
+        if code is not None:
+            order, fmt, decode = code
+            return order, fmt, _compose(decode, self.decode)
+
+
+    def parse_from(self, data, offset=0):
+        v, offset = self.unit.parse_from(data, offset)
+        return self.decode(v), offset
+
 
 class String(Convert):
     def __init__(self, length: int, encoding="utf-8"):
@@ -544,13 +816,25 @@ class LengthPrefixedObject(Unit):
     async def get_value(self, buffer):
         length = await self.length_unit.get_value(buffer)
         data = await buffer.pull(length)
-        temp_buffer = create_buffer()
-        temp_buffer.feed_data(data)
-        obj = await self.object_unit.get_value(temp_buffer)
-        if len(temp_buffer) > 0:
+        return self._parse_object(memoryview(data))
+
+
+    def _parse_object(self, view: memoryview):
+        try:
+            obj, offset = self.object_unit.parse_from(view)
+        except StarvingException:
+            raise ValueError("incomplete object")
+        if offset != len(view):
             raise ValueError("extra bytes left")
         return obj
 
+    def parse_from(self, data, offset=0):
+        length, offset = self.length_unit.parse_from(data, offset)
+        end = offset + length
+        if len(data) < end:
+            raise StarvingException
+        return self._parse_object(memoryview(data)[offset:end]), end
+
     def __call__(self, obj: FieldType) -> bytes:
         bytes_ = (
             obj.binary
@@ -561,14 +845,25 @@ class LengthPrefixedObject(Unit):
 
 
 class LengthPrefixedObjectList(LengthPrefixedObject):
-    async def get_value(self, buffer):
-        length = await self.length_unit.get_value(buffer)
-        data = await buffer.pull(length)
-        temp_buffer = create_buffer()
-        temp_buffer.feed_data(data)
+    r"""
+    ``object_unit`` values filling ``length_unit`` bytes
+
+    >>> from .socks5 import Addr
+    >>> addrs = Addr(1, "1.2.3.4", 80).binary + Addr(3, "a.b", 53).binary
+    >>> values, offset = LengthPrefixedObjectList(u8, Addr).parse_from(b"\x0e" + addrs)
+    >>> [(addr.host, addr.port) for addr in values], offset
+    ([('1.2.3.4', 80), ('a.b', 53)], 15)
+    """
+
+    def _parse_object(self, view: memoryview):
         lst = []
-        while len(temp_buffer._buffer) > 0:
-            lst.append(await self.object_unit.get_value(temp_buffer))
+        offset = 0
+        try:
+            while offset < len(view):
+                obj, offset = self.object_unit.parse_from(view, offset)
+                lst.append(obj)
+        except StarvingException:
+            raise ValueError("incomplete object")
         return lst
 
     def __call__(self, obj_list: List[FieldType]) -> bytes:
@@ -58,13 +58,14 @@ class Addr(schema.BinarySchema):
 
     @classmethod
     def from_tuple(cls, addr):
-        try:
-            return cls(1, *addr)
-        except OSError:
+        for atyp in (1, 4):
+            obj = cls(atyp, *addr)
             try:
-                return cls(4, *addr)
+                obj.binary  # encoding fails if host is not an ip of this family
             except OSError:
-                return cls(3, *addr)
+                continue
+            return obj
+        return cls(3, *addr)
 
 
 class AuthMethod(enum.IntEnum):
@@ -1,3 +1,5 @@
+from pathlib import Path
+
 from pydantic import BaseSettings, FilePath
 
 
@@ -9,6 +11,13 @@ class Settings(BaseSettings):
     blacklist: set = set()
     block_internal_ips: bool = False
     enable_health_check: bool = False
+    tier_api_token: str = None
+    traffic_db: Path = None
+    flush_interval: float = 5.0
+    cut_over_quota: bool = False
+    ul: int = None
+    dl: int = None
+    fast_open: bool = False
 
 
 settings = Settings()
@@ -1,9 +1,11 @@
+import hmac
 import os
-from hashlib import md5, sha1
-from typing import Callable, Optional
+from collections import OrderedDict
+from hashlib import md5
+from typing import Callable, Mapping, Optional
 
-import hkdf
 from nacl import bindings
+from nacl.exceptions import CryptoError
 
 
 def EVP_BytesToKey(password: bytes, size: int, salt: bytes = b"") -> bytes:
@@ -13,6 +15,24 @@ def EVP_BytesToKey(password: bytes, size: int, salt: bytes = b"") -> bytes:
     return b"".join(keybuf)[:size]
 
 
+def hkdf_sha1(salt: bytes, key: bytes, info: bytes, size: int) -> bytes:
+    """
+    HKDF (RFC 5869) with sha1 from one-shot hmacs, cheap enough to run for
+    every udp packet
+
+    >>> okm = hkdf_sha1(bytes(range(13)), b"\x0b" * 11, bytes(range(0xF0, 0xFA)), 42)
+    >>> okm.hex()[:32]
+    '085a01ea1b10f36933068b56efa5ad81'
+    """
+    prk = hmac.digest(salt, key, "sha1")
+    block = b""
+    blocks = []
+    for i in range(1, -(-size // 20) + 1):
+        block = hmac.digest(prk, block + info + bytes((i,)), "sha1")
+        blocks.append(block)
+    return b"".join(blocks)[:size]
+
+
 class ChaCha20IETFPoly1305:
     """
     >>> cipher = ChaCha20IETFPoly1305('password')
@@ -29,6 +49,8 @@ class ChaCha20IETFPoly1305:
     ...         assert rand_bytes == back_bytes
     ...     else:
     ...         assert l == cipher.PACKET_LIMIT
+    >>> cipher.decrypt_packet(cipher.encrypt_packet(b"datagram"))
+    b'datagram'
     """
 
     KEY_SIZE = 32
@@ -37,6 +59,7 @@ class ChaCha20IETFPoly1305:
     TAG_SIZE = 16
     PACKET_LIMIT = 0x3FFF
     info = b"ss-subkey"
+    ZERO_NONCE = bytes(NONCE_SIZE)
 
     def __init__(self, password: str):
         self.master_key = EVP_BytesToKey(
@@ -47,7 +70,7 @@ class ChaCha20IETFPoly1305:
         return os.urandom(self.SALT_SIZE)
 
     def _derive_subkey(self, salt: bytes) -> bytes:
-        return hkdf.Hkdf(salt, self.master_key, sha1).expand(self.info, self.KEY_SIZE)
+        return hkdf_sha1(salt, self.master_key, self.info, self.KEY_SIZE)
 
     def make_encrypter(self, salt: Optional[bytes] = None) -> (bytes, Callable):
         counter = 0
@@ -86,3 +109,115 @@ class ChaCha20IETFPoly1305:
             )
 
         return decrypt
+
+    def encrypt_packet(self, plaintext: bytes) -> bytes:
+        "a udp packet: its own random salt, then the plaintext sealed with nonce 0"
+        salt = self._random_salt()
+        return salt + bindings.crypto_aead_chacha20poly1305_ietf_encrypt(
+            plaintext, b"", self.ZERO_NONCE, self._derive_subkey(salt)
+        )
+
+    def decrypt_packet(self, packet: bytes) -> bytes:
+        salt = packet[: self.SALT_SIZE]
+        return bindings.crypto_aead_chacha20poly1305_ietf_decrypt(
+            packet[self.SALT_SIZE :], b"", self.ZERO_NONCE, self._derive_subkey(salt)
+        )
+
+
+class KeyRing:
+    """
+    Identify which user's key encrypted a stream by trial-decrypting its first
+    length chunk. The key that matched last time for the same source is tried
+    first, then the others in order of their recent hits. Only the first
+    ``HOT_KEYS`` are meant to be tried on the event loop, a connection
+    matching none of them has all of `keys` tried in an executor, see
+    `MultiUserAEADParser`.
+
+    >>> ring = KeyRing({"alice": "password1", "bob": "password2"})
+    >>> salt, encrypt = ChaCha20IETFPoly1305("password2").make_encrypter()
+    >>> ciphertext = encrypt(b"hello")
+    >>> size = 2 + ring.TAG_SIZE
+    >>> chunk0, chunk1 = ciphertext[:size], ciphertext[size:]
+    >>> user, cipher, decrypt, length_bytes = ring.identify(salt, chunk0, "1.2.3.4")
+    >>> user, int.from_bytes(length_bytes, "big"), decrypt(chunk1)
+    ('bob', 5, b'hello')
+    >>> ring.cache["1.2.3.4"], list(ring.ciphers)
+    ('bob', ['bob', 'alice'])
+    >>> [user for user, cipher in ring.candidates("5.6.7.8")]
+    ['bob', 'alice']
+    """
+
+    cipher_class = ChaCha20IETFPoly1305
+    HOT_KEYS = 16
+    SALT_SIZE = cipher_class.SALT_SIZE
+    TAG_SIZE = cipher_class.TAG_SIZE
+
+    def __init__(self, users: Mapping[str, str], cache_size: int = 65536):
+        self.ciphers: OrderedDict = OrderedDict()
+        self.passwords: Mapping[str, str] = {}
+        self.cache: OrderedDict = OrderedDict()
+        self.cache_size = cache_size
+        self.update(users)
+
+    def update(self, users: Mapping[str, str]):
+        "replace the keys, keep the hit order of unchanged users"
+        ciphers = OrderedDict(
+            (user, cipher)
+            for user, cipher in self.ciphers.items()
+            if self.passwords[user] == users.get(user)
+        )
+        for user, password in users.items():
+            if user not in ciphers:
+                ciphers[user] = self.cipher_class(password)
+        self.ciphers = ciphers
+        self.keys = tuple(ciphers.items())  # not reordered by hits, see `trial`
+        self.passwords = dict(users)
+
+    def candidates(self, source=None):
+        """
+        (user, cipher) pairs, the key that matched for ``source`` first, then
+        the others in hit order; lazily, a cache hit costs a lookup
+        """
+        cached = self.cache.get(source)
+        cipher = self.ciphers.get(cached)
+        if cipher is not None:
+            yield cached, cipher
+        for item in self.ciphers.items():
+            if item[0] != cached:
+                yield item
+
+    @staticmethod
+    def trial(salt: bytes, chunk: bytes, candidates):
+        """
+        return (user, cipher, decrypter, plaintext of the chunk) of the first
+        candidate whose key decrypts the chunk, or None; the ring is not
+        touched, so `keys` can be tried in an executor
+        """
+        for user, cipher in candidates:
+            decrypt = cipher.make_decrypter(salt)
+            try:
+                return user, cipher, decrypt, decrypt(chunk)
+            except CryptoError:
+                continue
+        return None
+
+    def hit(self, user: str, source=None):
+        "record that ``user`` matched, for ``source`` if given"
+        if user in self.ciphers:  # not removed by an update meanwhile
+            self.ciphers.move_to_end(user, last=False)
+        if source is not None:
+            self.cache[source] = user
+            self.cache.move_to_end(source)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def identify(self, salt: bytes, chunk: bytes, source=None):
+        """
+        return (user, cipher, decrypter, plaintext of the chunk),
+        the decrypter has already consumed the chunk
+        """
+        match = self.trial(salt, chunk, self.candidates(source))
+        if match is None:
+            raise ValueError("no matching key")
+        self.hit(match[0], source)
+        return match
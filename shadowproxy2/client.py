@@ -22,6 +22,8 @@ class Client:
         ctx = ProxyContext(None, self.outbound_ns)
         parser = await ctx.create_client((host, port))
         await parser.init_client((host, port))
+        # the replies of a pipelined handshake, the caller reads payload only
+        await parser.finish_handshake()
         return parser
 
     async def make_httpbin_request(self):
@@ -1,17 +1,50 @@
 from dependency_injector import containers, providers
 
+from . import app
 from .parsers.base import NullParser
-from .throttle import Throttle
+from .pool import ConnectionPool
+from .throttle import Shaper, global_download, global_upload, kbps
 from .urlparser import BoundNamespace
 from .ciphers import ChaCha20IETFPoly1305
-from .parsers import socks5, socks4, aead, http, trojan
+from .users import UserTable
+from .parsers import socks5, socks4, aead, http, trojan, mixed, tunnel
 import asyncio
 
 
+def _user_table(ns):
+    if ns is None:
+        return None
+    users = {}
+    if ns.proxy != "ss" and ns.username is not None and ns.password is not None:
+        users[ns.username] = ns.password
+    if users or ns.users:
+        return UserTable(str(ns.users) if ns.users else None, users)
+
+
+def _tierable(ns):
+    "whether the rates of the inbound may be changed by the tier api"
+    return bool(ns.name and app.settings.tier_api_token)
+
+
+def _ss_kind(ns):
+    if ns.users:
+        return "multi"
+    return "plain" if ns.username is None else "aead"
+
+
 class Container(containers.DeclarativeContainer):
     inbound_ns = providers.Dependency(instance_of=BoundNamespace)
     outbound_ns = providers.Dependency()
     quic_client_lock = providers.Singleton(asyncio.Lock)
+    kcp_client_lock = providers.Singleton(asyncio.Lock)
+    http_pool = providers.Singleton(ConnectionPool)
+    user_table = providers.Singleton(_user_table, inbound_ns)
+    inbound_cipher = providers.Singleton(
+        ChaCha20IETFPoly1305, inbound_ns.provided.password
+    )
+    outbound_cipher = providers.Singleton(
+        ChaCha20IETFPoly1305, outbound_ns.provided.password
+    )
     inbound_parser = providers.Selector(
         providers.Factory(lambda ns: "c1" if ns is None else "c2", inbound_ns),
         c1=providers.Factory(NullParser),
@@ -21,17 +54,14 @@ class Container(containers.DeclarativeContainer):
                 socks5.Socks5Parser,
                 inbound_ns.provided.username,
                 inbound_ns.provided.password,
+                user_table,
             ),
             socks4=providers.Factory(socks4.Socks4Parser),
             ss=providers.Selector(
-                providers.Factory(
-                    lambda ns: "plain" if ns.username is None else "aead", inbound_ns
-                ),
-                aead=providers.Factory(
-                    aead.AEADParser,
-                    providers.Singleton(
-                        ChaCha20IETFPoly1305, inbound_ns.provided.password
-                    ),
+                providers.Factory(_ss_kind, inbound_ns),
+                aead=providers.Factory(aead.AEADParser, inbound_cipher),
+                multi=providers.Factory(
+                    aead.MultiUserAEADParser, user_table.provided.keyring
                 ),
                 plain=providers.Factory(aead.PlainParser),
             ),
@@ -40,12 +70,24 @@ class Container(containers.DeclarativeContainer):
                 http.HTTPParser,
                 inbound_ns.provided.username,
                 inbound_ns.provided.password,
+                user_table,
             ),
             trojan=providers.Factory(
                 trojan.TrojanParser,
                 inbound_ns.provided.username,
                 inbound_ns.provided.password,
+                user_table,
+            ),
+            mixed=providers.Factory(
+                mixed.MixedParser,
+                inbound_ns.provided.username,
+                inbound_ns.provided.password,
+                user_table,
+            ),
+            tunnel=providers.Factory(
+                tunnel.TunnelParser, inbound_ns.provided.target_addr
             ),
+            red=providers.Factory(tunnel.RedirectParser),
         ),
     )
     outbound_parser = providers.Selector(
@@ -57,6 +99,7 @@ class Container(containers.DeclarativeContainer):
                 socks5.Socks5Parser,
                 outbound_ns.provided.username,
                 outbound_ns.provided.password,
+                pipeline=outbound_ns.provided.pipeline,
             ),
             socks4=providers.Factory(socks4.Socks4Parser),
             ss=providers.Selector(
@@ -65,28 +108,49 @@ class Container(containers.DeclarativeContainer):
                 ),
                 aead=providers.Factory(
                     aead.AEADParser,
-                    providers.Singleton(
-                        ChaCha20IETFPoly1305, outbound_ns.provided.password
-                    ),
+                    outbound_cipher,
+                    pipeline=outbound_ns.provided.pipeline,
+                ),
+                plain=providers.Factory(
+                    aead.PlainParser, pipeline=outbound_ns.provided.pipeline
                 ),
-                plain=providers.Factory(aead.PlainParser),
             ),
-            plain=providers.Factory(aead.PlainParser),
+            plain=providers.Factory(
+                aead.PlainParser, pipeline=outbound_ns.provided.pipeline
+            ),
             http=providers.Factory(
                 http.HTTPParser,
                 outbound_ns.provided.username,
                 outbound_ns.provided.password,
+                pipeline=outbound_ns.provided.pipeline,
             ),
             trojan=providers.Factory(
                 trojan.TrojanParser,
                 outbound_ns.provided.username,
                 outbound_ns.provided.password,
+                pipeline=outbound_ns.provided.pipeline,
             ),
         ),
     )
-    upload_throttle = providers.Singleton(
-        lambda ns: Throttle(ns.ul * 1024) if ns else None, inbound_ns
+    upload_shaper = providers.Singleton(
+        lambda ns: Shaper(
+            kbps(ns.total_ul),
+            kbps(ns.ul),
+            kbps(ns.conn_ul),
+            global_upload,
+            burst=kbps(ns.burst) or 0,
+            live=_tierable(ns),
+        ),
+        inbound_ns,
     )
-    download_throttle = providers.Singleton(
-        lambda ns: Throttle(ns.dl * 1024) if ns else None, inbound_ns
+    download_shaper = providers.Singleton(
+        lambda ns: Shaper(
+            kbps(ns.total_dl),
+            kbps(ns.dl),
+            kbps(ns.conn_dl),
+            global_download,
+            burst=kbps(ns.burst) or 0,
+            live=_tierable(ns),
+        ),
+        inbound_ns,
     )
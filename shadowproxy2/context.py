@@ -1,8 +1,13 @@
 import asyncio
 import contextlib
+import functools
+import os
+import socket
 import ssl
+import stat
 import traceback
 from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
 
 import click
 import websockets
@@ -11,9 +16,16 @@ from aioquic.asyncio.protocol import QuicStreamAdapter
 from aioquic.quic.configuration import QuicConfiguration
 
 from . import app
+from .accounting import Accounting, QuotaExceeded
+from .parsers.trojan import TrojanDatagramClient
 from .container import Container
-from .transport.ws import WebsocketReader, WebsocketWriter
-from .utils import is_global
+from .throttle import kbps
+from .transport.h2 import H2Client, H2Connection
+from .transport.kcp import KCPEndpoint
+from .transport.ws import RoutingServerProtocol, WebsocketReader, WebsocketWriter
+from .udp import DatagramMeter, DirectClient, SSClient, SSUDPRelay
+from .urlparser.models import parse_rate
+from .utils import format_addr, is_global
 from .ws_process_request import ws_process_request, concurrent_requests
 
 QuicStreamAdapter.close = lambda self: None
@@ -25,26 +37,65 @@ inbound_addr_var = ContextVar("inbound_addr", default=("", 0))
 outbound_addr_var = ContextVar("outbound_addr", default=("", 0))
 remote_addr_var = ContextVar("remote_addr", default=("", 0))
 target_addr_var = ContextVar("target_addr", default=("", 0))
+named_contexts: Dict[str, "ProxyContext"] = {}
+# (host, port) -> (transport, routes, server) of the ws and wss listeners
+ws_listeners: Dict[Tuple[str, int], tuple] = {}
+
+
+@functools.lru_cache()
+def server_ssl_context(*alpn_protocols):
+    "the certificate is loaded once per worker, whatever the inbounds using it"
+    sslcontext = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    sslcontext.load_cert_chain(str(app.settings.cert_chain), str(app.settings.key_file))
+    if alpn_protocols:
+        sslcontext.set_alpn_protocols(list(alpn_protocols))
+    return sslcontext
+
+
+def unlink_stale_socket(path: str):
+    "remove a socket file left by a previous run, refuse one still listened on"
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return  # binding fails on anything else, as it should
+    except FileNotFoundError:
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(1)
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:  # nobody listens any more
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+            return
+        except OSError:
+            pass  # a full backlog for example
+    raise Exception(f"{path} is in use by another process")
+
+
+async def route_ws(ws, path):
+    await ws.ctx.ws_handler(ws, path)
 
 
 class ProxyContext:
     stack: contextlib.AsyncExitStack
+    accounting: Optional[Accounting] = None
 
     def __init__(self, inbound_ns, outbound_ns):
         self.container = Container(inbound_ns=inbound_ns, outbound_ns=outbound_ns)
         self.inbound_ns = inbound_ns
         self.outbound_ns = outbound_ns
         self.quic_outbound = None
+        self.kcp_outbound = None
+        self.h2_outbound = None
+        if inbound_ns is not None and inbound_ns.name:
+            named_contexts[inbound_ns.name] = self
 
     async def create_server(self):
         return await getattr(self, f"create_{self.inbound_ns.transport}_server")()
 
     async def create_tcp_server(self):
         if self.inbound_ns.transport == "tls":
-            sslcontext = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-            sslcontext.load_cert_chain(
-                str(app.settings.cert_chain), str(app.settings.key_file)
-            )
+            sslcontext = server_ssl_context()
         else:
             sslcontext = None
         server = await asyncio.start_server(
@@ -58,6 +109,26 @@ class ProxyContext:
 
     create_tls_server = create_tcp_server
 
+    async def create_unix_server(self):
+        path = self.inbound_ns.path
+        unlink_stale_socket(path)
+        server = await asyncio.start_unix_server(self.tcp_handler, path)
+        server = await self.stack.enter_async_context(server)
+        if self.inbound_ns.mode is not None:
+            os.chmod(path, self.inbound_ns.mode)
+        bound = os.stat(path)
+        inode = bound.st_ino, bound.st_ctime_ns  # inode numbers get reused
+
+        def unlink():
+            "remove the socket file, unless another process has bound it since"
+            with contextlib.suppress(FileNotFoundError):
+                current = os.stat(path)
+                if (current.st_ino, current.st_ctime_ns) == inode:
+                    os.unlink(path)
+
+        self.stack.callback(unlink)
+        return server
+
     async def tcp_handler(self, reader, writer):
         parser = None
         try:
@@ -66,8 +137,8 @@ class ProxyContext:
             parser = self.container.inbound_parser()
             parser.set_rw(reader, writer)
             remote_parser = await parser.server(self)
-            self.create_task(parser.relay(remote_parser))
-            self.create_task(remote_parser.relay(parser))
+            if remote_parser is not None:  # None if served by the parser itself
+                self.start_relay(parser, remote_parser)
         except Exception as e:
             if app.settings.verbose > 0:
                 click.secho(f"{self.get_route()} {e}", fg="yellow")
@@ -76,6 +147,31 @@ class ProxyContext:
             if parser:
                 await parser.close()
 
+    async def connect_remote(self, parser, target_addr):
+        """
+        connect to ``target_addr`` and send the success reply of the inbound;
+        with fast open the reply goes first, the client's first payload waits
+        in the reader while the outbound connects, and a failed connect just
+        closes the connection
+        """
+        self.check_quota(parser.user)
+        if app.settings.fast_open:
+            await parser._write(parser.server_reply())
+            remote_parser = await self.create_client(target_addr)
+        else:
+            remote_parser = await self.create_client(target_addr)
+            await parser._write(parser.server_reply())
+        await remote_parser.init_client(target_addr)
+        return remote_parser
+
+    def start_relay(self, parser, remote_parser):
+        self.start_accounting(parser, remote_parser)
+        self.set_throttles(parser, remote_parser)
+        return (
+            self.create_task(parser.relay(remote_parser)),
+            self.create_task(remote_parser.relay(parser)),
+        )
+
     async def ws_handler(self, ws, path):
         concurrent_requests.inc()
         try:
@@ -87,9 +183,8 @@ class ProxyContext:
                 WebsocketWriter(ws),
             )
             remote_parser = await parser.server(self)
-            task1 = self.create_task(parser.relay(remote_parser))
-            task2 = self.create_task(remote_parser.relay(parser))
-            await asyncio.wait([task1, task2])
+            if remote_parser is not None:
+                await asyncio.wait(self.start_relay(parser, remote_parser))
         except Exception as e:
             if app.settings.verbose > 0:
                 click.secho(f"{self.get_route()} {e}", fg="yellow")
@@ -97,28 +192,32 @@ class ProxyContext:
             concurrent_requests.dec()
 
     async def create_ws_server(self):
-        if self.inbound_ns.transport == "wss":
-            sslcontext = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-            sslcontext.load_cert_chain(
-                str(app.settings.cert_chain), str(app.settings.key_file)
-            )
-        else:
-            sslcontext = None
-
-        create_protocol = None
-        if self.inbound_ns.credentials:
-            create_protocol = websockets.basic_auth_protocol_factory(
-                realm="realm", credentials=self.inbound_ns.credentials
-            )
+        "inbounds on the same ws or wss port share one listener, routed by path"
+        ns = self.inbound_ns
+        key = (ns.host, ns.port)
+        if ns.port and key in ws_listeners:
+            transport, routes, server = ws_listeners[key]
+            if transport != ns.transport:
+                raise Exception(f"{ns.host}:{ns.port} is already a {transport} port")
+            if ns.path in routes:
+                raise Exception(f"path {ns.path} of {ns.host}:{ns.port} is taken")
+            routes[ns.path] = self
+            return server
+        routes = {ns.path: self}
         server = websockets.serve(
-            self.ws_handler,
-            self.inbound_ns.host,
-            self.inbound_ns.port,
-            ssl=sslcontext,
+            route_ws,
+            ns.host,
+            ns.port,
+            ssl=server_ssl_context() if ns.transport == "wss" else None,
             process_request=ws_process_request,
-            create_protocol=create_protocol,
+            create_protocol=functools.partial(RoutingServerProtocol, routes=routes),
+            compression="deflate",  # if the routed inbound wants it
         )
-        return await self.stack.enter_async_context(server)
+        server = await self.stack.enter_async_context(server)
+        if ns.port:
+            ws_listeners[key] = (ns.transport, routes, server)
+            self.stack.callback(ws_listeners.pop, key, None)
+        return server
 
     create_wss_server = create_ws_server
 
@@ -135,11 +234,60 @@ class ProxyContext:
             stream_handler=lambda r, w: self.create_task(self.tcp_handler(r, w)),
         )
 
+    async def create_kcp_server(self):
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: KCPEndpoint(
+                self.inbound_ns.kcp_options,
+                on_stream=lambda r, w: self.create_task(self.tcp_handler(r, w)),
+            ),
+            local_addr=(self.inbound_ns.host, self.inbound_ns.port),
+            reuse_port=True,
+        )
+        self.stack.callback(transport.close)
+        return transport
+
+    async def create_h2_server(self):
+        "extended CONNECT streams (RFC 8441) over long-lived TLS connections"
+        sslcontext = server_ssl_context("h2")
+        authorization = None
+        if self.inbound_ns.credentials:
+            authorization = self.inbound_ns.basic_auth_header[0][1].encode()
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(
+            lambda: H2Connection(
+                client_side=False,
+                on_stream=lambda r, w: self.create_task(self.tcp_handler(r, w)),
+                path=self.inbound_ns.path,
+                authorization=authorization,
+            ),
+            self.inbound_ns.host,
+            self.inbound_ns.port,
+            reuse_port=True,
+            ssl=sslcontext,
+        )
+        return await self.stack.enter_async_context(server)
+
+    async def create_udp_server(self):
+        "the shadowsocks udp relay, listening next to an ss tcp inbound is fine"
+        if self.inbound_ns.proxy != "ss" or self.inbound_ns.username is None:
+            raise Exception("udp inbound supports ss with a cipher only")
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: SSUDPRelay(
+                self.container.inbound_cipher(),
+                self.datagram_client_factory(),
+                create_meter=lambda addr: self.create_meter(None, addr[0]),
+            ),
+            local_addr=(self.inbound_ns.host, self.inbound_ns.port),
+            reuse_port=True,
+        )
+        self.stack.callback(transport.close)
+        return transport
+
     async def create_client(self, target_addr):
         target_addr_var.set(target_addr)
-        if app.settings.block_internal_ips and not is_global(target_addr[0]):
-            raise Exception(f"{target_addr[0]} is blocked")
-        if target_addr[0] in app.settings.blacklist:
+        if not self.is_allowed(target_addr[0]):
             raise Exception(f"{target_addr[0]} is blocked")
         if self.outbound_ns is None:
             transport = "tcp"
@@ -156,6 +304,88 @@ class ProxyContext:
             print(self.get_route())
         return parser
 
+    def is_allowed(self, host):
+        if app.settings.block_internal_ips and not is_global(host):
+            return False
+        return host not in app.settings.blacklist
+
+    def datagram_client_factory(self):
+        """
+        udp counterpart of `create_client`, returns a callable creating a
+        client that sends datagrams to any target and hands the ones coming
+        back to its ``on_received(data, addr)``
+        """
+        ns = self.outbound_ns
+        if ns is None:
+            return lambda on_received: DirectClient(on_received, self.is_allowed).open()
+        if ns.proxy == "ss" and ns.username and ns.transport in ("tcp", "udp"):
+            # shadowsocks servers take udp on the port of their tcp relay
+            cipher = self.container.outbound_cipher()
+            server_addr = (ns.host, ns.port)
+            return lambda on_received: SSClient(on_received, cipher, server_addr).open()
+        if ns.proxy == "trojan":
+            # framed over one trojan UDP ASSOCIATE stream per client
+            return lambda on_received: TrojanDatagramClient(
+                on_received, self.create_client
+            ).open()
+        raise Exception(f"no udp support for {ns.transport}+{ns.proxy} outbound")
+
+    def reload(self):
+        "reload the user table of the inbound"
+        table = self.container.user_table()
+        if table is not None:
+            table.reload()
+
+    @property
+    def inbound_name(self):
+        ns = self.inbound_ns
+        return ns.name or f"{ns.transport}+{ns.proxy}://{ns.address}"
+
+    def start_accounting(self, parser, remote_parser):
+        if self.accounting is None:
+            return
+        try:
+            self.accounting.start(
+                self.inbound_name, parser.user or "", parser, remote_parser
+            )
+        except QuotaExceeded:
+            self.create_task(remote_parser.close())
+            raise
+
+    def set_throttles(self, parser, remote_parser):
+        "an inbound parser keeps its throttle over the requests it forwards"
+        source = source_addr_var.get()
+        user = parser.user or (source[0] if isinstance(source, tuple) else "unix")
+        if parser.throttle is None:
+            parser.set_throttle(self.container.upload_shaper().connection(user))
+        remote_parser.set_throttle(self.container.download_shaper().connection(user))
+
+    def check_quota(self, user):
+        if self.accounting is not None:
+            self.accounting.check(user or "")
+
+    def create_meter(self, user, source_host: str) -> DatagramMeter:
+        """
+        the counters and throttles of a udp session of ``user``, shaped per
+        source host without a user; raise QuotaExceeded if over quota
+        """
+        meter = DatagramMeter()
+        if self.accounting is not None:
+            self.accounting.start_meter(self.inbound_name, user or "", meter)
+        key = user or source_host
+        meter.upload_throttle = self.container.upload_shaper().connection(key)
+        meter.download_throttle = self.container.download_shaper().connection(key)
+        return meter
+
+    def set_tier(self, ul=None, dl=None):
+        "change per user rates(KB/s or tier name) of live connections"
+        if ul is not None:
+            rate = kbps(parse_rate(ul))
+            self.container.upload_shaper().update_rates(user_rate=rate)
+        if dl is not None:
+            rate = kbps(parse_rate(dl))
+            self.container.download_shaper().update_rates(user_rate=rate)
+
     @staticmethod
     def get_route():
         s = source_addr_var.get() or ("", 0)
@@ -164,8 +394,8 @@ class ProxyContext:
         r = remote_addr_var.get() or ("", 0)
         t = target_addr_var.get() or ("", 0)
         return (
-            f"{s[0]}:{s[1]} -> {i[0]}:{i[1]} -> "
-            f"{o[0]}:{o[1]} -> {r[0]}:{r[1]}({t[0]}:{t[1]})"
+            f"{format_addr(s)} -> {format_addr(i)} -> "
+            f"{format_addr(o)} -> {format_addr(r)}({format_addr(t)})"
         )
 
     async def create_tcp_client(self, target_addr):
@@ -196,6 +426,12 @@ class ProxyContext:
 
     create_tls_client = create_tcp_client
 
+    async def create_unix_client(self, target_addr):
+        return await asyncio.open_unix_connection(self.outbound_ns.path)
+
+    async def create_udp_client(self, target_addr):
+        raise Exception("a udp outbound only relays datagrams")
+
     async def create_ws_client(self, target_addr):
         transport = self.outbound_ns.transport
         host = self.outbound_ns.host
@@ -216,6 +452,7 @@ class ProxyContext:
                     uri,
                     ssl=sslcontext,
                     extra_headers=self.outbound_ns.basic_auth_header,
+                    compression="deflate" if self.outbound_ns.deflate else None,
                 )
             except OSError as e:
                 if app.settings.verbose > 1:
@@ -250,6 +487,43 @@ class ProxyContext:
                 await self.quic_outbound.wait_connected()
             return await self.quic_outbound.create_stream()
 
+    async def create_kcp_client(self, target_addr):
+        "kcp sessions to the outbound share one udp socket, like quic streams"
+        async with self.container.kcp_client_lock():
+            if self.kcp_outbound is None or self.kcp_outbound.transport.is_closing():
+                loop = asyncio.get_running_loop()
+                infos = await loop.getaddrinfo(
+                    self.outbound_ns.host, self.outbound_ns.port, type=socket.SOCK_DGRAM
+                )
+                family, *_, server_addr = infos[0]
+                transport, self.kcp_outbound = await loop.create_datagram_endpoint(
+                    lambda: KCPEndpoint(
+                        self.outbound_ns.kcp_options, remote_addr=server_addr[:2]
+                    ),
+                    family=family,
+                    local_addr=("::" if family == socket.AF_INET6 else "0.0.0.0", 0),
+                )
+                self.stack.callback(transport.close)
+        return self.kcp_outbound.open_stream()
+
+    async def create_h2_client(self, target_addr):
+        "streams to the outbound share a few h2 connections, like quic streams"
+        if self.h2_outbound is None:
+            sslcontext = ssl.create_default_context()
+            if not self.outbound_ns.verify_ssl:
+                sslcontext.check_hostname = False
+                sslcontext.verify_mode = ssl.CERT_NONE
+            sslcontext.set_alpn_protocols(["h2"])
+            self.h2_outbound = H2Client(
+                (self.outbound_ns.host, self.outbound_ns.port),
+                sslcontext,
+                path=self.outbound_ns.path or "/",
+                headers=self.outbound_ns.basic_auth_header or (),
+            )
+            self.stack.callback(self.h2_outbound.close)
+        stream = await self.h2_outbound.open_stream()
+        return stream.reader, stream
+
     def task_callback(self, task):
         try:
             exc = task.exception()
@@ -16,6 +16,14 @@ def read(nbytes: int = 0) -> Generator[tuple, bytes, bytes]:
     return (yield (Traps._read, nbytes))
 
 
+def read_view(nbytes: int = 0) -> Generator[tuple, memoryview, memoryview]:
+    """
+    like `read`, but return a memoryview of the buffer instead of a copy,
+    the view is only valid until more data is received
+    """
+    return (yield (Traps._read_view, nbytes))
+
+
 def read_more(nbytes: int = 1) -> Generator[tuple, bytes, bytes]:
     """
     read *at least* ``nbytes``
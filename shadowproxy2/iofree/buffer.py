@@ -128,7 +128,11 @@ class Buffer(Sized):
         self.head = self.head + nbytes
 
     def scale_up(self, nbytes: int) -> None:
-        self.buf.extend(b"\x00" * nbytes)
+        # a new bytearray instead of extending in place, views returned by
+        # `pull_view` keep pointing at the old one
+        buf = bytearray(self.size + nbytes)
+        buf[: self.head] = memoryview(self.buf)[: self.head]
+        self.buf = buf
         self.size += nbytes
 
     def push_struct(self, struct_obj, *args) -> None:
@@ -155,18 +159,59 @@ class Buffer(Sized):
         if nbytes < 0:
             raise ValueError("nbytes must >= 0")
         if nbytes == 0:
-            res = b"" + self.buf[self.tail : self.head]
+            res = bytes(memoryview(self.buf)[self.tail : self.head])
             self.head = self.tail = 0
             return res
-        if self.data_size < nbytes:
+        if self.head - self.tail < nbytes:
+            raise StarvingException
+        start = self.tail
+        self.tail += nbytes
+        res = bytes(memoryview(self.buf)[start : self.tail])
+        if self.head == self.tail:
+            self.head = self.tail = 0
+        return res
+
+    def pull_view(self, nbytes: int = 0) -> memoryview:
+        """
+        like `pull`, but return a memoryview instead of a copy, the data
+        it points to may be overwritten by the next push
+
+        >>> buffer = Buffer(8)
+        >>> buffer.push(b"abcdef")
+        >>> view = buffer.pull_view(4)
+        >>> bytes(view), buffer.data_size
+        (b'abcd', 2)
+        >>> buffer.push(b"0123456789")  # grows, the view stays valid
+        >>> bytes(view), bytes(buffer.pull_view())
+        (b'abcd', b'ef0123456789')
+        """
+        if nbytes < 0:
+            raise ValueError("nbytes must >= 0")
+        if nbytes == 0:
+            res = memoryview(self.buf)[self.tail : self.head]
+            self.head = self.tail = 0
+            return res
+        if self.head - self.tail < nbytes:
             raise StarvingException
         start = self.tail
         self.tail += nbytes
-        res = b"" + self.buf[start : self.tail]
+        res = memoryview(self.buf)[start : self.tail]
         if self.head == self.tail:
             self.head = self.tail = 0
         return res
 
+    def view(self) -> memoryview:
+        "unread data without copying, must be released before the next push"
+        return memoryview(self.buf)[self.tail : self.head]
+
+    def skip(self, nbytes: int) -> None:
+        "drop ``nbytes`` of unread data"
+        if self.data_size < nbytes:
+            raise StarvingException
+        self.tail += nbytes
+        if self.head == self.tail:
+            self.head = self.tail = 0
+
     def pull_amap(self, least_nbytes: int = 1):
         """
         pull as much as possible, at least nbytes
@@ -185,13 +230,17 @@ class Buffer(Sized):
         return self.buf[self.tail : self.tail + nbytes]
 
     def pull_int(self, nbytes: int, byteorder: str, signed: bool):
-        return int.from_bytes(self.pull(nbytes), byteorder, signed=signed)
+        return int.from_bytes(self.pull_view(nbytes), byteorder, signed=signed)
 
     def pull_struct(self, struct_obj):
         size: int = struct_obj.size
-        if self.data_size < size:
+        if self.head - self.tail < size:
             raise StarvingException
-        return struct_obj.unpack(self.pull(size))
+        res = struct_obj.unpack_from(self.buf, self.tail)
+        self.tail += size
+        if self.head == self.tail:
+            self.head = self.tail = 0
+        return res
 
     def pull_until(self, bytes_like, *, init_pos: int = -1, return_tail: bool = True):
         length: int = len(bytes_like)
@@ -208,6 +257,6 @@ class Buffer(Sized):
         start = self.tail
         self.tail = index + length
         if return_tail:
-            return b"" + self.buf[start : self.tail]
+            return bytes(memoryview(self.buf)[start : self.tail])
         else:
-            return b"" + self.buf[start:index]
+            return bytes(memoryview(self.buf)[start:index])
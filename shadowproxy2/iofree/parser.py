@@ -27,6 +27,7 @@ class Traps(IntEnum):
     _peek = auto()
     _wait_event = auto()
     _get_parser = auto()
+    _read_view = auto()
 
 
 class State(IntEnum):
@@ -36,6 +37,20 @@ class State(IntEnum):
 
 
 class Parser:
+    _handlers: tuple = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._build_handlers()
+
+    @classmethod
+    def _build_handlers(cls):
+        "dispatch table of trap handlers, indexed by `Traps` values"
+        handlers = [None] * (max(Traps) + 1)
+        for trap in Traps:
+            handlers[trap] = getattr(cls, trap.name)
+        cls._handlers = tuple(handlers)
+
     def __init__(self, gen: Generator, buffer: Buffer = None):
         self.gen = gen
         self.buffer = buffer or Buffer()
@@ -105,35 +120,31 @@ class Parser:
         if self._state is State._state_end:
             return
         self._state = State._state_next
-        while self._state is State._state_next:
-            self._next_state()
-
-    def _next_state(self) -> None:
-        if self._last_trap is None:
-            try:
-                trap, *args = self.gen.send(self._next_value)
-            except StopIteration as e:
-                self._state = State._state_end
-                self.set_result(e.value)
-                return
-            except Exception:
-                self._state = State._state_end
-                tb = sys.exc_info()[2]
-                raise ParseError(f"{self._next_value!r}").with_traceback(tb)
-            else:
-                if not isinstance(trap, Traps):
+        handlers = self._handlers
+        send = self.gen.send
+        trap, self._last_trap = self._last_trap, None
+        value = self._next_value
+        while True:
+            if trap is None:
+                try:
+                    trap = send(value)
+                except StopIteration as e:
+                    self._state = State._state_end
+                    self.set_result(e.value)
+                    return
+                except Exception:
+                    self._state = State._state_end
+                    tb = sys.exc_info()[2]
+                    raise ParseError(f"{value!r}").with_traceback(tb)
+                if trap[0].__class__ is not Traps:
                     self._state = State._state_end
-                    raise RuntimeError(f"Expect Traps object, but got: {trap}")
-        else:
-            trap, *args = self._last_trap
-        result = getattr(self, trap.name)(*args)
-        if result is _wait:
-            self._state = State._state_wait
-            self._last_trap = (trap, *args)
-        else:
-            self._state = State._state_next
-            self._next_value = result
-            self._last_trap = None
+                    raise RuntimeError(f"Expect Traps object, but got: {trap[0]}")
+            value = handlers[trap[0]](self, *trap[1:])
+            if value is _wait:
+                self._state = State._state_wait
+                self._last_trap = trap
+                return
+            trap = None
 
     def readall(self) -> bytes:
         """
@@ -167,6 +178,12 @@ class Parser:
         except StarvingException:
             return _wait
 
+    def _read_view(self, nbytes: int = 0) -> Union[memoryview, object]:
+        try:
+            return self.buffer.pull_view(nbytes)
+        except StarvingException:
+            return _wait
+
     def _read_more(self, nbytes: int = 1) -> Union[bytes, object]:
         try:
             return self.buffer.pull_amap(nbytes)
@@ -231,3 +248,6 @@ class AsyncioParser(Parser):
 
     def close(self):
         self.transport.close()
+
+
+Parser._build_handlers()
@@ -1,15 +1,24 @@
+import asyncio
 import types
+from functools import partial
+from itertools import islice
 
 import click
 
+from .. import iofree
+from ..aiobuffer.buffer import StarvingException
 from ..aiobuffer.socks5 import Addr
-from .base import NullParser
+from .base import NullParser, read_schema
 
 
 class AEADParser(NullParser):
-    def __init__(self, cipher):
+    _pending = None  # a future the reader waits for before taking more data
+
+    def __init__(self, cipher, pipeline: bool = False):
         self.cipher = cipher
+        self.pipeline = pipeline
         self._cipher_buf = bytearray()
+        self._plaintext = b""  # left over by the sans-IO handshake
         self._reader = self._create_reader()
 
     def set_rw(self, reader, writer, throttle=None):
@@ -30,8 +39,12 @@ class AEADParser(NullParser):
 
         self.reader.origin_feed_data = self.reader.feed_data
         self.reader.feed_data = types.MethodType(_feed_data, self.reader)
-        if self.reader._buffer:
-            self.reader._buffer, _buffer = bytearray(), self.reader._buffer
+        self.reader.direct = False  # a websocket message must be decrypted
+        self.reader._buffer, _buffer = bytearray(), self.reader._buffer
+        if self._plaintext:
+            self.reader.origin_feed_data(self._plaintext)
+            self._plaintext = b""
+        if _buffer:
             self.reader.feed_data(_buffer)
 
     def _pull_ciphertext(self, nbytes):
@@ -44,43 +57,138 @@ class AEADParser(NullParser):
     def _create_reader(self):
         salt = yield from self._pull_ciphertext(self.cipher.SALT_SIZE)
         decrypt = self.cipher.make_decrypter(salt)
+        yield from self._read_chunks(decrypt)
+
+    def _read_chunks(self, decrypt, length_bytes=None):
         while True:
-            chunk0 = yield from self._pull_ciphertext(2 + self.cipher.TAG_SIZE)
-            length_bytes = decrypt(chunk0)
+            if length_bytes is None:
+                chunk0 = yield from self._pull_ciphertext(2 + self.cipher.TAG_SIZE)
+                length_bytes = decrypt(chunk0)
             length = int.from_bytes(length_bytes, "big")
             if length != length & 0x3FFF:  # 16 * 1024 - 1
                 raise Exception("exceed the length limit")
             chunk1 = yield from self._pull_ciphertext(length + self.cipher.TAG_SIZE)
+            length_bytes = None
             yield decrypt(chunk1)
 
     async def server(self, ctx):
         addr = await self.reader.pull(Addr)
         target_addr = (addr.host, addr.port)
+        ctx.check_quota(self.user)
         remote_parser = await ctx.create_client(target_addr)
-        packet, self.encrypt = self.cipher.make_encrypter()
-        await self._write(packet)
+        await self._write(self.server_reply())
         await remote_parser.init_client(target_addr)
         return remote_parser
 
+    def server_handshake(self):
+        engine = yield from iofree.get_parser()
+        self._wakeup = engine.wakeup
+        plaintext = bytearray()
+        while True:
+            if self._pending is None:
+                self._cipher_buf.extend((yield from iofree.read_more()))
+            else:  # data waits in the engine till the reader can take it
+                yield from iofree.wait()
+            for chunk in iter(partial(self._reader.send, None), None):
+                plaintext.extend(chunk)
+            try:
+                addr, offset = Addr.parse_from(plaintext)
+            except StarvingException:
+                continue
+            self._plaintext = bytes(plaintext[offset:])
+            return addr.host, addr.port
+
+    def server_reply(self):
+        packet, self.encrypt = self.cipher.make_encrypter()
+        return packet
+
     async def write(self, data):
         packet = self.encrypt(data)
         await self._write(packet)
 
     async def init_client(self, target_addr):
         packet, self.encrypt = self.cipher.make_encrypter()
-        await self._write(packet)
-        addr = Addr.from_tuple(target_addr)
-        await self.write(addr.binary)
+        packet += self.encrypt(Addr.from_tuple(target_addr).binary)
+        if self.pipeline:
+            self.hold(packet)
+        else:
+            await self._write(packet)
+
+
+class MultiUserAEADParser(AEADParser):
+    def __init__(self, keyring):
+        self.keyring = keyring
+        super().__init__(None)
+
+    def connection_made(self, transport):
+        peername = transport.get_extra_info("peername")
+        self.source = peername[0] if peername else None
+
+    def set_rw(self, reader, writer, throttle=None):
+        self.connection_made(writer)
+        super().set_rw(reader, writer, throttle)
+        feed_eof = self.reader.feed_eof
+
+        def _feed_eof():
+            "an eof waits for the key, the data before it is fed first"
+            if self._pending is None:
+                feed_eof()
+            else:
+                self._pending.add_done_callback(lambda _: feed_eof())
+
+        self.reader.feed_eof = _feed_eof
+
+    def _wakeup(self):
+        "feed nothing to resume the reader"
+        if not self.reader._eof:
+            self.reader.feed_data(b"")
+
+    def _create_reader(self):
+        """
+        the hot keys are tried right away, all of them after a miss in an
+        executor, so a connection with an unknown key can't stall the loop
+        """
+        keyring = self.keyring
+        salt = yield from self._pull_ciphertext(keyring.SALT_SIZE)
+        chunk0 = yield from self._pull_ciphertext(2 + keyring.TAG_SIZE)
+        hot = islice(keyring.candidates(self.source), keyring.HOT_KEYS)
+        match = keyring.trial(salt, chunk0, hot)
+        if match is None and len(keyring.keys) > keyring.HOT_KEYS:
+            # keys is never mutated, unlike the hit order of ciphers
+            self._pending = asyncio.get_running_loop().run_in_executor(
+                None, keyring.trial, salt, chunk0, keyring.keys
+            )
+            self._pending.add_done_callback(lambda _: self._wakeup())
+            while not self._pending.done():
+                yield
+            match = self._pending.result()
+            self._pending = None
+        if match is None:
+            raise ValueError("no matching key")
+        keyring.hit(match[0], self.source)
+        self.user, self.cipher, decrypt, length_bytes = match
+        yield from self._read_chunks(decrypt, length_bytes)
 
 
 class PlainParser(NullParser):
+    def __init__(self, pipeline: bool = False):
+        self.pipeline = pipeline
+
     async def server(self, ctx):
         addr = await self.reader.pull(Addr)
         target_addr = (addr.host, addr.port)
+        ctx.check_quota(self.user)
         remote_parser = await ctx.create_client(target_addr)
         await remote_parser.init_client(target_addr)
         return remote_parser
 
+    def server_handshake(self):
+        addr = yield from read_schema(Addr)
+        return addr.host, addr.port
+
     async def init_client(self, target_addr):
-        addr = Addr.from_tuple(target_addr)
-        await self.write(addr.binary)
+        addr = Addr.from_tuple(target_addr).binary
+        if self.pipeline:
+            self.hold(addr)
+        else:
+            await self.write(addr)
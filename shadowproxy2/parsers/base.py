@@ -1,20 +1,59 @@
 import asyncio
 from inspect import isawaitable
 
-from ..aiobuffer.buffer import create_buffer
+from .. import iofree
+from ..aiobuffer.buffer import StarvingException, create_buffer
+
+PIPELINE_DELAY = 0.05  # seconds a held header waits for the first payload
+
+
+def read_schema(obj):
+    """
+    iofree generator to parse an aiobuffer unit or schema straight from the
+    buffer of the running iofree parser
+    """
+    buffer = (yield from iofree.get_parser()).buffer
+    while True:
+        if buffer.data_size:
+            try:
+                value, offset = obj.parse_from(buffer.view())
+            except StarvingException:
+                pass  # not waiting here, the traceback would keep the view alive
+            else:
+                buffer.skip(offset)
+                return value
+        yield from iofree.wait()
 
 
 class NullParser:
+    user = None
+    throttle = None
+    counter = None
+    pipeline = False
+    held = b""  # sent in front of the first payload, see `hold`
+    pending_reply = None  # replies of a pipelined handshake, not read yet
+
     def set_rw(self, reader, writer, throttle=None):
         self.reader = create_buffer(reader)
         self.writer = writer
+        self.read_func = self.reader.read
+        self.set_throttle(throttle)
+
+    def set_throttle(self, throttle):
+        if self.throttle is not None:  # replaced, e.g. on a pooled connection
+            self.throttle.close()
+            self.throttle = None
+            self.read_func = self.reader.read
         if throttle:
             self._event = asyncio.Event()
             self._event.set()
             self.throttle = throttle
             self.read_func = self.read
-        else:
-            self.read_func = self.reader.read
+
+    def is_reusable(self) -> bool:
+        "whether an idle connection can carry another request"
+        reader = self.reader
+        return not (self.writer.is_closing() or reader._eof or reader._buffer)
 
     def __repr__(self):
         s = super().__repr__()
@@ -26,19 +65,53 @@ class NullParser:
         self.throttle.consume(len(data), self._event)
         return data
 
+    def server_reply(self) -> bytes:
+        "bytes to send to the client once the remote connection is made"
+        return b""
+
     async def init_client(self, target_addr):
         return
 
+    def hold(self, data: bytes):
+        """
+        send ``data`` together with the first payload to save a round trip,
+        or alone after `PIPELINE_DELAY` for protocols whose server speaks first
+        """
+        self.held = data
+        loop = asyncio.get_running_loop()
+        self._held_handle = loop.call_later(PIPELINE_DELAY, self._flush_held)
+
+    def _flush_held(self):
+        if not self.held:
+            return
+        self._held_handle.cancel()
+        data, self.held = self.held, b""
+        if not self.writer.is_closing():
+            r = self.writer.write(data)
+            if isawaitable(r):
+                asyncio.ensure_future(r)
+
+    async def finish_handshake(self):
+        "read the replies of a pipelined `init_client`, raise if it failed"
+        if self.pending_reply is not None:
+            pending, self.pending_reply = self.pending_reply, None
+            await pending
+
     async def relay(self, output_parser):
+        counter = self.counter
         try:
+            await self.finish_handshake()
             while True:
                 try:
                     data = await self.read_func(4096)
                 except Exception:
                     data = None
                 if data:
+                    if counter is not None:
+                        counter.nbytes += len(data)
                     await output_parser.write(data)
                     continue
+                output_parser._flush_held()
                 if (
                     output_parser.writer.can_write_eof()
                     and not output_parser.writer.is_closing()
@@ -53,6 +126,9 @@ class NullParser:
         return await self._write(data, drain=True)
 
     async def _write(self, data, drain=False):
+        if self.held:
+            data, self.held = self.held + data, b""
+            self._held_handle.cancel()
         r = self.writer.write(data)
         if isawaitable(r):
             return await r
@@ -61,6 +137,11 @@ class NullParser:
         return r
 
     async def close(self):
+        if self.throttle:
+            self.throttle.close()
+        if self.pending_reply is not None:
+            self.pending_reply.close()
+            self.pending_reply = None
         if self.writer.is_closing():
             return
         r = self.writer.close()
@@ -1,53 +1,271 @@
+import asyncio
 import base64
 import re
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Tuple
 from urllib.parse import urlparse
 
+from .. import iofree
 from ..aiobuffer import buffer as schema
-from .base import NullParser
+from ..aiobuffer.buffer import StarvingException
+from .base import NullParser, read_schema
 
 HTTP_LINE = re.compile(b"([^ ]+) +(.+?) +(HTTP/[^ ]+)")
-ABSOLUTE_PREFIX = re.compile(r"^(.*://)?[^/]*")
+CHUNK_SIZE = re.compile(rb"[0-9a-fA-F]{1,16}")
+ABSOLUTE_PREFIX = re.compile(rb"^([a-zA-Z][a-zA-Z0-9+.-]*://)?[^/?]*")
+SPACE_BEFORE_COLON = re.compile(rb"\n[^:\r\n]*[ \t]:")  # in a header name
+HEAD_END = re.compile(b"\r\n\r\n")  # unlike find, searches memoryviews in place
+# headers of one hop, not forwarded; expect is answered by the proxy itself
+HOP_BY_HOP = {
+    b"connection",
+    b"keep-alive",
+    b"proxy-connection",
+    b"proxy-authorization",
+    b"proxy-authenticate",
+    b"te",
+    b"trailer",
+    b"upgrade",
+    b"expect",
+}
+CHUNKED = -1
+COPY_SIZE = 65536
+MAX_HEAD_SIZE = 16384
+MAX_HEADERS = 100
 
 
 class ProtocolError(Exception):
     ...
 
 
+@lru_cache(maxsize=64)
+def header_pattern(name: bytes) -> re.Pattern:
+    "matches a ``name`` header line in any case, its value is group 1"
+    return re.compile(rb"\r\n" + re.escape(name) + rb":([^\r\n]*)", re.IGNORECASE)
+
+
+class Headers:
+    r"""
+    case insensitive header lookup over the raw bytes of a head, searched in
+    place without a lowercase copy
+
+    >>> headers = Headers(b"GET / HTTP/1.1\r\nHost: a.com\r\nX-A:1\r\nx-a: 2", 16)
+    >>> headers[b"host"], headers.get(b"X-A"), headers.get_all(b"x-a")
+    (b'a.com', b'1', [b'1', b'2'])
+    >>> b"Content-Length" in headers, list(headers.items())[1]
+    (False, (b'X-A', b'1'))
+    """
+
+    __slots__ = ("head", "start")
+
+    def __init__(self, head: bytes, start: int):
+        self.head = head
+        self.start = start  # offset of the first header line
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({dict(self.items())!r})"
+
+    def items(self) -> Iterator[Tuple[bytes, bytes]]:
+        "(name, value) of every header line, names keep their case"
+        head = self.head
+        pos, end = self.start, len(head)
+        while pos < end:
+            eol = head.find(b"\r\n", pos)
+            if eol == -1:
+                eol = end
+            colon = head.find(b":", pos, eol)
+            if colon != -1:
+                yield head[pos:colon].strip(), head[colon + 1 : eol].strip()
+            pos = eol + 2
+
+    def get_all(self, name: bytes) -> List[bytes]:
+        matches = header_pattern(name).finditer(self.head, self.start - 2)
+        return [match.group(1).strip() for match in matches]
+
+    def get(self, name: bytes, default=None):
+        match = header_pattern(name).search(self.head, self.start - 2)
+        if match is None:
+            return default
+        return match.group(1).strip()
+
+    def __getitem__(self, name: bytes) -> bytes:
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name: bytes) -> bool:
+        return header_pattern(name).search(self.head, self.start - 2) is not None
+
+
+class HTTPHead(schema.Unit):
+    r"""
+    the head of a request or response without the blank line, bounded by
+    ``max_size`` bytes and ``max_headers`` header lines; it is found and
+    counted in place, the only copy made is the returned bytes
+
+    >>> HTTPHead().parse_from(b"GET / HTTP/1.1\r\nHost:a\r\n\r\nbody")
+    (b'GET / HTTP/1.1\r\nHost:a', 26)
+    >>> HTTPHead().parse_from(memoryview(b"..GET / HTTP/1.1\r\n\r\n"), 2)
+    (b'GET / HTTP/1.1', 20)
+    >>> HTTPHead(max_headers=1).parse_from(b"GET / HTTP/1.1\r\nA: 1\r\nB: 2\r\n\r\n")
+    Traceback (most recent call last):
+    ...
+    shadowproxy2.parsers.http.ProtocolError: more than 1 headers
+    """
+
+    def __init__(self, max_size: int = MAX_HEAD_SIZE, max_headers: int = MAX_HEADERS):
+        self.max_size = max_size
+        self.max_headers = max_headers
+
+    def __str__(self):
+        return f"{self.__class__.__name__}({self.max_size}, {self.max_headers})"
+
+    async def get_value(self, buffer):
+        # only reached if max_size exceeds the limit of the reader
+        return self.parse_from(await buffer.readuntil(b"\r\n\r\n"))[0]
+
+    def __call__(self, obj: bytes) -> bytes:
+        return obj + b"\r\n\r\n"
+
+    def parse_from(self, data, offset=0):
+        stop = offset + self.max_size + 4
+        match = HEAD_END.search(data, offset, stop)
+        if match is None:
+            if len(data) >= stop:
+                raise ProtocolError(f"head larger than {self.max_size} bytes")
+            raise StarvingException
+        end = match.start()
+        head = bytes(data[offset:end])
+        # not counted in heads too short to hold that many lines
+        if len(head) > 2 * self.max_headers:
+            if head.count(b"\r\n") > self.max_headers:
+                raise ProtocolError(f"more than {self.max_headers} headers")
+        return head, end + 4
+
+
+def body_length(headers: Headers, request: bool = True) -> Optional[int]:
+    r"""
+    CHUNKED, the content length, or None if the body ends with the connection;
+    a framing another hop could read differently raises ProtocolError: chunked
+    not being the final transfer coding of a request, or a content length that
+    is not digits or disagrees with another one
+
+    >>> def length(head, request=True):
+    ...     return body_length(Headers(b"GET / HTTP/1.1\r\n" + head, 16), request)
+    >>> length(b"Transfer-Encoding: gzip, chunked") == CHUNKED
+    True
+    >>> length(b"Content-Length: 12"), length(b""), length(b"Content-Length: 1,1")
+    (12, None, 1)
+    >>> length(b"Transfer-Encoding: chunked, gzip", request=False) is None
+    True
+    >>> length(b"Content-Length: -1")
+    Traceback (most recent call last):
+    ...
+    shadowproxy2.parsers.http.ProtocolError: bad content length: [b'-1']
+    """
+    codings = headers.get_all(b"transfer-encoding")
+    if codings:
+        # a content length next to it is ignored, and dropped when forwarded
+        if b",".join(codings).rsplit(b",", 1)[-1].strip().lower() == b"chunked":
+            return CHUNKED
+        if request:
+            raise ProtocolError(f"chunked is not the final coding: {codings!r}")
+        return None
+    lengths = headers.get_all(b"content-length")
+    if not lengths:
+        return None
+    values = {value.strip() for line in lengths for value in line.split(b",")}
+    if len(values) != 1:
+        raise ProtocolError(f"bad content length: {lengths!r}")
+    (value,) = values
+    if not value.isdigit():
+        raise ProtocolError(f"bad content length: {lengths!r}")
+    return int(value)
+
+
+def forwarded_headers(headers: Headers) -> List[bytes]:
+    "the header lines to pass on, a content length is dropped next to chunked"
+    dropped = HOP_BY_HOP
+    if b"transfer-encoding" in headers:
+        dropped = HOP_BY_HOP | {b"content-length"}
+    return [b"%s: %s" % (k, v) for k, v in headers.items() if k.lower() not in dropped]
+
+
+def keep_alive(ver: bytes, headers: Headers) -> bool:
+    """
+    >>> keep_alive(b"HTTP/1.1", {}), keep_alive(b"HTTP/1.0", {})
+    (True, False)
+    >>> keep_alive(b"HTTP/1.0", {b"proxy-connection": b"Keep-Alive"})
+    True
+    >>> keep_alive(b"HTTP/1.1", {b"connection": b"close"})
+    False
+    """
+    tokens = b",".join(
+        [headers.get(b"connection", b""), headers.get(b"proxy-connection", b"")]
+    ).lower()
+    if b"close" in tokens:
+        return False
+    return ver != b"HTTP/1.0" or b"keep-alive" in tokens
+
+
 class HTTPResponse(schema.BinarySchema):
-    head = schema.EndWith(b"\r\n\r\n")
+    head = HTTPHead()
+    __slots__ = ("ver", "code", "status", "headers")
 
     def __post_init__(self):
-        first_line, *header_lines = self.head.split(b"\r\n")
-        self.ver, self.code, *status = first_line.split(None, 2)
+        head = self.head
+        eol = head.find(b"\r\n")
+        if eol == -1:
+            eol = len(head)
+        self.ver, self.code, *status = head[:eol].split(None, 2)
         self.status = status[0] if status else b""
-        self.header_lines = header_lines
+        self.headers = Headers(head, eol + 2)
+
+    def build_send_data(self, keep_alive: bool) -> bytes:
+        "the response head to forward to the client"
+        lines = forwarded_headers(self.headers)
+        lines.append(b"Connection: keep-alive" if keep_alive else b"Connection: close")
+        return b"%s %s %s\r\n%s\r\n\r\n" % (
+            self.ver,
+            self.code,
+            self.status,
+            b"\r\n".join(lines),
+        )
 
 
 class HTTPRequest(schema.BinarySchema):
-    head = schema.EndWith(b"\r\n\r\n")
+    head = HTTPHead()
+    __slots__ = ("method", "path", "ver", "headers")
 
     def __post_init__(self):
-        first_line, *header_lines = self.head.split(b"\r\n")
-        self.method, self.path, self.ver = HTTP_LINE.fullmatch(first_line).groups()
-        self.headers = dict([line.split(b": ", 1) for line in header_lines])
+        head = self.head
+        eol = head.find(b"\r\n")
+        if eol == -1:
+            eol = len(head)
+        match = HTTP_LINE.fullmatch(head, 0, eol)
+        if match is None:
+            raise ProtocolError(f"bad request line: {head[:eol]!r}")
+        self.method, self.path, self.ver = match.groups()
+        self.headers = Headers(head, eol + 2)
 
-    def build_send_data(self, username: str, password: str):
-        if username is None or password is None:
-            auth = None
-        else:
-            auth = username.encode(), password.encode()
-        headers_list = [
-            b"%s: %s" % (k, v)
-            for k, v in self.headers.items()
-            if not k.startswith(b"Proxy-")
-        ]
-        headers_list.append(b"Proxy-Connection: Keep-Alive")
-        if auth:
-            headers_list.append(
-                b"Proxy-Authorization: Basic %s" % base64.b64encode(b":".join(auth))
-            )
+    def build_send_data(self, host: bytes) -> bytes:
+        r"""
+        the request head to send to the origin server, in origin form
+
+        >>> request = HTTPRequest(
+        ...     b"GET http://a.com/x?y HTTP/1.1\r\nProxy-Connection: close"
+        ... )
+        >>> request.build_send_data(b"a.com")
+        b'GET /x?y HTTP/1.1\r\nHost: a.com\r\nConnection: keep-alive\r\n\r\n'
+        """
+        headers_list = forwarded_headers(self.headers)
+        if b"host" not in self.headers:
+            headers_list.insert(0, b"Host: %s" % host)
+        headers_list.append(b"Connection: keep-alive")
         lines = b"\r\n".join(headers_list)
-        path = ABSOLUTE_PREFIX.sub("", self.path)
+        path = ABSOLUTE_PREFIX.sub(b"", self.path)
+        if not path.startswith(b"/"):
+            path = b"/" + path
         return b"%s %s %s\r\n%s\r\n\r\n" % (
             self.method,
             path,
@@ -56,49 +274,194 @@ class HTTPRequest(schema.BinarySchema):
         )
 
 
+async def copy_exactly(src: NullParser, dst: NullParser, nbytes: int):
+    while nbytes > 0:
+        data = await src.read_func(min(nbytes, COPY_SIZE))
+        if not data:
+            raise asyncio.IncompleteReadError(b"", nbytes)
+        nbytes -= len(data)
+        if src.counter is not None:
+            src.counter.nbytes += len(data)
+        await dst.write(data)
+
+
+async def copy_body(src: NullParser, dst: NullParser, length: Optional[int]):
+    "relay a message body of ``length`` bytes, CHUNKED or until eof if None"
+    if length is None:
+        while True:
+            data = await src.read_func(COPY_SIZE)
+            if not data:
+                return
+            if src.counter is not None:
+                src.counter.nbytes += len(data)
+            await dst.write(data)
+    elif length != CHUNKED:
+        return await copy_exactly(src, dst, length)
+    while True:
+        line = await src.reader.readuntil(b"\r\n")
+        await dst._write(line)
+        size = line.split(b";", 1)[0].strip()
+        if not CHUNK_SIZE.fullmatch(size):
+            raise ProtocolError(f"bad chunk size: {line!r}")
+        size = int(size, 16)
+        if size == 0:
+            break
+        await copy_exactly(src, dst, size + 2)
+    while line != b"\r\n":  # trailer section
+        line = await src.reader.readuntil(b"\r\n")
+        await dst._write(line)
+    await dst.writer.drain()
+
+
+async def connect_origin(ctx, origin) -> NullParser:
+    remote = await ctx.create_client(origin)
+    await remote.init_client(origin)
+    await remote.finish_handshake()
+    return remote
+
+
+def move_meters(stale: NullParser, fresh: NullParser):
+    "the counter and throttle of a dead upstream connection go to its successor"
+    fresh.counter, stale.counter = stale.counter, None
+    fresh.set_throttle(stale.throttle)
+    stale.throttle = None  # not closed with the stale connection
+
+
 class HTTPParser(NullParser):
-    def __init__(self, username: str, password: str):
+    def __init__(
+        self, username: str, password: str, users=None, pipeline: bool = False
+    ):
         self.username = username
         self.password = password
+        self.users = users
+        self.pipeline = pipeline
         if username is None or password is None:
             self.auth = None
         else:
             self.auth = self.username.encode(), self.password.encode()
 
+    def _authenticate(self, request: HTTPRequest):
+        "set the user of the request, return the response if it is rejected"
+        if self.users is None:
+            return None
+        pauth = request.headers.get(b"Proxy-Authorization", None)
+        user = self.users.basic_auth.get(pauth)
+        if user is None:
+            return (
+                request.ver + b" 407 Proxy Authentication Required\r\n"
+                b"Connection: close\r\n"
+                b'Proxy-Authenticate: Basic realm="Shadowproxy Auth"\r\n\r\n'
+            )
+        self.user = user
+
     async def server(self, ctx):
         request = await self.reader.pull(HTTPRequest)
-        if self.auth:
-            pauth = request.headers.get(b"Proxy-Authorization", None)
-            httpauth = b"Basic " + base64.b64encode(b":".join(self.auth))
-            if httpauth != pauth:
-                await self._write(
-                    request.ver + b" 407 Proxy Authentication Required\r\n"
-                    b"Connection: close\r\n"
-                    b'Proxy-Authenticate: Basic realm="Shadowproxy Auth"\r\n\r\n'
-                )
+        while request is not None:
+            rejection = self._authenticate(request)
+            if rejection is not None:
+                await self._write(rejection)
                 raise ProtocolError("Unauthorized HTTP Request")
-        if request.method == b"CONNECT":
-            host, _, port = request.path.partition(b":")
-            target_addr = (host.decode(), int(port))
+            if request.method == b"CONNECT":
+                host, _, port = request.path.partition(b":")
+                return await ctx.connect_remote(self, (host.decode(), int(port)))
+            request = await self.forward(ctx, request)
+        await self.close()
+        return None
+
+    async def forward(self, ctx, request: HTTPRequest):
+        """
+        forward a request with an absolute uri over a pooled upstream
+        connection, return the next request of the client, or None when the
+        client connection is done
+        """
+        url = urlparse(request.path)
+        if url.scheme != b"http" or not url.hostname:
+            await self._write(request.ver + b" 400 Bad Request\r\n\r\n")
+            raise ProtocolError(f"bad request uri: {request.path!r}")
+        origin = (url.hostname.decode(), url.port or 80)
+        headers = request.headers
+        try:
+            if SPACE_BEFORE_COLON.search(request.head, headers.start - 2):
+                # a name we would not look up, forwarded stripped
+                raise ProtocolError("whitespace before a header colon")
+            request_length = body_length(headers) or 0
+        except ProtocolError:
+            await self._write(request.ver + b" 400 Bad Request\r\n\r\n")
+            raise
+        if headers.get(b"expect", b"").lower() == b"100-continue":
+            await self._write(request.ver + b" 100 Continue\r\n\r\n")
+        ctx.check_quota(self.user)
+        pool = ctx.container.http_pool()
+        remote = pool.acquire(origin)
+        reused = remote is not None
+        if remote is None:
+            remote = await connect_origin(ctx, origin)
+        ctx.start_accounting(self, remote)
+        ctx.set_throttles(self, remote)
+        while True:
+            try:
+                await remote._write(request.build_send_data(url.netloc))
+                await copy_body(self, remote, request_length)
+                await remote.writer.drain()
+                response = await remote.reader.pull(HTTPResponse)
+                break
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # the origin may close an idle connection at any moment
+                if not reused or request_length != 0:
+                    await remote.close()
+                    raise
+                stale, reused = remote, False
+                try:
+                    remote = await connect_origin(ctx, origin)
+                    move_meters(stale, remote)
+                finally:
+                    await stale.close()
+            except BaseException:  # a malformed body for example
+                await remote.close()
+                raise
+        try:
+            while response.code.startswith(b"1"):  # interim responses
+                await self._write(response.head + b"\r\n\r\n")
+                response = await remote.reader.pull(HTTPResponse)
+            response_headers = response.headers
+            if request.method == b"HEAD" or response.code in (b"204", b"304"):
+                response_length = 0
+            else:
+                response_length = body_length(response_headers, request=False)
+            bounded = response_length is not None
+            client_alive = bounded and keep_alive(request.ver, headers)
+            await self.write(response.build_send_data(client_alive))
+            await copy_body(remote, self, response_length)
+        except BaseException:
+            await remote.close()
+            raise
+        remote.counter = None
+        remote.set_throttle(None)
+        if bounded and keep_alive(response.ver, response_headers):
+            pool.release(origin, remote)
         else:
+            await remote.close()
+        if not client_alive:
+            return None
+        try:
+            return await self.reader.pull(HTTPRequest)
+        except asyncio.IncompleteReadError:
+            return None
+
+    def server_handshake(self):
+        parser = yield from iofree.get_parser()
+        request = yield from read_schema(HTTPRequest)
+        rejection = self._authenticate(request)
+        if rejection is not None:
+            parser.write(rejection)
+            raise ProtocolError("Unauthorized HTTP Request")
+        if request.method != b"CONNECT":
             raise ProtocolError("only http connect is supported")
-            url = urlparse(request.path)
-            if not url.hostname:
-                error_msg = "hostname is needed"
-                await self._write(
-                    b"HTTP/1.1 200 OK\r\n"
-                    b"Connection: close\r\n"
-                    b"Content-Type: text/plain\r\n"
-                    b"Content-Length: 2\r\n\r\n"
-                )
-                await self._write(error_msg.encode())
-                raise ProtocolError(error_msg)
-            target_addr = (url.hostname.decode(), url.port or 80)
-        remote_parser = await ctx.create_client(target_addr)
-        if request.method == b"CONNECT":
-            await self._write(b"HTTP/1.1 200 Connection: Established\r\n\r\n")
-        await remote_parser.init_client(target_addr)
-        return remote_parser
+        host, _, port = request.path.partition(b":")
+        return host.decode(), int(port)
+
+    def server_reply(self):
+        return b"HTTP/1.1 200 Connection: Established\r\n\r\n"
 
     async def init_client(self, target_addr):
         target_host, target_port = target_addr
@@ -115,6 +478,13 @@ class HTTPParser(NullParser):
             )
         headers_str += "\r\n"
         await self._write(headers_str.encode())
+        if self.pipeline:
+            # the response is read by `finish_handshake`
+            self.pending_reply = self._read_response()
+            return None
+        return await self._read_response()
+
+    async def _read_response(self):
         response = await self.reader.pull(HTTPResponse)
         if response.code != b"200":
             raise ProtocolError(f"bad status code: {response.code} {response.status}")
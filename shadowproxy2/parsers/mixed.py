@@ -0,0 +1,66 @@
+from .. import iofree
+from .base import NullParser
+from .http import HTTPParser
+from .socks4 import Socks4Parser
+from .socks5 import Socks5Parser
+from .trojan import TrojanParser
+
+
+class ProtocolError(Exception):
+    ...
+
+
+# the protocol of a connection is told by its first byte: the version of
+# socks, an uppercase http method or a lowercase hex trojan digest
+PROTOCOLS = [None] * 256
+PROTOCOLS[4] = Socks4Parser
+PROTOCOLS[5] = Socks5Parser
+for byte in b"ABCDEFGHIJKLMNOPQRSTUVWXYZ":
+    PROTOCOLS[byte] = HTTPParser
+for byte in b"0123456789abcdef":
+    PROTOCOLS[byte] = TrojanParser
+PROTOCOLS = tuple(PROTOCOLS)
+
+
+class MixedParser(NullParser):
+    """
+    socks5, socks4, http and trojan on a single port, the protocol is
+    detected from the first byte without consuming it
+    """
+
+    def __init__(self, username: str = None, password: str = None, users=None):
+        super().__init__()
+        self.username = username
+        self.password = password
+        self.users = users
+        self.inner = None
+
+    def _detect(self, first_byte: bytes):
+        cls = PROTOCOLS[first_byte[0]]
+        if cls is None:
+            raise ProtocolError(f"unknown protocol, first byte: {first_byte[0]:#04x}")
+        if cls is Socks4Parser:
+            if self.username is not None or self.users is not None:
+                raise ProtocolError("socks4 has no authentication, refused")
+            self.inner = cls()
+        else:
+            self.inner = cls(self.username, self.password, self.users)
+        return self.inner
+
+    async def server(self, ctx):
+        inner = self._detect(await self.reader.peek(1))
+        inner.set_rw(self.reader, self.writer)
+        try:
+            return await inner.server(ctx)
+        finally:
+            self.user = inner.user
+
+    def server_handshake(self):
+        inner = self._detect((yield from iofree.peek(1)))
+        try:
+            return (yield from inner.server_handshake())
+        finally:
+            self.user = inner.user
+
+    def server_reply(self):
+        return self.inner.server_reply()
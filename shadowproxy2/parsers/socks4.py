@@ -2,7 +2,7 @@ import enum
 import socket
 
 from ..aiobuffer import buffer as schema
-from .base import NullParser
+from .base import NullParser, read_schema
 
 
 class Cmd(enum.IntEnum):
@@ -37,6 +37,7 @@ class Response(schema.BinarySchema):
 
 
 domain = schema.EndWith(b"\x00")
+GRANTED = Response(..., Rep(0x5A), 0, "0.0.0.0")
 
 
 class Socks4Parser(NullParser):
@@ -44,28 +45,32 @@ class Socks4Parser(NullParser):
         request = await self.reader.pull(ClientRequest)
         if request.dst_ip.startswith("0.0.0"):
             host = await self.reader.pull(domain)
-            addr = (host, request.dst_port)
+            addr = (host.decode(), request.dst_port)
         else:
             addr = (request.dst_ip, request.dst_port)
         assert request.cmd is Cmd.connect
-        remote_parser = await ctx.create_client(addr)
-        await self._write(Response(..., Rep(0x5A), 0, "0.0.0.0").binary)
-        await remote_parser.init_client(addr)
-        return remote_parser
+        return await ctx.connect_remote(self, addr)
+
+    def server_handshake(self):
+        request = yield from read_schema(ClientRequest)
+        assert request.cmd is Cmd.connect
+        if request.dst_ip.startswith("0.0.0"):
+            host = yield from read_schema(domain)
+            return host.decode(), request.dst_port
+        return request.dst_ip, request.dst_port
+
+    def server_reply(self):
+        return GRANTED.binary
 
     async def init_client(self, target_addr):
-        tail = b""
         target_host, target_port = target_addr
+        request = ClientRequest(..., Cmd.connect, target_port, target_host, b"\x01\x01")
         try:
-            request = ClientRequest(
-                ..., Cmd.connect, target_port, target_host, b"\x01\x01"
-            )
+            data = request.binary
         except OSError:
-            request = ClientRequest(
-                ..., Cmd.connect, target_port, "0.0.0.1", b"\x01\x01"
-            )
-            tail = domain(target_host.encode())
-        await self._write(request.binary + tail)
+            request.dst_ip = "0.0.0.1"
+            data = request.binary + domain(target_host.encode())
+        await self._write(data)
         response = await self.reader.pull(Response)
         assert response.rep is Rep.granted
         return response
@@ -1,5 +1,24 @@
+import asyncio
+
+from .. import iofree
 from ..aiobuffer import socks5
-from .base import NullParser
+from ..udp import Socks5UDPRelay
+from .base import NullParser, read_schema
+
+
+BIND_ADDR = socks5.Addr(1, "0.0.0.0", 0)
+NO_AUTH = socks5.ServerSelection(..., socks5.AuthMethod.no_auth)
+USER_AUTH = socks5.ServerSelection(..., socks5.AuthMethod.user_auth)
+AUTH_SUCCEEDED = socks5.UsernameAuthReply(..., ...)
+NOT_ALLOWED = socks5.Reply(..., socks5.Rep.not_allowed, ..., BIND_ADDR)
+NOT_SUPPORTED = socks5.Reply(..., socks5.Rep.command_not_supported, ..., BIND_ADDR)
+SUCCEEDED = socks5.Reply(..., socks5.Rep.succeeded, ..., BIND_ADDR)
+CLIENT_HANDSHAKE = socks5.Handshake(
+    ..., [socks5.AuthMethod.no_auth, socks5.AuthMethod.user_auth]
+)
+# a pipelining client offers only the method it is going to use
+NO_AUTH_HANDSHAKE = socks5.Handshake(..., [socks5.AuthMethod.no_auth])
+USER_AUTH_HANDSHAKE = socks5.Handshake(..., [socks5.AuthMethod.user_auth])
 
 
 class ProtocolError(Exception):
@@ -7,59 +26,131 @@ class ProtocolError(Exception):
 
 
 class Socks5Parser(NullParser):
-    def __init__(self, username: str = None, password: str = None):
+    def __init__(
+        self,
+        username: str = None,
+        password: str = None,
+        users=None,
+        pipeline: bool = False,
+    ):
         super().__init__()
         self.username = username
         self.password = password
+        self.users = users
+        self.pipeline = pipeline
 
     async def server(self, ctx):
-        if self.username is None or self.password is None:
-            auth = None
-        else:
-            auth = self.username, self.password
         handshake = await self.reader.pull(socks5.Handshake)
-        addr = socks5.Addr(1, "0.0.0.0", 0)
-        if auth:
+        if self.users is not None:
             if socks5.AuthMethod.user_auth not in handshake.methods:
-                await self._write(
-                    socks5.Reply(..., socks5.Rep.not_allowed, ..., addr).binary
-                )
+                await self._write(NOT_ALLOWED.binary)
                 raise ProtocolError("auth method not allowed")
-            await self._write(
-                socks5.ServerSelection(..., socks5.AuthMethod.user_auth).binary
-            )
+            await self._write(USER_AUTH.binary)
             user_auth = await self.reader.pull(socks5.UsernameAuth)
-            if (user_auth.username, user_auth.password) != auth:
-                await self._write(
-                    socks5.Reply(..., socks5.Rep.not_allowed, ..., addr).binary
-                )
+            if not self.users.check(user_auth.username, user_auth.password):
+                await self._write(NOT_ALLOWED.binary)
                 raise ProtocolError("auth failed")
-            await self._write(socks5.UsernameAuthReply(..., ...).binary)
+            self.user = user_auth.username
+            await self._write(AUTH_SUCCEEDED.binary)
         else:
-            await self._write(
-                socks5.ServerSelection(..., socks5.AuthMethod.no_auth).binary
-            )
+            await self._write(NO_AUTH.binary)
         request = await self.reader.pull(socks5.ClientRequest)
+        if request.cmd is socks5.Cmd.associate:
+            await self.associate(ctx)
+            return None
         if request.cmd is not socks5.Cmd.connect:
-            raise ProtocolError(
-                f"only support connect command now, got {socks5.Cmd.connect!r}"
-            )
+            await self._write(NOT_SUPPORTED.binary)
+            raise ProtocolError(f"command not supported: {request.cmd!r}")
         target_addr = (request.addr.host, request.addr.port)
-        remote_parser = await ctx.create_client(target_addr)
-        await self._write(socks5.Reply(..., socks5.Rep(0), ..., addr).binary)
-        await remote_parser.init_client(target_addr)
-        return remote_parser
+        return await ctx.connect_remote(self, target_addr)
+
+    async def associate(self, ctx):
+        """
+        UDP ASSOCIATE: relay the client's datagrams through a udp socket
+        bound next to the tcp connection, until the client closes it
+        """
+        try:
+            create_client = ctx.datagram_client_factory()
+        except Exception:
+            await self._write(NOT_SUPPORTED.binary)
+            raise
+        peername = self.writer.get_extra_info("peername")
+        if not isinstance(peername, tuple):  # a unix socket, no udp next to it
+            await self._write(NOT_SUPPORTED.binary)
+            raise ProtocolError("udp associate needs a tcp connection")
+        try:
+            ctx.check_quota(self.user)
+        except Exception:
+            await self._write(NOT_ALLOWED.binary)
+            raise
+        loop = asyncio.get_running_loop()
+        client_host = peername[0]
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: Socks5UDPRelay(
+                create_client,
+                client_host,
+                create_meter=lambda addr: ctx.create_meter(self.user, client_host),
+            ),
+            local_addr=(self.writer.get_extra_info("sockname")[0], 0),
+        )
+        try:
+            bind_addr = socks5.Addr.from_tuple(transport.get_extra_info("sockname")[:2])
+            reply = socks5.Reply(..., socks5.Rep.succeeded, ..., bind_addr)
+            await self._write(reply.binary)
+            while await self.reader.read(4096):
+                pass
+        finally:
+            transport.close()
+            await self.close()
+
+    def server_handshake(self):
+        parser = yield from iofree.get_parser()
+        handshake = yield from read_schema(socks5.Handshake)
+        if self.users is not None:
+            if socks5.AuthMethod.user_auth not in handshake.methods:
+                parser.write(NOT_ALLOWED.binary)
+                raise ProtocolError("auth method not allowed")
+            parser.write(USER_AUTH.binary)
+            user_auth = yield from read_schema(socks5.UsernameAuth)
+            if not self.users.check(user_auth.username, user_auth.password):
+                parser.write(NOT_ALLOWED.binary)
+                raise ProtocolError("auth failed")
+            self.user = user_auth.username
+            parser.write(AUTH_SUCCEEDED.binary)
+        else:
+            parser.write(NO_AUTH.binary)
+        request = yield from read_schema(socks5.ClientRequest)
+        if request.cmd is not socks5.Cmd.connect:  # associate needs the streams
+            parser.write(NOT_SUPPORTED.binary)
+            raise ProtocolError(f"command not supported: {request.cmd!r}")
+        return request.addr.host, request.addr.port
+
+    def server_reply(self):
+        return SUCCEEDED.binary
 
     async def init_client(self, target_addr):
         if self.username is None or self.password is None:
             auth = None
         else:
             auth = self.username, self.password
-        await self._write(
-            socks5.Handshake(
-                ..., [socks5.AuthMethod.no_auth, socks5.AuthMethod.user_auth]
-            ).binary
-        )
+        request = socks5.ClientRequest(
+            ..., socks5.Cmd.connect, ..., socks5.Addr.from_tuple(target_addr)
+        ).binary
+        if self.pipeline:
+            # greeting, auth and request in one write, the replies are read
+            # by `finish_handshake` before the first read from the server
+            if auth:
+                auth_request = socks5.UsernameAuth(..., *auth).binary
+                await self._write(USER_AUTH_HANDSHAKE.binary + auth_request + request)
+            else:
+                await self._write(NO_AUTH_HANDSHAKE.binary + request)
+            self.pending_reply = self._read_replies(auth, None)
+            return None
+        await self._write(CLIENT_HANDSHAKE.binary)
+        return await self._read_replies(auth, request)
+
+    async def _read_replies(self, auth, request):
+        "read the replies of `init_client`, ``request`` is sent if not yet"
         server_selection = await self.reader.pull(socks5.ServerSelection)
         if server_selection.method not in (
             socks5.AuthMethod.no_auth,
@@ -67,13 +158,11 @@ class Socks5Parser(NullParser):
         ):
             raise ProtocolError("no method to choose")
         if auth and (server_selection.method is socks5.AuthMethod.user_auth):
-            await self._write(socks5.UsernameAuth(..., *auth).binary)
+            if request is not None:
+                await self._write(socks5.UsernameAuth(..., *auth).binary)
             await self.reader.pull(socks5.UsernameAuthReply)
-        await self._write(
-            socks5.ClientRequest(
-                ..., socks5.Cmd.connect, ..., socks5.Addr.from_tuple(target_addr)
-            ).binary
-        )
+        if request is not None:
+            await self._write(request)
         reply = await self.reader.pull(socks5.Reply)
         if reply.rep is not socks5.Rep.succeeded:
             raise ProtocolError(f"bad reply: {reply}")
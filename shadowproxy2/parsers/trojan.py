@@ -30,11 +30,23 @@
 # |  1   | Variable |    2     |   2    | X'0D0A' | Variable |
 # +------+----------+----------+--------+---------+----------+
 
-from hashlib import sha224
+import asyncio
+import traceback
+from functools import partial
+from inspect import isawaitable
 
+import click
+
+from .. import app, iofree
 from ..aiobuffer import buffer as schema
 from ..aiobuffer import socks5
-from .base import NullParser
+from ..udp import BACKLOG_LIMIT, SESSION_LIMIT, UDP_TIMEOUT, NATTable, packed_addr
+from ..users import trojan_digest
+from .base import NullParser, read_schema
+from .socks5 import NOT_ALLOWED, NOT_SUPPORTED
+
+# framed datagrams are dropped while this much is waiting to be sent
+UDP_BUFFER_LIMIT = 256 * 1024
 
 
 class ProtocolError(Exception):
@@ -49,40 +61,194 @@ class TrojanSchema(schema.BinarySchema):
     crlf1 = schema.MustEqual(schema.Bytes(2), b"\r\n")
 
 
+class UDPHeader(schema.BinarySchema):
+    addr = socks5.Addr
+    length = schema.u16be
+    crlf = schema.MustEqual(schema.Bytes(2), b"\r\n")
+
+
+def udp_frame(addr, data: bytes) -> bytes:
+    r"""
+    >>> udp_frame(("1.2.3.4", 53), b"dns")
+    b'\x01\x01\x02\x03\x04\x005\x00\x03\r\ndns'
+    """
+    return packed_addr(addr) + len(data).to_bytes(2, "big") + b"\r\n" + data
+
+
 class TrojanParser(NullParser):
-    def __init__(self, username: str = None, password: str = None):
+    def __init__(
+        self,
+        username: str = None,
+        password: str = None,
+        users=None,
+        pipeline: bool = False,
+    ):
         super().__init__()
         self.username = username
         self.password = password
-        if self.username is None or self.password is None:
-            self.rauth = b''
-        else:
-            self.rauth = f"{username}:{password}".encode()
+        self.users = users
+        self.pipeline = pipeline
 
     async def server(self, ctx):
         trojan = await self.reader.pull(TrojanSchema)
-        addr = socks5.Addr(1, "0.0.0.0", 0)
-        if self.rauth:
-            if sha224(self.rauth).hexdigest().encode() != trojan.hex:
-                await self._write(
-                    socks5.Reply(..., socks5.Rep.not_allowed, ..., addr).binary
-                )
+        if self.users is not None:
+            user = self.users.trojan_digests.get(trojan.hex)
+            if user is None:
+                await self._write(NOT_ALLOWED.binary)
                 raise ProtocolError("auth method not allowed")
+            self.user = user
 
+        if trojan.cmd is socks5.Cmd.associate:
+            await self.associate(ctx)
+            return None
         if trojan.cmd is not socks5.Cmd.connect:
-            raise ProtocolError(
-                f"only support connect command now, got {socks5.Cmd.connect!r}"
-            )
+            await self._write(NOT_SUPPORTED.binary)
+            raise ProtocolError(f"command not supported: {trojan.cmd!r}")
         target_addr = (trojan.addr.host, trojan.addr.port)
+        ctx.check_quota(self.user)
         remote_parser = await ctx.create_client(target_addr)
         await remote_parser.init_client(target_addr)
         return remote_parser
 
-    async def init_client(self, target_addr):
+    def server_handshake(self):
+        parser = yield from iofree.get_parser()
+        trojan = yield from read_schema(TrojanSchema)
+        if self.users is not None:
+            user = self.users.trojan_digests.get(trojan.hex)
+            if user is None:
+                parser.write(NOT_ALLOWED.binary)
+                raise ProtocolError("auth method not allowed")
+            self.user = user
+        if trojan.cmd is not socks5.Cmd.connect:  # associate needs the streams
+            raise ProtocolError(f"command not supported: {trojan.cmd!r}")
+        return trojan.addr.host, trojan.addr.port
 
-        await self._write(
-                TrojanSchema(
-                    sha224(self.rauth or b'').hexdigest().encode(), ...,
-                    socks5.Cmd.connect, socks5.Addr.from_tuple(target_addr), ...
-            ).binary
+    async def associate(self, ctx):
+        """
+        UDP ASSOCIATE: the stream carries framed datagrams to any target,
+        each target gets its own udp client, closed when idle; the datagrams
+        are counted and shaped by one `DatagramMeter`
+        """
+        create_client = ctx.datagram_client_factory()
+        peername = self.writer.get_extra_info("peername")
+        source_host = peername[0] if isinstance(peername, tuple) else "unix"
+        meter = ctx.create_meter(self.user, source_host)
+        nat = NATTable(
+            UDP_TIMEOUT,
+            lambda client: client.close(),
+            asyncio.get_running_loop(),
+            SESSION_LIMIT,
         )
+        reply = partial(self._reply_datagram, meter)
+        try:
+            async for data, target_addr in self.read_datagrams():
+                if not meter.admit_upload(len(data)):
+                    continue
+                client = nat.get(target_addr)
+                if client is None:
+                    client = create_client(reply)
+                    nat.put(target_addr, client)
+                client.send(data, target_addr)
+        finally:
+            nat.close()
+            meter.close()
+            await self.close()
+
+    def _reply_datagram(self, meter, data: bytes, addr):
+        if meter.admit_download(len(data)):
+            self.send_datagram(data, addr)
+
+    async def read_datagrams(self):
+        "yield (data, addr) of the framed datagrams until the stream ends"
+        while True:
+            try:
+                header = await self.reader.pull(UDPHeader)
+                data = await self.reader.readexactly(header.length)
+            except asyncio.IncompleteReadError:
+                return
+            yield data, (header.addr.host, header.addr.port)
+
+    def send_datagram(self, data: bytes, addr):
+        "frame a datagram onto the stream, dropped if the stream is backed up"
+        if self.writer.is_closing():
+            return
+        transport = getattr(self.writer, "transport", None)
+        if transport and transport.get_write_buffer_size() > UDP_BUFFER_LIMIT:
+            return
+        r = self.writer.write(udp_frame(addr, data))
+        if isawaitable(r):
+            asyncio.ensure_future(r)
+
+    def _header(self, cmd, target_addr) -> bytes:
+        return TrojanSchema(
+            trojan_digest(self.username, self.password),
+            ...,
+            cmd,
+            socks5.Addr.from_tuple(target_addr),
+            ...,
+        ).binary
+
+    async def init_client(self, target_addr):
+        header = self._header(socks5.Cmd.connect, target_addr)
+        if self.pipeline:
+            self.hold(header)
+        else:
+            await self._write(header)
+
+    async def init_associate(self, target_addr):
+        "start a UDP ASSOCIATE stream, ``target_addr`` is of its first datagram"
+        await self._write(self._header(socks5.Cmd.associate, target_addr))
+
+
+class TrojanDatagramClient:
+    """
+    Send datagrams to any target over one trojan UDP ASSOCIATE stream.
+    ``connect(target_addr)`` opens the stream on the first datagram, which
+    waits in a backlog with the ones following it until the stream is ready.
+    """
+
+    def __init__(self, on_received, connect):
+        self.on_received = on_received
+        self.connect = connect
+        self.parser = None
+        self.backlog = []
+        self.task = None
+
+    def open(self) -> "TrojanDatagramClient":
+        return self
+
+    def send(self, data: bytes, addr):
+        if self.parser is not None:
+            self.parser.send_datagram(data, addr)
+            return
+        if len(self.backlog) < BACKLOG_LIMIT:
+            self.backlog.append((data, addr))
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._run(addr))
+
+    async def _run(self, target_addr):
+        parser = None
+        try:
+            parser = await self.connect(target_addr)
+            await parser.init_associate(target_addr)
+            self.parser = parser
+            backlog, self.backlog = self.backlog, []
+            for data, addr in backlog:
+                parser.send_datagram(data, addr)
+            async for data, addr in parser.read_datagrams():
+                self.on_received(data, addr)
+        except Exception as e:
+            # udp: datagrams of a broken stream are just lost
+            if app.settings.verbose > 0:
+                click.secho(f"trojan udp to {target_addr}: {e}", fg="yellow")
+            if app.settings.verbose > 1:
+                traceback.print_exc()
+        finally:
+            self.parser = None
+            self.task = None  # the next datagram opens a new stream
+            if parser is not None:
+                await parser.close()
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
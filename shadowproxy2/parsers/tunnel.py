@@ -0,0 +1,72 @@
+import ipaddress
+import socket
+from typing import Tuple
+
+from .base import NullParser
+
+SO_ORIGINAL_DST = 80  # linux/netfilter_ipv4.h, the same for ip6tables
+
+
+class ProtocolError(Exception):
+    ...
+
+
+def unmapped(host: str) -> str:
+    """
+    an ipv4 address mapped into ipv6, as a dual stack socket names it, in
+    its ipv4 form
+
+    >>> unmapped("::ffff:10.0.0.1"), unmapped("10.0.0.1"), unmapped("::1")
+    ('10.0.0.1', '10.0.0.1', '::1')
+    """
+    mapped = getattr(ipaddress.ip_address(host), "ipv4_mapped", None)
+    return host if mapped is None else str(mapped)
+
+
+def original_dst(sock) -> Tuple[str, int]:
+    "the destination of a connection before iptables redirected it"
+    if sock.family == socket.AF_INET6:
+        host = sock.getsockname()[0]
+        if not ipaddress.ip_address(host).ipv4_mapped:
+            data = sock.getsockopt(socket.IPPROTO_IPV6, SO_ORIGINAL_DST, 28)
+            port = int.from_bytes(data[2:4], "big")
+            return socket.inet_ntop(socket.AF_INET6, data[8:24]), port
+    data = sock.getsockopt(socket.SOL_IP, SO_ORIGINAL_DST, 16)
+    return socket.inet_ntoa(data[4:8]), int.from_bytes(data[2:4], "big")
+
+
+class TunnelParser(NullParser):
+    "forward every connection to a fixed target, no handshake bytes at all"
+
+    def __init__(self, target_addr: Tuple[str, int] = None):
+        self.target_addr = target_addr
+
+    async def server(self, ctx):
+        ctx.check_quota(self.user)
+        remote_parser = await ctx.create_client(self.target_addr)
+        await remote_parser.init_client(self.target_addr)
+        return remote_parser
+
+    def server_handshake(self):
+        return self.target_addr
+        yield  # a generator that needs no bytes
+
+
+class RedirectParser(TunnelParser):
+    "transparent proxy for connections redirected by iptables REDIRECT"
+
+    def connection_made(self, transport):
+        sock = transport.get_extra_info("socket")
+        try:
+            target_addr = original_dst(sock)
+        except OSError as e:
+            raise ProtocolError(f"no original destination: {e}") from e
+        host, port = sock.getsockname()[:2]
+        if (unmapped(target_addr[0]), target_addr[1]) == (unmapped(host), port):
+            raise ProtocolError(f"{target_addr} is not redirected")
+        self.target_addr = target_addr
+
+    def set_rw(self, reader, writer, throttle=None):
+        super().set_rw(reader, writer, throttle)
+        if self.target_addr is None:
+            self.connection_made(writer)
@@ -0,0 +1,73 @@
+import asyncio
+import time
+from collections import deque
+from typing import Deque, Dict, Hashable, Set, Tuple
+
+
+class ConnectionPool:
+    """
+    Idle upstream connections kept per origin for plain http forwarding,
+    the most recently released one is reused first. Connections closed by
+    the origin, idle longer than ``idle_timeout`` seconds or beyond
+    ``max_idle`` per origin are closed.
+
+    >>> class Conn:
+    ...     closed = False
+    ...     def is_reusable(self):
+    ...         return not self.closed
+    ...     async def close(self):
+    ...         self.closed = True
+    >>> pool = ConnectionPool()
+    >>> conn = Conn()
+    >>> pool.release(("example.com", 80), conn)
+    >>> pool.acquire(("example.com", 80)) is conn
+    True
+    >>> pool.acquire(("example.com", 80)) is None
+    True
+    """
+
+    def __init__(self, max_idle: int = 8, idle_timeout: float = 60.0):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle: Dict[Hashable, Deque[Tuple[float, object]]] = {}
+        self._closing: Set[asyncio.Task] = set()
+
+    def acquire(self, origin: Hashable):
+        "an idle connection to ``origin``, or None"
+        conns = self.idle.get(origin)
+        if not conns:
+            return None
+        deadline = time.monotonic() - self.idle_timeout
+        while conns:
+            released_at, conn = conns.pop()
+            if released_at > deadline and conn.is_reusable():
+                break
+            self._discard(conn)
+        else:
+            conn = None
+        if not conns:
+            del self.idle[origin]
+        return conn
+
+    def release(self, origin: Hashable, conn) -> None:
+        "keep ``conn`` for the next request to ``origin``"
+        now = time.monotonic()
+        conns = self.idle.get(origin)
+        if conns is None:
+            conns = self.idle[origin] = deque()
+        conns.append((now, conn))
+        while conns and (
+            len(conns) > self.max_idle or conns[0][0] <= now - self.idle_timeout
+        ):
+            self._discard(conns.popleft()[1])
+
+    def _discard(self, conn) -> None:
+        task = asyncio.ensure_future(conn.close())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    def close(self) -> None:
+        for conns in self.idle.values():
+            for _, conn in conns:
+                self._discard(conn)
+        self.idle.clear()
@@ -0,0 +1,29 @@
+"""
+The ``server_handshake`` iofree generators of the inbound parsers parse a
+handshake from bytes alone and return the target address, replies are
+written with the parser from `iofree.get_parser`. They are run without
+sockets by the tests and ``benchmarks/bench_handshake``, connections are
+served by the stream based ``server()`` coroutines, which are faster.
+"""
+from .iofree.buffer import Buffer
+from .iofree.parser import Parser
+
+BUFFER_SIZE = 4096
+
+
+class HandshakeEngine(Parser):
+    """
+    The iofree parser of a handshake: replies go straight to the transport,
+    there is no response queue to set up for every connection.
+    """
+
+    def __init__(self, gen, transport):
+        self.transport = transport
+        super().__init__(gen, Buffer(BUFFER_SIZE))
+
+    def write(self, data: bytes) -> None:
+        self.transport.write(data)
+
+    def wakeup(self) -> None:
+        "run on a handshake that waited for something other than data"
+        self.data_received()
@@ -2,19 +2,43 @@ import asyncio
 import contextlib
 import signal
 
+from . import app
+from .accounting import Accounting
+
 
 async def run_server(ctx_list):
     loop = asyncio.get_running_loop()
     quit_event = asyncio.Event()
     loop.add_signal_handler(signal.SIGINT, quit_event.set)
+    loop.add_signal_handler(
+        signal.SIGHUP, lambda: [ctx.reload() for ctx in ctx_list]
+    )
     # loop.add_signal_handler(signal.SIGINT, factory.close)
 
     async with contextlib.AsyncExitStack() as stack:
+        if app.settings.traffic_db:
+            accounting = Accounting(
+                str(app.settings.traffic_db),
+                app.settings.flush_interval,
+                app.settings.cut_over_quota,
+            )
+            stack.callback(accounting.close)
+            task = asyncio.create_task(accounting.run())
+            stack.push_async_callback(_cancel, task)
+        else:
+            accounting = None
         for ctx in ctx_list:
             ctx.stack = stack
+            ctx.accounting = accounting
             print(
                 f"server running at {ctx.inbound_ns} -> {ctx.outbound_ns}", flush=True
             )
             await ctx.create_server()
 
         await quit_event.wait()
+
+
+async def _cancel(task):
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
@@ -2,6 +2,7 @@
 # https://dev.to/satrobit/rate-limiting-using-the-token-bucket-algorithm-3cjh
 import asyncio
 import time
+from typing import Any, Dict, Optional, Set, Tuple
 
 
 class Throttle:
@@ -36,3 +37,246 @@ class Throttle:
             loop = asyncio.get_running_loop()
             event.clear()
             loop.call_later((1 - self.bucket) / self.rate, event.set)
+
+
+def kbps(rate: Optional[int]) -> Optional[int]:
+    "convert KB/s to bytes per second"
+    return None if rate is None else rate * 1024
+
+
+class HierarchicalThrottle:
+    """
+    Hierarchical Token Bucket (HTB-style) node
+
+    Every node has a ceil bucket filled at its own ``rate`` and an assured
+    bucket filled at its fair share of the parent's assured rate. A node may
+    send while its assured bucket is positive, otherwise it borrows: it has to
+    wait for both its ceil bucket and its parent. Bytes are charged to every
+    node up to the root.
+
+    @param rate: max bytes per second of this node, None means unlimited
+    @param parent: parent node, None for a root
+    @param time_window: the tokens are added in this time frame
+    @param burst: bytes a new node may send before settling to its rate
+
+    >>> root = HierarchicalThrottle(1000)
+    >>> a = HierarchicalThrottle(parent=root)
+    >>> b = HierarchicalThrottle(parent=root)
+    >>> a.assured_rate, b.assured_rate
+    (500.0, 500.0)
+    >>> now = root.last_check
+    >>> a.charge(250, now), b.charge(250, now)
+    (0.0, 0.0)
+    >>> a.charge(500, now)
+    0.5
+    >>> b.close()
+    >>> a.assured_rate
+    1000.0
+    >>> c = HierarchicalThrottle(100, parent=root, burst=1000)
+    >>> c.charge(1000, now), c.charge(100, now)
+    (0.0, 1.0)
+    >>> d = HierarchicalThrottle(100, parent=root, burst=100)
+    >>> d.admit(100, now), d.admit(1, now), d.cbucket
+    (True, False, 50.0)
+    """
+
+    def __init__(
+        self,
+        rate: Optional[int] = None,
+        parent: Optional["HierarchicalThrottle"] = None,
+        time_window: float = 0.5,
+        burst: int = 0,
+    ):
+        self.rate = rate
+        self.parent = parent
+        self.time_window = time_window
+        self.children: Set[HierarchicalThrottle] = set()
+        self.closed = False
+        if parent is None:
+            self._chain: Tuple[HierarchicalThrottle, ...] = (self,)
+        else:
+            parent.children.add(self)
+            self._chain = (*parent._chain, self)
+        self.cbucket = (rate or 0) * time_window + burst
+        self.bucket = burst if parent else self.cbucket
+        self.last_check = time.monotonic()
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(rate={self.rate}, "
+            f"children={len(self.children)})"
+        )
+
+    @property
+    def assured_rate(self) -> Optional[float]:
+        assured = None
+        for node in self._chain:
+            if assured is not None and node.parent is not None:
+                assured /= len(node.parent.children)
+            if node.rate is not None:
+                assured = node.rate if assured is None else min(assured, node.rate)
+        return None if assured is None else float(assured)
+
+    def update_rate(self, rate: Optional[int]):
+        if rate is not None:
+            limit = rate * self.time_window
+            # a node limited from now on starts with a full ceil bucket
+            self.cbucket = limit if self.rate is None else min(self.cbucket, limit)
+        self.rate = rate
+
+    def _refill(self, now: float, assured: Optional[float]):
+        time_passed = now - self.last_check
+        if time_passed <= 0:
+            return
+        self.last_check = now
+        if self.rate is not None:
+            limit = self.rate * self.time_window
+            if self.cbucket < limit:
+                self.cbucket = min(self.cbucket + time_passed * self.rate, limit)
+        if assured is not None:
+            limit = assured * self.time_window
+            if self.bucket < limit:
+                self.bucket = min(self.bucket + time_passed * assured, limit)
+
+    def charge(self, packets: int, now: float) -> float:
+        """
+        charge ``packets`` bytes to this node and all its ancestors,
+        return the number of seconds to wait before sending more
+        """
+        assured = None
+        delay = 0.0
+        for node in self._chain:
+            if assured is not None and node.parent is not None:
+                assured /= len(node.parent.children)
+            if node.rate is not None:
+                assured = node.rate if assured is None else min(assured, node.rate)
+            node._refill(now, assured)
+            # unlimited buckets run no debt, a rate set later starts afresh
+            if assured is not None:
+                node.bucket -= packets
+            if node.rate is not None:
+                node.cbucket -= packets
+            own_wait = ceil_wait = 0.0
+            if assured and node.bucket < 0:
+                own_wait = -node.bucket / assured
+            if node.rate and node.cbucket < 0:
+                ceil_wait = -node.cbucket / node.rate
+            if node.parent is None:
+                delay = max(own_wait, ceil_wait)
+            else:
+                delay = min(own_wait, max(ceil_wait, delay))
+        return delay
+
+    def admit(self, packets: int, now: float) -> bool:
+        """
+        charge ``packets`` bytes only if they can be sent right away, for
+        datagrams, which are dropped rather than delayed
+        """
+        if self.charge(packets, now) > 0:
+            self.charge(-packets, now)
+            return False
+        return True
+
+    def consume(self, packets: int, event: asyncio.Event):
+        delay = self.charge(packets, time.monotonic())
+        if delay > 0:
+            loop = asyncio.get_running_loop()
+            event.clear()
+            loop.call_later(delay, event.set)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.parent is not None:
+            self.parent.children.discard(self)
+
+
+global_upload = HierarchicalThrottle()
+global_download = HierarchicalThrottle()
+
+
+class Shaper:
+    """
+    Build the throttle hierarchy of an inbound:
+    global -> inbound -> user -> connection
+
+    @param rate: max bytes per second of the whole inbound
+    @param user_rate: max bytes per second of every user
+    @param conn_rate: max bytes per second of every connection
+    @param parent: the global throttle
+    @param burst: bytes every new connection may send before settling
+    @param live: rates may be set later by `update_rates`, so connections get
+        a throttle even while nothing is limited
+    """
+
+    def __init__(
+        self,
+        rate: Optional[int] = None,
+        user_rate: Optional[int] = None,
+        conn_rate: Optional[int] = None,
+        parent: Optional[HierarchicalThrottle] = None,
+        burst: int = 0,
+        live: bool = False,
+    ):
+        self.root = HierarchicalThrottle(rate, parent)
+        self.user_rate = user_rate
+        self.conn_rate = conn_rate
+        self.burst = burst
+        self.live = live
+        self.users: Dict[Any, HierarchicalThrottle] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return (
+            self.live
+            or any(node.rate is not None for node in self.root._chain)
+            or bool(self.user_rate or self.conn_rate)
+        )
+
+    def connection(self, user) -> Optional[HierarchicalThrottle]:
+        "create a connection throttle, return None if nothing is limited"
+        if not self.enabled:
+            return None
+        # the user node exists even without a user rate, for `update_rates`
+        parent = self.users.get(user)
+        if parent is None:
+            parent = HierarchicalThrottle(self.user_rate, self.root)
+            self.users[user] = parent
+        return _ConnectionThrottle(
+            self, user, self.conn_rate, parent, burst=self.burst
+        )
+
+    def release(self, user, node: HierarchicalThrottle):
+        parent = node.parent
+        if not parent.children:
+            parent.close()
+            if self.users.get(user) is parent:
+                del self.users[user]
+
+    def update_rates(self, rate=..., user_rate=..., conn_rate=...):
+        "update rates of the live hierarchy, ``...`` leaves a level unchanged"
+        if rate is not ...:
+            self.root.update_rate(rate)
+        if user_rate is not ...:
+            self.user_rate = user_rate
+            for node in self.users.values():
+                node.update_rate(user_rate)
+        if conn_rate is not ...:
+            self.conn_rate = conn_rate
+            for parent in self.users.values():
+                for node in parent.children:
+                    node.update_rate(conn_rate)
+
+
+class _ConnectionThrottle(HierarchicalThrottle):
+    def __init__(self, shaper: Shaper, user, *args, **kwargs):
+        self.shaper = shaper
+        self.user = user
+        super().__init__(*args, **kwargs)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.shaper.release(self.user, self)
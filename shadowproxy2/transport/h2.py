@@ -0,0 +1,425 @@
+import asyncio
+import hmac
+import ssl
+from typing import Callable, Dict, List, Optional, Tuple
+
+import h2.config
+import h2.connection
+import h2.events
+import h2.exceptions
+from h2.errors import ErrorCodes
+from h2.settings import SettingCodes, Settings
+
+PROTOCOL = "shadowproxy"  # :protocol of the extended CONNECT streams (RFC 8441)
+WINDOW_SIZE = 4 * 1024 * 1024  # flow control window of every stream
+MAX_STREAMS = 256  # concurrent streams a server accepts per connection
+# room for the window of every stream, so the unread data of a paused stream
+# never holds up the others: only stream windows wait for the consumer
+CONNECTION_WINDOW_SIZE = MAX_STREAMS * WINDOW_SIZE
+MAX_CONNECTIONS = 4  # connections a client opens to one server
+WRITE_LIMIT = 256 * 1024  # bytes buffered by a stream before drain waits
+
+
+class H2Stream:
+    """
+    An extended CONNECT stream of a `H2Connection`. It is the writer, shaped
+    like `asyncio.StreamWriter`, and the transport of its ``reader``: the
+    DATA frames read are acknowledged to the peer while the reader is not
+    paused, that is flow control follows the consumer.
+    """
+
+    def __init__(self, connection: "H2Connection", stream_id: int, established: bool):
+        self.connection = connection
+        self.stream_id = stream_id
+        self.established = established  # a client sends nothing before the 200
+        self.reader = asyncio.StreamReader()
+        self.reader.set_transport(self)
+        self.pending = bytearray()
+        self.end_pending = False
+        self.ended = False
+        self.remote_ended = False
+        self.closing = False
+        self.paused = False
+        self.unacked = 0
+        self._drain_waiter = None
+        self._closed = connection.loop.create_future()
+
+    # the reader's transport
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+        if self.unacked:
+            self.connection.acknowledge(self.stream_id, self.unacked)
+            self.unacked = 0
+
+    def _data_received(self, data: bytes, flow_controlled_length: int):
+        if not self.remote_ended:
+            self.reader.feed_data(data)
+        if self.paused:
+            self.unacked += flow_controlled_length
+        else:
+            self.connection.acknowledge(self.stream_id, flow_controlled_length)
+
+    def _response_received(self, status: bytes):
+        if status == b"200":
+            self.established = True
+            self.connection.send_pending(self)
+        else:
+            self._reset(ConnectionRefusedError(f"h2 CONNECT refused: {status!r}"))
+
+    def _remote_end(self):
+        if self.remote_ended:
+            return
+        self.remote_ended = True
+        self.reader.feed_eof()
+        self._maybe_finished()
+
+    def _reset(self, exc: Exception = None):
+        self.ended = self.remote_ended = self.closing = True
+        self.pending.clear()
+        if exc is not None and not self.reader.at_eof():
+            self.reader.set_exception(exc)
+        else:
+            self.reader.feed_eof()
+        self._maybe_finished()
+
+    def _maybe_finished(self):
+        if self.ended and self.remote_ended:
+            self.connection.forget(self)
+            self._wake_drain()
+            if not self._closed.done():
+                self._closed.set_result(None)
+
+    def _wake_drain(self):
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+        self._drain_waiter = None
+
+    # the writer
+    def write(self, data: bytes):
+        if self.end_pending or self.ended:
+            return
+        self.pending += data
+        self.connection.send_pending(self)
+
+    async def drain(self):
+        while len(self.pending) > WRITE_LIMIT and not self.ended:
+            if self._drain_waiter is None:
+                self._drain_waiter = self.connection.loop.create_future()
+            await self._drain_waiter
+        if self.ended and self.pending:
+            raise ConnectionResetError("h2 stream reset")
+        await self.connection.drain()
+
+    def can_write_eof(self) -> bool:
+        return True
+
+    def write_eof(self):
+        if not self.end_pending:
+            self.end_pending = True
+            self.connection.send_pending(self)
+
+    def get_extra_info(self, name, default=None):
+        return self.connection.transport.get_extra_info(name, default)
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    def close(self):
+        "end the stream once the pending data is out, cancel the peer's half"
+        if not self.closing:
+            self.closing = True
+            self.write_eof()
+
+    async def wait_closed(self):
+        await asyncio.shield(self._closed)
+
+
+class H2Connection(asyncio.Protocol):
+    """
+    An HTTP/2 connection carrying extended CONNECT streams. A server passes
+    the reader and writer of every accepted stream to ``on_stream``; a client
+    opens streams with `open_stream`. Frames produced in one loop iteration
+    go out in a single write.
+    """
+
+    def __init__(
+        self,
+        client_side: bool,
+        on_stream: Callable = None,
+        path: str = None,
+        authorization: bytes = None,
+    ):
+        config = h2.config.H2Configuration(client_side=client_side)
+        self.conn = h2.connection.H2Connection(config=config)
+        settings = {
+            SettingCodes.INITIAL_WINDOW_SIZE: WINDOW_SIZE,
+            SettingCodes.MAX_CONCURRENT_STREAMS: MAX_STREAMS,
+        }
+        if not client_side:
+            settings[SettingCodes.ENABLE_CONNECT_PROTOCOL] = 1
+        self.conn.local_settings = Settings(client=client_side, initial_values=settings)
+        self.on_stream = on_stream
+        self.path = path.encode() if path else None
+        self.authorization = authorization
+        self.streams: Dict[int, H2Stream] = {}
+        self.transport = None
+        self.loop = None
+        self.ready = None  # resolved by the first SETTINGS of the peer
+        self.closed = False
+        self._flush_scheduled = False
+        self._write_paused = False
+        self._drain_waiters: List[asyncio.Future] = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        self.ready = self.loop.create_future()
+        self.conn.initiate_connection()
+        self.conn.increment_flow_control_window(CONNECTION_WINDOW_SIZE - 65535)
+        self._flush()
+
+    def has_capacity(self) -> bool:
+        conn = self.conn
+        return (
+            not self.closed
+            and conn.open_outbound_streams < conn.remote_settings.max_concurrent_streams
+        )
+
+    def open_stream(self, authority: str, path: str, headers=()) -> H2Stream:
+        """
+        a new extended CONNECT stream, writable right away: data waits in the
+        stream until the response comes, the setup costs no round trip
+        """
+        stream_id = self.conn.get_next_available_stream_id()
+        stream = self.streams[stream_id] = H2Stream(self, stream_id, False)
+        self.conn.send_headers(
+            stream_id,
+            [
+                (":method", "CONNECT"),
+                (":protocol", PROTOCOL),
+                (":scheme", "https"),
+                (":path", path),
+                (":authority", authority),
+                *headers,
+            ],
+        )
+        self._schedule_flush()
+        return stream
+
+    def data_received(self, data):
+        try:
+            events = self.conn.receive_data(data)
+        except h2.exceptions.ProtocolError:
+            self._flush()
+            self.transport.close()
+            return
+        for event in events:
+            handler = getattr(self, f"_on_{type(event).__name__}", None)
+            if handler is not None:
+                handler(event)
+        self._flush()
+
+    def _on_RequestReceived(self, event):
+        headers = dict(event.headers)
+        if (
+            self.on_stream is None
+            or headers.get(b":method") != b"CONNECT"
+            or headers.get(b":protocol") != PROTOCOL.encode()
+        ):
+            status = b"400"
+        elif self.path is not None and headers.get(b":path") != self.path:
+            status = b"404"
+        elif self.authorization is not None and not hmac.compare_digest(
+            headers.get(b"authorization", b""), self.authorization
+        ):
+            status = b"401"
+        else:
+            status = b"200"
+        if status != b"200":
+            self.conn.send_headers(event.stream_id, [(":status", status)], True)
+            return
+        stream = self.streams[event.stream_id] = H2Stream(self, event.stream_id, True)
+        self.conn.send_headers(event.stream_id, [(":status", "200")])
+        self.on_stream(stream.reader, stream)
+
+    def _on_ResponseReceived(self, event):
+        stream = self.streams.get(event.stream_id)
+        if stream is not None:
+            stream._response_received(dict(event.headers).get(b":status"))
+
+    def _on_DataReceived(self, event):
+        stream = self.streams.get(event.stream_id)
+        if stream is None:
+            self.acknowledge(event.stream_id, event.flow_controlled_length)
+        else:
+            stream._data_received(event.data, event.flow_controlled_length)
+
+    def _on_StreamEnded(self, event):
+        stream = self.streams.get(event.stream_id)
+        if stream is not None:
+            stream._remote_end()
+
+    def _on_StreamReset(self, event):
+        stream = self.streams.get(event.stream_id)
+        if stream is not None:
+            exc = ConnectionResetError(f"h2 stream reset: {event.error_code!r}")
+            stream._reset(exc)
+
+    def _on_WindowUpdated(self, event):
+        if event.stream_id == 0:
+            for stream in list(self.streams.values()):
+                self.send_pending(stream)
+        elif event.stream_id in self.streams:
+            self.send_pending(self.streams[event.stream_id])
+
+    def _on_RemoteSettingsChanged(self, event):
+        if not self.ready.done():
+            self.ready.set_result(None)
+        if SettingCodes.INITIAL_WINDOW_SIZE in event.changed_settings:
+            for stream in list(self.streams.values()):
+                self.send_pending(stream)
+
+    def _on_ConnectionTerminated(self, event):
+        self.transport.close()
+
+    def acknowledge(self, stream_id: int, size: int):
+        self.conn.acknowledge_received_data(size, stream_id)
+        self._schedule_flush()
+
+    def send_pending(self, stream: H2Stream):
+        "send what the flow control windows allow, then the end of the stream"
+        if not stream.established or stream.ended or self.closed:
+            return
+        conn = self.conn
+        stream_id = stream.stream_id
+        try:
+            while stream.pending:
+                size = min(
+                    conn.local_flow_control_window(stream_id),
+                    conn.max_outbound_frame_size,
+                    len(stream.pending),
+                )
+                if size <= 0:
+                    break
+                conn.send_data(stream_id, bytes(stream.pending[:size]))
+                del stream.pending[:size]
+            if stream.end_pending and not stream.pending:
+                conn.end_stream(stream_id)
+                stream.ended = True
+                if stream.closing and not stream.remote_ended:
+                    conn.reset_stream(stream_id, ErrorCodes.CANCEL)
+                    stream.remote_ended = True
+                stream._maybe_finished()
+        except h2.exceptions.StreamClosedError:
+            stream._reset()
+        if len(stream.pending) <= WRITE_LIMIT:
+            stream._wake_drain()
+        self._schedule_flush()
+
+    def forget(self, stream: H2Stream):
+        self.streams.pop(stream.stream_id, None)
+
+    def _schedule_flush(self):
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        data = self.conn.data_to_send()
+        if data and not self.transport.is_closing():
+            self.transport.write(data)
+
+    def pause_writing(self):
+        self._write_paused = True
+
+    def resume_writing(self):
+        self._write_paused = False
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def drain(self):
+        if self._write_paused and not self.closed:
+            waiter = self.loop.create_future()
+            self._drain_waiters.append(waiter)
+            await waiter
+
+    def connection_lost(self, exc):
+        self.closed = True
+        if not self.ready.done():
+            self.ready.set_exception(exc or ConnectionResetError("h2 connection lost"))
+            self.ready.exception()  # retrieved, a client may never await it
+        for stream in list(self.streams.values()):
+            stream._reset(ConnectionResetError("h2 connection lost"))
+        self.resume_writing()
+
+    def close(self):
+        if not self.closed:
+            self.conn.close_connection()
+            self._flush()
+            self.transport.close()
+
+
+class H2Client:
+    """
+    Extended CONNECT streams to one server over at most ``max_connections``
+    long-lived connections: a stream goes to the least busy one, a new
+    connection is opened when all of them are full.
+    """
+
+    def __init__(
+        self,
+        addr: Tuple[str, int],
+        sslcontext: ssl.SSLContext,
+        path: str = "/",
+        headers=(),
+        max_connections: int = MAX_CONNECTIONS,
+    ):
+        self.addr = addr
+        self.sslcontext = sslcontext
+        self.path = path
+        self.headers = [(name.lower(), value) for name, value in headers]
+        self.max_connections = max_connections
+        self.connections: List[H2Connection] = []
+        self.lock = asyncio.Lock()
+
+    def _pick(self) -> Optional[H2Connection]:
+        self.connections = [conn for conn in self.connections if not conn.closed]
+        candidates = [conn for conn in self.connections if conn.has_capacity()]
+        if candidates:
+            return min(candidates, key=lambda conn: len(conn.streams))
+        return None
+
+    async def open_stream(self) -> H2Stream:
+        conn = self._pick()
+        if conn is None:
+            async with self.lock:
+                conn = self._pick()
+                if conn is None:
+                    if len(self.connections) >= self.max_connections:
+                        raise ConnectionError("every h2 connection is full")
+                    conn = await self._connect()
+        authority = f"{self.addr[0]}:{self.addr[1]}"
+        return conn.open_stream(authority, self.path, self.headers)
+
+    async def _connect(self) -> H2Connection:
+        loop = asyncio.get_running_loop()
+        _, conn = await loop.create_connection(
+            lambda: H2Connection(client_side=True), *self.addr, ssl=self.sslcontext
+        )
+        await conn.ready  # the server must allow extended CONNECT first
+        if not conn.conn.remote_settings.enable_connect_protocol:
+            conn.close()
+            raise ConnectionError("h2 server does not allow extended CONNECT")
+        self.connections.append(conn)
+        return conn
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
+        self.connections.clear()
@@ -0,0 +1,580 @@
+import asyncio
+import random
+import socket
+import struct
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Optional, Tuple
+
+CMD_PUSH = 81
+CMD_ACK = 82
+CMD_WASK = 83  # ask for the window of the peer
+CMD_WINS = 84  # tell the peer our window
+ASK_SEND = 1
+ASK_TELL = 2
+RTO_NDL = 30  # ms, minimal rto in no-delay mode
+RTO_MIN = 100
+RTO_DEF = 200
+RTO_MAX = 60000
+THRESH_INIT = 2
+THRESH_MIN = 2
+PROBE_INIT = 7000  # ms to wait before asking a zero window
+PROBE_LIMIT = 120000
+DEAD_LINK = 20  # transmissions of a segment before the link is dead
+MTU = 1400
+HEADER = struct.Struct("<IBBHIIII")  # conv cmd frg wnd ts sn una len
+OVERHEAD = HEADER.size
+MASK = 0xFFFFFFFF
+
+READ_LIMIT = 256 * 1024  # received bytes kept in a reader before the window shrinks
+LINGER = 10.0  # seconds a closed session waits for the end of the peer's stream
+IDLE_TIMEOUT = 600.0  # seconds a session lives without hearing from the peer
+# seconds an accepted session lives without delivering a byte to its reader, a
+# first segment costs nothing to spoof and must not hold a session for long
+HANDSHAKE_TIMEOUT = 10.0
+MAX_SESSIONS = 4096  # sessions a server endpoint accepts
+MAX_ADDR_SESSIONS = 256  # sessions a server endpoint accepts from one address
+CLOSED_LIMIT = 1024  # closed sessions remembered to ignore their late packets
+# a window is sent in one burst, the default socket buffers would drop most of it
+SOCKET_BUFFER = 4 * 1024 * 1024
+
+
+class Segment:
+    __slots__ = ("sn", "ts", "data", "resendts", "rto", "fastack", "xmit")
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.sn = self.ts = self.resendts = self.rto = self.fastack = self.xmit = 0
+
+
+class KCP:
+    r"""
+    The ARQ of KCP (https://github.com/skywind3000/kcp) in stream mode and
+    sans-IO: bytes go in with `send`, packets for the peer come out of
+    ``output``, packets of the peer go in with `input` and the bytes come out
+    of `recv`; `flush` runs every ``interval`` ms. An empty segment marks
+    the end of the stream, see `send_eof`.
+
+    >>> wire = []
+    >>> a, b = KCP(1, wire.append), KCP(1, wire.append)
+    >>> a.send(b"hello"); a.send_eof(); a.flush()
+    >>> b.input(wire.pop()), b.recv(), b.recv(), b.recv()
+    (True, b'hello', b'', None)
+    >>> b.flush(); a.input(wire.pop()), a.waitsnd
+    (True, 0)
+    """
+
+    def __init__(
+        self,
+        conv: int,
+        output: Callable[[bytes], None],
+        nodelay: bool = True,
+        interval: int = 10,
+        resend: int = 2,
+        wnd: int = 1024,
+        mtu: int = MTU,
+    ):
+        self.conv = conv
+        self.output = output
+        self.nodelay = nodelay
+        self.interval = interval
+        self.fastresend = resend
+        self.nocwnd = nodelay  # no congestion window in no-delay mode
+        self.mtu = mtu
+        self.mss = mtu - OVERHEAD
+        self.snd_wnd = self.rcv_wnd = self.rmt_wnd = min(wnd, 0xFFFF)
+        self.snd_una = self.snd_nxt = self.rcv_nxt = 0
+        self.cwnd = 1
+        self.incr = self.mss
+        self.ssthresh = THRESH_INIT
+        self.rx_srtt = self.rx_rttval = 0
+        self.rx_rto = RTO_DEF
+        self.rx_minrto = RTO_NDL if nodelay else RTO_MIN
+        self.current = 0  # ms, set by the driver before `input` and `flush`
+        self.probe = self.ts_probe = self.probe_wait = 0
+        self.snd_queue = deque()
+        self.snd_buf: "OrderedDict[int, Segment]" = OrderedDict()
+        self.rcv_queue = deque()
+        self.rcv_buf: Dict[int, bytes] = {}
+        self.acklist = []
+        self.dead = False
+
+    @property
+    def waitsnd(self) -> int:
+        "segments not acknowledged yet"
+        return len(self.snd_buf) + len(self.snd_queue)
+
+    @property
+    def idle(self) -> bool:
+        "whether `flush` has nothing to send: no ack, probe or segment"
+        return not (
+            self.acklist
+            or self.snd_queue
+            or self.snd_buf
+            or self.probe
+            or self.rmt_wnd == 0
+        )
+
+    def send(self, data: bytes):
+        if not data:
+            return
+        mss = self.mss
+        if self.snd_queue:  # stream mode, fill up the last segment first
+            last = self.snd_queue[-1]
+            room = mss - len(last.data)
+            if room > 0 and last.data:
+                last.data += data[:room]
+                data = data[room:]
+        for i in range(0, len(data), mss):
+            self.snd_queue.append(Segment(bytes(data[i : i + mss])))
+
+    def send_eof(self):
+        self.snd_queue.append(Segment(b""))
+
+    def recv(self) -> Optional[bytes]:
+        "the next received bytes in order, b'' at the end of stream or None"
+        if not self.rcv_queue:
+            return None
+        full = len(self.rcv_queue) >= self.rcv_wnd
+        data = self.rcv_queue.popleft()
+        self._move_rcv()
+        if full and len(self.rcv_queue) < self.rcv_wnd:
+            self.probe |= ASK_TELL  # tell the peer the window is open again
+        return data
+
+    def _move_rcv(self):
+        rcv_buf = self.rcv_buf
+        while self.rcv_nxt in rcv_buf and len(self.rcv_queue) < self.rcv_wnd:
+            self.rcv_queue.append(rcv_buf.pop(self.rcv_nxt))
+            self.rcv_nxt += 1
+
+    def _wnd_unused(self) -> int:
+        return max(self.rcv_wnd - len(self.rcv_queue), 0)
+
+    def input(self, data: bytes) -> bool:
+        "feed a packet of the peer, False if it is not a kcp packet of ours"
+        prev_una = self.snd_una
+        maxack = None
+        maxack_ts = 0
+        offset, size = 0, len(data)
+        while size - offset >= OVERHEAD:
+            conv, cmd, _, wnd, ts, sn, una, length = HEADER.unpack_from(data, offset)
+            offset += OVERHEAD
+            if conv != self.conv or size - offset < length:
+                return False
+            self.rmt_wnd = wnd
+            self._parse_una(una)
+            if cmd == CMD_ACK:
+                rtt = ((self.current & MASK) - ts) & MASK
+                if rtt < 0x80000000:
+                    self._update_ack(rtt)
+                if self.snd_una <= sn < self.snd_nxt:
+                    self.snd_buf.pop(sn, None)
+                self._shrink_buf()
+                if maxack is None or sn > maxack:
+                    maxack, maxack_ts = sn, ts
+            elif cmd == CMD_PUSH:
+                if sn < self.rcv_nxt + self.rcv_wnd:
+                    self.acklist.append((sn, ts))
+                    if sn >= self.rcv_nxt and sn not in self.rcv_buf:
+                        self.rcv_buf[sn] = bytes(data[offset : offset + length])
+                        self._move_rcv()
+            elif cmd == CMD_WASK:
+                self.probe |= ASK_TELL
+            elif cmd != CMD_WINS:
+                return False
+            offset += length
+        if maxack is not None:
+            self._parse_fastack(maxack, maxack_ts)
+        if self.snd_una > prev_una and self.cwnd < self.rmt_wnd:
+            self._grow_cwnd()
+        return True
+
+    def _parse_una(self, una: int):
+        snd_buf = self.snd_buf
+        while snd_buf:
+            sn = next(iter(snd_buf))
+            if sn >= una:
+                break
+            del snd_buf[sn]
+        self._shrink_buf()
+
+    def _shrink_buf(self):
+        self.snd_una = next(iter(self.snd_buf)) if self.snd_buf else self.snd_nxt
+
+    def _parse_fastack(self, maxack: int, ts: int):
+        for sn, seg in self.snd_buf.items():
+            if sn >= maxack:
+                break
+            if (ts - seg.ts) & MASK < 0x80000000:
+                seg.fastack += 1
+
+    def _update_ack(self, rtt: int):
+        if self.rx_srtt == 0:
+            self.rx_srtt = rtt
+            self.rx_rttval = rtt // 2
+        else:
+            delta = abs(rtt - self.rx_srtt)
+            self.rx_rttval = (3 * self.rx_rttval + delta) // 4
+            self.rx_srtt = max((7 * self.rx_srtt + rtt) // 8, 1)
+        rto = self.rx_srtt + max(self.interval, 4 * self.rx_rttval)
+        self.rx_rto = min(max(self.rx_minrto, rto), RTO_MAX)
+
+    def _grow_cwnd(self):
+        mss = self.mss
+        if self.cwnd < self.ssthresh:
+            self.cwnd += 1
+            self.incr += mss
+        else:
+            self.incr = max(self.incr, mss)
+            self.incr += (mss * mss) // self.incr + mss // 16
+            if (self.cwnd + 1) * mss <= self.incr:
+                self.cwnd = (self.incr + mss - 1) // mss
+        if self.cwnd > self.rmt_wnd:
+            self.cwnd = self.rmt_wnd
+            self.incr = self.rmt_wnd * mss
+
+    def flush(self):
+        "send acks, window probes, new and timed out or fast retransmitted segments"
+        current = self.current
+        ts_now = current & MASK
+        conv, mtu, pack = self.conv, self.mtu, HEADER.pack
+        wnd = self._wnd_unused()
+        una = self.rcv_nxt & MASK
+        buf = bytearray()
+
+        for sn, ts in self.acklist:
+            if len(buf) + OVERHEAD > mtu:
+                self.output(bytes(buf))
+                buf.clear()
+            buf += pack(conv, CMD_ACK, 0, wnd, ts, sn, una, 0)
+        self.acklist.clear()
+
+        if self.rmt_wnd == 0:
+            if self.probe_wait == 0:
+                self.probe_wait = PROBE_INIT
+                self.ts_probe = current + self.probe_wait
+            elif current >= self.ts_probe:
+                self.probe_wait = min(self.probe_wait * 3 // 2, PROBE_LIMIT)
+                self.ts_probe = current + self.probe_wait
+                self.probe |= ASK_SEND
+        else:
+            self.ts_probe = self.probe_wait = 0
+        for flag, cmd in ((ASK_SEND, CMD_WASK), (ASK_TELL, CMD_WINS)):
+            if self.probe & flag:
+                if len(buf) + OVERHEAD > mtu:
+                    self.output(bytes(buf))
+                    buf.clear()
+                buf += pack(conv, cmd, 0, wnd, ts_now, 0, una, 0)
+        self.probe = 0
+
+        cwnd = min(self.snd_wnd, self.rmt_wnd)
+        if not self.nocwnd:
+            cwnd = min(self.cwnd, cwnd)
+        while self.snd_queue and self.snd_nxt < self.snd_una + cwnd:
+            seg = self.snd_queue.popleft()
+            seg.sn = self.snd_nxt
+            self.snd_nxt += 1
+            self.snd_buf[seg.sn] = seg
+
+        resent = self.fastresend if self.fastresend > 0 else MASK
+        rtomin = 0 if self.nodelay else self.rx_rto >> 3
+        change = lost = False
+        for seg in self.snd_buf.values():
+            if seg.xmit == 0:
+                seg.rto = self.rx_rto
+                seg.resendts = current + seg.rto + rtomin
+            elif current >= seg.resendts:
+                if self.nodelay:
+                    seg.rto += seg.rto // 2
+                else:
+                    seg.rto += max(seg.rto, self.rx_rto)
+                seg.resendts = current + seg.rto
+                lost = True
+            elif seg.fastack >= resent:
+                seg.fastack = 0
+                seg.resendts = current + seg.rto
+                change = True
+            else:
+                continue
+            seg.xmit += 1
+            seg.ts = ts_now
+            data = seg.data
+            if len(buf) + OVERHEAD + len(data) > mtu:
+                self.output(bytes(buf))
+                buf.clear()
+            buf += pack(conv, CMD_PUSH, 0, wnd, ts_now, seg.sn & MASK, una, len(data))
+            buf += data
+            if seg.xmit >= DEAD_LINK:
+                self.dead = True
+        if buf:
+            self.output(bytes(buf))
+
+        if change:
+            inflight = self.snd_nxt - self.snd_una
+            self.ssthresh = max(inflight // 2, THRESH_MIN)
+            self.cwnd = self.ssthresh + resent
+            self.incr = self.cwnd * self.mss
+        if lost:
+            self.ssthresh = max(cwnd // 2, THRESH_MIN)
+            self.cwnd = 1
+            self.incr = self.mss
+
+
+class KCPSession:
+    """
+    A kcp session of a `KCPEndpoint`: its ``reader`` is a StreamReader and
+    the session itself is the writer, shaped like `asyncio.StreamWriter` so
+    every parser runs on it unchanged.
+    """
+
+    def __init__(
+        self,
+        endpoint: "KCPEndpoint",
+        addr,
+        conv: int,
+        options: dict,
+        accepted: bool = False,
+    ):
+        self.endpoint = endpoint
+        self.addr = addr
+        self.kcp = KCP(conv, self._output, **options)
+        self.kcp.current = endpoint.now()
+        self.reader = asyncio.StreamReader()
+        self.last_recv = self.started = self.kcp.current
+        self.accepted = accepted  # opened by the peer
+        self.delivered = False  # whether the reader got any bytes
+        self.closing = False
+        self.eof_received = False
+        self.eof_written = False
+        self._flush_scheduled = False
+        self._drain_waiter = None
+        self._closed = endpoint.loop.create_future()
+
+    def _output(self, packet: bytes):
+        self.endpoint.transport.sendto(packet, self.addr)
+
+    def datagram_received(self, data: bytes):
+        kcp = self.kcp
+        kcp.current = self.endpoint.now()
+        if kcp.input(data):
+            self.last_recv = kcp.current
+            self._deliver()
+
+    def _deliver(self):
+        reader = self.reader
+        while not self.eof_received and len(reader._buffer) < READ_LIMIT:
+            data = self.kcp.recv()
+            if data is None:
+                break
+            if data:
+                reader.feed_data(data)
+                self.delivered = True
+            else:
+                self.eof_received = True
+                reader.feed_eof()
+
+    def tick(self, now: int) -> bool:
+        "one `KCP.flush` interval, False once the session is over"
+        kcp = self.kcp
+        if kcp.rcv_queue:
+            self._deliver()
+        if not kcp.idle:
+            kcp.current = now
+            kcp.flush()
+        if self._drain_waiter is not None and (
+            kcp.waitsnd < 2 * kcp.snd_wnd or kcp.dead
+        ):
+            self._wake_drain()
+        if kcp.dead:
+            self._finish()
+            return False
+        if self.closing and kcp.waitsnd == 0:
+            if not self._closed.done():
+                self._closed.set_result(None)
+            if self.eof_received or now - self.last_recv > LINGER * 1000:
+                self._finish()
+                return False
+        elif now - self.last_recv > IDLE_TIMEOUT * 1000 or (
+            self.accepted
+            and not self.delivered
+            and now - self.started > HANDSHAKE_TIMEOUT * 1000
+        ):
+            self._finish()
+            return False
+        return True
+
+    def _finish(self):
+        self.closing = True
+        if not self.eof_received:
+            self.eof_received = True
+            self.reader.feed_eof()
+        self._wake_drain()
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    def _wake_drain(self):
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+        self._drain_waiter = None
+
+    def _schedule_flush(self):
+        # writes of one loop iteration go out together, before the next tick
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.endpoint.loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if not self.kcp.dead:
+            self.kcp.current = self.endpoint.now()
+            self.kcp.flush()
+
+    def write(self, data: bytes):
+        if self.eof_written or self.kcp.dead:
+            return
+        self.kcp.send(data)
+        self._schedule_flush()
+
+    async def drain(self):
+        kcp = self.kcp
+        while kcp.waitsnd >= 2 * kcp.snd_wnd and not kcp.dead:
+            if self._drain_waiter is None:
+                self._drain_waiter = self.endpoint.loop.create_future()
+            await self._drain_waiter
+        if kcp.dead:
+            raise ConnectionResetError("kcp link is dead")
+
+    def can_write_eof(self) -> bool:
+        return True
+
+    def write_eof(self):
+        if not self.eof_written:
+            self.eof_written = True
+            self.kcp.send_eof()
+            self._schedule_flush()
+
+    def get_extra_info(self, name, default=None):
+        if name == "peername":
+            return self.addr
+        return self.endpoint.transport.get_extra_info(name, default)
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    def close(self):
+        if not self.closing:
+            self.closing = True
+            self.write_eof()
+
+    async def wait_closed(self):
+        await asyncio.shield(self._closed)
+
+
+class KCPEndpoint(asyncio.DatagramProtocol):
+    """
+    One udp socket carrying kcp sessions told apart by peer address and
+    conv. A server creates a session for the first segment of every new
+    conv, up to ``MAX_SESSIONS`` and ``MAX_ADDR_SESSIONS`` per address, and
+    hands its reader and writer to ``on_stream``; a client opens sessions to
+    ``remote_addr`` with `open_stream`. A single timer flushes every session
+    with something to send each ``interval`` ms while there are any.
+    """
+
+    def __init__(
+        self,
+        options: dict,
+        on_stream: Callable = None,
+        remote_addr: Tuple[str, int] = None,
+    ):
+        self.options = options
+        self.interval = options.get("interval", 10)
+        self.on_stream = on_stream
+        self.remote_addr = remote_addr
+        self.sessions: Dict[Tuple, KCPSession] = {}
+        self.addr_sessions: Dict[Tuple, int] = {}  # accepted sessions per address
+        self.closed: OrderedDict = OrderedDict()
+        self.transport = None
+        self.loop = None
+        self._handle = None
+
+    def now(self) -> int:
+        return int(self.loop.time() * 1000)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        sock = transport.get_extra_info("socket")
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+            except OSError:
+                pass  # capped by net.core.rmem_max / wmem_max
+
+    def _add_session(self, addr, conv: int, accepted: bool = False) -> KCPSession:
+        session = KCPSession(self, addr, conv, self.options, accepted)
+        self.sessions[(addr, conv)] = session
+        if accepted:
+            self.addr_sessions[addr] = self.addr_sessions.get(addr, 0) + 1
+        if self._handle is None:
+            self._handle = self.loop.call_later(self.interval / 1000, self._tick)
+        return session
+
+    def datagram_received(self, data, addr):
+        if len(data) < OVERHEAD:
+            return
+        addr = addr[:2]
+        conv = int.from_bytes(data[:4], "little")
+        session = self.sessions.get((addr, conv))
+        if session is None:
+            # only the first segment of a new conv opens a session
+            if (
+                self.on_stream is None
+                or (addr, conv) in self.closed
+                or data[4] != CMD_PUSH
+                or data[12:16] != b"\x00\x00\x00\x00"
+                or len(self.sessions) >= MAX_SESSIONS
+                or self.addr_sessions.get(addr, 0) >= MAX_ADDR_SESSIONS
+            ):
+                return
+            session = self._add_session(addr, conv, accepted=True)
+            self.on_stream(session.reader, session)
+        session.datagram_received(data)
+
+    def open_stream(self):
+        "reader and writer of a new session to ``remote_addr``"
+        while True:
+            conv = random.getrandbits(32)
+            if (self.remote_addr, conv) not in self.sessions:
+                break
+        session = self._add_session(self.remote_addr, conv)
+        return session.reader, session
+
+    def _tick(self):
+        now = self.now()
+        for key, session in list(self.sessions.items()):
+            if not session.tick(now):
+                del self.sessions[key]
+                if session.accepted:
+                    count = self.addr_sessions.pop(session.addr) - 1
+                    if count:
+                        self.addr_sessions[session.addr] = count
+                self.closed[key] = None
+                if len(self.closed) > CLOSED_LIMIT:
+                    self.closed.popitem(last=False)
+        if self.sessions:
+            self._handle = self.loop.call_later(self.interval / 1000, self._tick)
+        else:
+            self._handle = None
+
+    def error_received(self, exc):
+        pass  # icmp errors, lost segments are retransmitted anyway
+
+    def connection_lost(self, exc):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        for session in self.sessions.values():
+            session.kcp.dead = True
+            session._finish()
+        self.sessions.clear()
+        self.addr_sessions.clear()
@@ -1,21 +1,139 @@
 import asyncio
-from websockets import ConnectionClosedOK
+import hmac
+from http import HTTPStatus
+from urllib.parse import urlsplit
+
+from websockets import ConnectionClosedOK, InvalidHeader, WebSocketServerProtocol
+from websockets.headers import build_www_authenticate_basic, parse_authorization_basic
+
+FRAME_SIZE = 64 * 1024  # coalesced writes go out in frames up to this size
+FLUSH_DELAY = 0  # seconds a small write waits for more, 0: till the loop iterates
+
+
+class ProtocolError(Exception):
+    ...
+
+
+async def recv_bytes(ws) -> bytes:
+    "the next message, the tunnel carries bytes so a text message is refused"
+    data = await ws.recv()
+    if isinstance(data, str):
+        raise ProtocolError("text message received")
+    return data
+
+
+class RoutingServerProtocol(WebSocketServerProtocol):
+    """
+    The server side of a websocket listener shared by several inbounds:
+    ``routes`` maps a request path to the `ProxyContext` of the inbound with
+    that path, ``None`` to the one without a path, which takes the rest.
+    Basic auth and permessage-deflate follow the routed inbound.
+    """
+
+    ctx = None
+
+    def __init__(self, *args, routes, **kwargs):
+        self.routes = routes
+        super().__init__(*args, **kwargs)
+
+    async def process_request(self, path, request_headers):
+        self.ctx = self.routes.get(urlsplit(path).path, self.routes.get(None))
+        credentials = self.ctx and self.ctx.inbound_ns.credentials
+        if credentials:
+            try:
+                authorization = parse_authorization_basic(
+                    request_headers["Authorization"]
+                )
+            except (KeyError, InvalidHeader):
+                authorization = ("", "")
+            if not hmac.compare_digest(
+                ":".join(authorization).encode(), ":".join(credentials).encode()
+            ):
+                return (
+                    HTTPStatus.UNAUTHORIZED,
+                    [("WWW-Authenticate", build_www_authenticate_basic("realm"))],
+                    b"Invalid credentials\n",
+                )
+        response = await super().process_request(path, request_headers)
+        if response is None and self.ctx is None:
+            return HTTPStatus.NOT_FOUND, [], b"No such path\n"
+        return response
+
+    def process_extensions(self, headers, available_extensions):
+        if not self.ctx.inbound_ns.deflate:
+            available_extensions = None
+        return super().process_extensions(headers, available_extensions)
 
 
 class WebsocketWriter:
+    """
+    Writes are buffered and sent as one frame once ``FRAME_SIZE`` bytes are
+    pending or ``FLUSH_DELAY`` has passed, instead of a frame, a mask and a
+    syscall for every relayed chunk; writes made while a frame is being sent
+    join the next one. A write that fills a frame returns
+    `drain`, so callers awaiting writes get back pressure.
+    """
+
     def __init__(self, ws):
         self.ws = ws
+        self.buffer = bytearray()
+        self._flush_handle = None
+        self._sender = None
+        self._error = None  # why sending failed, raised by drain
+
+    def write(self, data):
+        if self._error is not None:
+            return
+        self.buffer += data
+        if len(self.buffer) >= FRAME_SIZE:
+            self._flush()
+            return self.drain()
+        if self._flush_handle is None and self._sender is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(FLUSH_DELAY, self._flush)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._sender is None and self.buffer:
+            self._sender = asyncio.ensure_future(self._send())
+
+    async def _send(self):
+        "send the buffer until it is empty, what is written meanwhile included"
+        try:
+            while self.buffer:
+                data = bytes(self.buffer[:FRAME_SIZE])
+                del self.buffer[:FRAME_SIZE]
+                await self.ws.send(data)
+        except Exception as e:
+            self._error = e
+            self.buffer.clear()
+        finally:
+            self._sender = None
 
-    async def write(self, data):
-        await self.ws.send(data)
+    async def drain(self):
+        "wait till less than a frame is pending, writes made meanwhile included"
+        while len(self.buffer) >= FRAME_SIZE and self._error is None:
+            if self._sender is None:
+                self._flush()
+            await asyncio.shield(self._sender)
+        if self._error is not None:
+            raise self._error
 
     def can_write_eof(self):
         return False
 
+    def get_extra_info(self, name, default=None):
+        return self.ws.transport.get_extra_info(name, default)
+
     def is_closing(self):
         return self.ws.closed
 
     async def close(self):
+        self._flush()
+        if self._sender is not None:
+            await asyncio.shield(self._sender)
         await self.ws.close()
 
     async def wait_closed(self):
@@ -23,6 +141,8 @@ class WebsocketWriter:
 
 
 class WebsocketReader(asyncio.StreamReader):
+    direct = True  # False once a parser needs every message through feed_data
+
     def __init__(self, ws):
         super().__init__()
         self.ws = ws
@@ -30,6 +150,25 @@ class WebsocketReader(asyncio.StreamReader):
     def __repr__(self):
         return "<WebsocketReader>"
 
+    async def read(self, n=-1):
+        """
+        hand a received message over as it is when nothing is buffered,
+        unless the reader is not `direct`
+        """
+        if self._buffer or self._eof or n == 0 or not self.direct:
+            return await super().read(n)
+        if self._exception is not None:
+            raise self._exception
+        try:
+            data = await recv_bytes(self.ws)
+        except ConnectionClosedOK:
+            self.feed_eof()
+            return b""
+        if 0 < n < len(data):
+            self.feed_data(data[n:])
+            return data[:n]
+        return data
+
     async def _wait_for_data(self, func_name):
         """Wait until feed_data() or feed_eof() is called.
 
@@ -55,7 +194,7 @@ class WebsocketReader(asyncio.StreamReader):
 
         while not self._buffer and not self._eof:
             try:
-                data = await self.ws.recv()
+                data = await recv_bytes(self.ws)
             except ConnectionClosedOK:
                 self.feed_eof()
             else:
@@ -0,0 +1,438 @@
+import asyncio
+import socket
+import time
+from collections import OrderedDict
+from functools import lru_cache, partial
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .aiobuffer.socks5 import Addr, UDPRelay
+
+UDP_TIMEOUT = 60.0  # seconds a udp session lives without traffic
+SESSION_LIMIT = 4096  # udp sessions of a relay, the least recently used go first
+RESOLVED_LIMIT = 1024  # hosts remembered by a datagram client
+BACKLOG_LIMIT = 256  # datagrams waiting for a socket or a name, more are dropped
+Address = Tuple[str, int]
+
+
+class NATTable:
+    """
+    udp sessions ordered by their last use, a single timer closes the ones
+    idle for ``timeout`` seconds, oldest first; beyond ``maxsize`` sessions
+    the least recently used one is closed
+
+    >>> closed = []
+    >>> table = NATTable(10, closed.append, maxsize=2)
+    >>> table.put("a", "A", now=0)
+    >>> table.put("b", "B", now=5)
+    >>> table.get("a", now=6)
+    'A'
+    >>> table.expire(now=15.5)
+    >>> closed, len(table)
+    (['B'], 1)
+    >>> table.put("c", "C", now=16)
+    >>> table.put("d", "D", now=17)
+    >>> closed, list(table.entries)
+    (['B', 'A'], ['c', 'd'])
+    """
+
+    def __init__(
+        self,
+        timeout: float,
+        on_expire: Callable,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+        maxsize: int = None,
+    ):
+        self.timeout = timeout
+        self.on_expire = on_expire
+        self.loop = loop
+        self.maxsize = maxsize
+        self.entries: OrderedDict = OrderedDict()
+        self._handle = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, now: float = None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        self.entries[key] = (time.monotonic() if now is None else now, entry[1])
+        return entry[1]
+
+    def put(self, key, value, now: float = None):
+        self.entries[key] = (time.monotonic() if now is None else now, value)
+        self.entries.move_to_end(key)
+        if self.maxsize is not None and len(self.entries) > self.maxsize:
+            self.on_expire(self.entries.popitem(last=False)[1][1])
+        if self._handle is None and self.loop is not None:
+            self._handle = self.loop.call_later(self.timeout, self._tick)
+
+    def expire(self, now: float = None):
+        deadline = (time.monotonic() if now is None else now) - self.timeout
+        entries = self.entries
+        while entries:
+            key = next(iter(entries))
+            used_at, value = entries[key]
+            if used_at > deadline:
+                break
+            del entries[key]
+            self.on_expire(value)
+
+    def _tick(self):
+        self._handle = None
+        self.expire()
+        if self.entries:
+            used_at = next(iter(self.entries.values()))[0]
+            delay = max(used_at + self.timeout - time.monotonic(), 0)
+            self._handle = self.loop.call_later(delay, self._tick)
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        entries, self.entries = self.entries, OrderedDict()
+        for _, value in entries.values():
+            self.on_expire(value)
+
+
+def _dual_stack_socket() -> socket.socket:
+    try:
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        sock.bind(("::", 0))
+    except OSError:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("0.0.0.0", 0))
+    sock.setblocking(False)
+    return sock
+
+
+def _is_ip(host: str) -> bool:
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+        except OSError:
+            continue
+        return True
+    return False
+
+
+@lru_cache(maxsize=4096)
+def packed_addr(addr: Address) -> bytes:
+    return Addr.from_tuple(addr).binary
+
+
+@lru_cache(maxsize=4096)
+def relay_header(addr: Address) -> bytes:
+    "the socks5 udp header of a datagram from ``addr``"
+    return b"\x00\x00\x00" + packed_addr(addr)
+
+
+class DirectClient(asyncio.DatagramProtocol):
+    """
+    Send datagrams straight to their targets from one local udp socket,
+    ``on_received(data, addr)`` is called with every datagram coming back.
+    Domain names are resolved once, datagrams sent before the socket or the
+    name is ready wait in a backlog; ``is_allowed(host)`` is checked once
+    per host.
+    """
+
+    def __init__(
+        self,
+        on_received: Callable[[bytes, Address], None],
+        is_allowed: Callable[[str], bool] = lambda host: True,
+    ):
+        self.on_received = on_received
+        self.is_allowed = is_allowed
+        self.transport = None
+        self.family = socket.AF_INET6
+        self.resolved: Dict[str, Optional[str]] = {}
+        self.backlog: List[Tuple[bytes, Address]] = []
+        self._tasks = set()
+        self.closed = False
+
+    def open(self) -> "DirectClient":
+        loop = asyncio.get_running_loop()
+        sock = _dual_stack_socket()
+        self.family = sock.family
+        self._spawn(loop.create_datagram_endpoint(lambda: self, sock=sock))
+        return self
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.closed:
+            transport.close()
+            return
+        backlog, self.backlog = self.backlog, []
+        for data, addr in backlog:
+            self.sendto(data, addr)
+
+    def datagram_received(self, data, addr):
+        host = addr[0]
+        if host.startswith("::ffff:") and "." in host:
+            host = host[7:]
+        self.on_received(data, (host, addr[1]))
+
+    def error_received(self, exc):
+        pass  # icmp errors of earlier datagrams, nothing to do with udp
+
+    def sendto(self, data: bytes, addr: Address):
+        "send a raw datagram to ``addr``"
+        host, port = addr
+        ip = self.resolved.get(host, "")  # "" while resolving, None if blocked
+        if ip and self.transport is not None:
+            self.transport.sendto(data, (ip, port))
+            return
+        if ip is None or len(self.backlog) >= BACKLOG_LIMIT:
+            return
+        self.backlog.append((data, addr))
+        if host not in self.resolved:
+            if len(self.resolved) >= RESOLVED_LIMIT:
+                self.resolved.clear()
+            self.resolved[host] = ""
+            self._spawn(self._resolve(host, port))
+
+    send = sendto
+
+    async def _resolve(self, host: str, port: int):
+        ip = None
+        if self.is_allowed(host):
+            if _is_ip(host):
+                ip = host
+            else:
+                loop = asyncio.get_running_loop()
+                try:
+                    infos = await loop.getaddrinfo(host, port, type=socket.SOCK_DGRAM)
+                except OSError:
+                    infos = []
+                for family, *_, sockaddr in infos:
+                    if family == socket.AF_INET or self.family == socket.AF_INET6:
+                        ip = sockaddr[0]
+                        break
+            if ip is not None and self.family == socket.AF_INET6 and "." in ip:
+                ip = "::ffff:" + ip
+        self.resolved[host] = ip
+        if self.transport is None:
+            return  # the backlog goes out in `connection_made`
+        backlog, self.backlog = self.backlog, []
+        for data, addr in backlog:
+            self.sendto(data, addr)
+
+    def close(self):
+        self.closed = True
+        if self.transport is not None:
+            self.transport.close()
+        for task in list(self._tasks):
+            task.cancel()
+
+
+class SSClient(DirectClient):
+    """
+    Send datagrams through a shadowsocks server: each one is sealed on its
+    own, behind the address of its target.
+    """
+
+    def __init__(
+        self,
+        on_received: Callable[[bytes, Address], None],
+        cipher,
+        server_addr: Address,
+    ):
+        super().__init__(on_received)
+        self.cipher = cipher
+        self.server_addr = server_addr
+
+    def datagram_received(self, data, addr):
+        try:
+            plaintext = self.cipher.decrypt_packet(data)
+            source, offset = Addr.parse_from(plaintext)
+        except Exception:
+            return
+        self.on_received(plaintext[offset:], (source.host, source.port))
+
+    def send(self, data: bytes, addr: Address):
+        packet = self.cipher.encrypt_packet(packed_addr(addr) + data)
+        self.sendto(packet, self.server_addr)
+
+
+class DatagramMeter:
+    """
+    The traffic counters and throttles of a udp session, set like the ones
+    of a connection, see `Accounting` and `Shaper`. A datagram its throttle
+    has no room for is dropped rather than delayed, and is not counted; a
+    closed meter, over quota for example, drops everything.
+
+    >>> from .accounting import Counter
+    >>> meter = DatagramMeter()
+    >>> meter.upload = Counter()
+    >>> meter.admit_upload(100), meter.admit_download(100), meter.upload.nbytes
+    (True, True, 100)
+    >>> meter.close()
+    >>> meter.admit_upload(100)
+    False
+    """
+
+    __slots__ = (
+        "upload",
+        "download",
+        "upload_throttle",
+        "download_throttle",
+        "closed",
+        "__weakref__",
+    )
+
+    def __init__(self):
+        self.upload = self.download = None
+        self.upload_throttle = self.download_throttle = None
+        self.closed = False
+
+    @staticmethod
+    def _admit(counter, throttle, nbytes: int) -> bool:
+        if throttle is not None and not throttle.admit(nbytes, time.monotonic()):
+            return False
+        if counter is not None:
+            counter.nbytes += nbytes
+        return True
+
+    def admit_upload(self, nbytes: int) -> bool:
+        "whether a datagram of ``nbytes`` from the client may go on"
+        return not self.closed and self._admit(
+            self.upload, self.upload_throttle, nbytes
+        )
+
+    def admit_download(self, nbytes: int) -> bool:
+        "whether a datagram of ``nbytes`` to the client may go on"
+        return not self.closed and self._admit(
+            self.download, self.download_throttle, nbytes
+        )
+
+    def close(self):
+        self.closed = True
+        for throttle in (self.upload_throttle, self.download_throttle):
+            if throttle is not None:
+                throttle.close()
+
+
+class DatagramRelay(asyncio.DatagramProtocol):
+    """
+    The client facing socket of a udp relay. Every client address gets a
+    datagram client from ``create_client`` and a `DatagramMeter` from
+    ``create_meter``, if given, kept in a `NATTable`; ``create_meter`` may
+    raise to refuse the address. Datagrams are relayed synchronously as they
+    arrive, there is no task per datagram. Subclasses tell how a target is
+    wrapped around the payload.
+    """
+
+    def __init__(
+        self,
+        create_client: Callable,
+        timeout: float = UDP_TIMEOUT,
+        maxsize: int = SESSION_LIMIT,
+        create_meter: Callable[[Address], DatagramMeter] = None,
+    ):
+        self.create_client = create_client
+        self.create_meter = create_meter
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.transport = None
+        self.nat = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.nat = NATTable(
+            self.timeout,
+            self._close_session,
+            asyncio.get_running_loop(),
+            self.maxsize,
+        )
+
+    @staticmethod
+    def _close_session(session):
+        client, meter = session
+        client.close()
+        if meter is not None:
+            meter.close()
+
+    def unpack(self, data: bytes, addr: Address) -> Tuple[bytes, Address]:
+        "the payload and target of a datagram from the client, or None to drop it"
+        raise NotImplementedError
+
+    def pack(self, data: bytes, from_addr: Address) -> bytes:
+        "the datagram telling the client about ``data`` from ``from_addr``"
+        raise NotImplementedError
+
+    def datagram_received(self, data, addr):
+        try:
+            unpacked = self.unpack(data, addr)
+        except Exception:
+            return
+        if unpacked is None:
+            return
+        session = self.nat.get(addr)
+        if session is None:
+            meter = None
+            if self.create_meter is not None:
+                try:
+                    meter = self.create_meter(addr)
+                except Exception:
+                    return
+            client = self.create_client(partial(self.reply, addr, meter))
+            session = (client, meter)
+            self.nat.put(addr, session)
+        client, meter = session
+        payload, target_addr = unpacked
+        if meter is None or meter.admit_upload(len(payload)):
+            client.send(payload, target_addr)
+
+    def reply(self, client_addr: Address, meter, data: bytes, from_addr: Address):
+        if self.transport.is_closing():
+            return
+        if meter is None or meter.admit_download(len(data)):
+            self.transport.sendto(self.pack(data, from_addr), client_addr)
+
+    def connection_lost(self, exc):
+        self.nat.close()
+
+
+class Socks5UDPRelay(DatagramRelay):
+    "the udp socket of a socks5 UDP ASSOCIATE, only the client host may use it"
+
+    def __init__(self, create_client: Callable, client_host: str, **kwargs):
+        super().__init__(create_client, **kwargs)
+        self.client_host = client_host
+
+    def unpack(self, data, addr):
+        if addr[0] != self.client_host:
+            return None
+        relay, _ = UDPRelay.parse_from(data)
+        if relay.flag:
+            return None  # fragmentation is not supported
+        return relay.data, (relay.addr.host, relay.addr.port)
+
+    def pack(self, data, from_addr):
+        return relay_header(from_addr) + data
+
+
+class SSUDPRelay(DatagramRelay):
+    """
+    udp inbound of shadowsocks, every packet is a fresh salt and the sealed
+    target address and payload; packets failing to decrypt are dropped
+    """
+
+    def __init__(self, cipher, create_client: Callable, **kwargs):
+        super().__init__(create_client, **kwargs)
+        self.cipher = cipher
+
+    def unpack(self, data, addr):
+        plaintext = self.cipher.decrypt_packet(data)
+        target, offset = Addr.parse_from(plaintext)
+        return plaintext[offset:], (target.host, target.port)
+
+    def pack(self, data, from_addr):
+        return self.cipher.encrypt_packet(packed_addr(from_addr) + data)
@@ -7,10 +7,12 @@ from parsimonious.nodes import NodeVisitor
 from .models import BoundNamespace
 
 grammar = r"""
-url         = (transport "+")? proxy "://" (username ":" password "@")? host? ":" port
-              path? ("#" pair ("," pair)* )?
-transport   = "tcp" / "kcp" / "quic" / "udp" / "tls" / "wss" / "ws"
+url         = (transport "+")? proxy "://" (username ":" password "@")?
+              (address / unix_path) ("#" pair ("," pair)* )?
+address     = host? ":" port path?
+transport   = "tcp" / "kcp" / "quic" / "udp" / "tls" / "wss" / "ws" / "h2" / "unix"
 proxy       = "ss" / "socks5" / "socks4" / "http" / "tunnel" / "red" / "trojan" / "plain"
+              / "mixed"
 host        = ipv4 / fqdn / ipv6repr
 ipv4        = ~r"\d{1,3}.\d{1,3}.\d{1,3}.\d{1,3}"
 fqdn        = ~r"([0-9a-z]((-*[0-9a-z])|[0-9a-z])*\.){0,5}[a-z]+"i
@@ -19,10 +21,14 @@ ipv6        = ~r"[\w:]+"
 username    = ~r"[\w-]+"
 password    = ~r"[\w-]+"
 path        = ~r"/[\w-]*"
+unix_path   = ~r"/[\w./-]+"
 port        = ~r"\d+"
 pair        = key "=" value
-key         = "via" / "name" / "ul" / "dl" / "verify_ssl" / "user" / "pw"
-value       = ~r"[\w-]+"
+key         = "via" / "name" / "ul" / "dl" / "total_ul" / "total_dl" / "conn_ul"
+              / "conn_dl" / "burst" / "verify_ssl" / "users" / "user" / "pw"
+              / "pipeline" / "target" / "nodelay" / "interval" / "wnd" / "resend"
+              / "deflate" / "mode"
+value       = ~r"[\w./:\[\]-]+"
 """
 
 
@@ -42,6 +48,22 @@ class URLVisitor(NodeVisitor):
     >>> visitor = URLVisitor()
     >>> ns = visitor.visit(tree)
     >>> assert ns.host == '::1'
+    >>> url = 'http://:8080#total_dl=1000,dl=100,conn_dl=50'
+    >>> ns = URLVisitor().visit(grammar.parse(url))
+    >>> assert (ns.total_dl, ns.dl, ns.conn_dl) == (1000, 100, 50)
+    >>> url = 'socks5://:1080#dl=720p,ul=144p,burst=2048'
+    >>> ns = URLVisitor().visit(grammar.parse(url))
+    >>> assert (ns.dl, ns.ul, ns.burst) == (80, 20, 2048)
+    >>> url = 'tunnel://:5353#target=[::1]:53'
+    >>> ns = URLVisitor().visit(grammar.parse(url))
+    >>> assert ns.target_addr == ('::1', 53)
+    >>> url = 'kcp+ss://chacha20-ietf-poly1305:pw@:8388#interval=20,wnd=256'
+    >>> ns = URLVisitor().visit(grammar.parse(url))
+    >>> assert ns.kcp_options["interval"] == 20 and ns.kcp_options["nodelay"]
+    >>> ns = URLVisitor().visit(grammar.parse('unix+socks5:///run/sp.sock#name=x'))
+    >>> assert (ns.path, ns.port) == ('/run/sp.sock', None)
+    >>> str(ns)
+    'unix+socks5:///run/sp.sock'
     """
 
     def __init__(self):
@@ -80,6 +102,8 @@ class URLVisitor(NodeVisitor):
     def visit_path(self, node, visited_children):
         self.info["path"] = node.text
 
+    visit_unix_path = visit_path
+
     def visit_pair(self, node, visited_children):
         self.info[node.children[0].text] = node.children[2].text
 
@@ -1,7 +1,7 @@
 import base64
 from enum import Enum, unique
 
-from pydantic import BaseModel
+from pydantic import BaseModel, FilePath, root_validator, validator
 
 
 @unique
@@ -13,6 +13,8 @@ class TransportEnum(Enum):
     tls = "tls"
     ws = "ws"
     wss = "wss"
+    h2 = "h2"
+    unix = "unix"
 
 
 @unique
@@ -25,6 +27,7 @@ class ProxyEnum(Enum):
     red = "red"
     trojan = "trojan"
     plain = "plain"
+    mixed = "mixed"
 
 
 rate_mapping = {
@@ -35,6 +38,34 @@ rate_mapping = {
     80: "720p",
     100: "1080p",
 }
+tier_mapping = {tier: rate for rate, tier in rate_mapping.items()}
+
+
+def parse_rate(value):
+    """
+    convert a tier name to its rate(KB/s)
+
+    >>> parse_rate("720p"), parse_rate("300"), parse_rate(None)
+    (80, 300, None)
+    """
+    if value is None or isinstance(value, int):
+        return value
+    if value in tier_mapping:
+        return tier_mapping[value]
+    return int(value)
+
+
+def parse_target(value):
+    """
+    split a host:port target, ipv6 hosts are in brackets
+
+    >>> parse_target("example.com:53"), parse_target("[::1]:53")
+    (('example.com', 53), ('::1', 53))
+    """
+    host, sep, port = value.rpartition(":")
+    if not sep or not host or not port.isdigit():
+        raise ValueError(f"target must be host:port, got {value!r}")
+    return host.strip("[]"), int(port)
 
 
 class BoundNamespace(BaseModel):
@@ -44,22 +75,103 @@ class BoundNamespace(BaseModel):
     password: str = None
     path: str = None
     host: str
-    port: int
+    port: int = None  # None for a unix socket, whose path is ``path``
     via: str = None
     name: str = None
     verify_ssl: bool = True
-    ul: int = None  # max upload traffic speed per source ip(KB/s)
-    dl: int = None  # max download traffic speed per source ip(KB/s)
+    pipeline: bool = False  # pipeline the handshake of the outbound
+    target: str = None  # host:port of a tunnel inbound
+    nodelay: bool = True  # kcp: quick retransmission, no congestion window
+    interval: int = 10  # kcp: ms between flushes
+    wnd: int = 1024  # kcp: send and receive window, in segments
+    resend: int = 2  # kcp: fast retransmit after this many later acks, 0 is off
+    deflate: bool = False  # ws: permessage-deflate, useless on encrypted payloads
+    mode: int = None  # unix: permission bits of the socket file, octal like 660
+    ul: int = None  # max upload traffic speed per user or source ip(KB/s)
+    dl: int = None  # max download traffic speed per user or source ip(KB/s)
+    total_ul: int = None  # max upload traffic speed of the inbound(KB/s)
+    total_dl: int = None  # max download traffic speed of the inbound(KB/s)
+    conn_ul: int = None  # max upload traffic speed per connection(KB/s)
+    conn_dl: int = None  # max download traffic speed per connection(KB/s)
+    burst: int = None  # traffic allowed per connection before throttling(KB)
     user: str = None
     pw: str = None
+    users: FilePath = None  # file of username:password lines
 
     class Config:
         use_enum_values = True
         extra = "forbid"
 
+    @validator("ul", "dl", "total_ul", "total_dl", "conn_ul", "conn_dl", pre=True)
+    def parse_tier(cls, value):
+        return parse_rate(value)
+
+    @validator("interval", "wnd")
+    def check_positive(cls, value, field):
+        if value <= 0:
+            raise ValueError(f"{field.name} must be positive")
+        return value
+
+    @validator("mode", pre=True)
+    def parse_mode(cls, value):
+        if isinstance(value, str):
+            try:
+                value = int(value, 8)
+            except ValueError:
+                raise ValueError("mode is octal, like 660") from None
+        if not 0 <= value <= 0o777:
+            raise ValueError("mode is octal, like 660")
+        return value
+
+    @validator("target")
+    def check_target(cls, value):
+        parse_target(value)
+        return value
+
+    @root_validator(skip_on_failure=True)
+    def check_tunnel(cls, values):
+        if values.get("proxy") == "tunnel" and not values.get("target"):
+            raise ValueError("tunnel needs a target, like #target=host:port")
+        return values
+
+    @root_validator(skip_on_failure=True)
+    def check_udp(cls, values):
+        if values.get("transport") == "udp" and values.get("proxy") != "ss":
+            raise ValueError("only ss runs over udp, like udp+ss://cipher:pw@:port")
+        return values
+
+    @root_validator(skip_on_failure=True)
+    def check_unix(cls, values):
+        if (values.get("transport") == "unix") != (values.get("port") is None):
+            raise ValueError("unix takes a path, like unix+socks5:///run/sp.sock")
+        if values.get("mode") is not None and values.get("transport") != "unix":
+            raise ValueError("mode is for the socket file of a unix inbound")
+        return values
+
     def __str__(self):
         auth = f"{self.username}:{self.password}@" if self.username else ""
-        return f"{self.transport}+{self.proxy}://{auth}{self.host}:{self.port}"
+        return f"{self.transport}+{self.proxy}://{auth}{self.address}"
+
+    @property
+    def address(self):
+        "host:port, or the path of a unix socket"
+        if self.transport == "unix":
+            return self.path
+        return f"{self.host}:{self.port}"
+
+    @property
+    def target_addr(self):
+        if self.target:
+            return parse_target(self.target)
+
+    @property
+    def kcp_options(self):
+        return dict(
+            nodelay=self.nodelay,
+            interval=self.interval,
+            wnd=self.wnd,
+            resend=self.resend,
+        )
 
     @property
     def credentials(self):
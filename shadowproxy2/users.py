@@ -0,0 +1,98 @@
+import base64
+import functools
+import hmac
+from hashlib import sha224
+from typing import Dict, Iterable, Optional
+
+import click
+
+from .ciphers import KeyRing
+
+
+def parse_users(lines: Iterable[str]) -> Dict[str, str]:
+    """
+    parse lines of ``username:password``,
+    blank lines and lines starting with ``#`` are ignored
+
+    >>> parse_users(["# comment", "alice:pass1", "", "bob:pass:2"])
+    {'alice': 'pass1', 'bob': 'pass:2'}
+    """
+    users = {}
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        username, sep, password = line.partition(":")
+        if not sep or not username:
+            raise ValueError(f"bad user line: {line!r}")
+        users[username] = password
+    return users
+
+
+@functools.lru_cache(maxsize=1024)
+def trojan_digest(username: Optional[str], password: Optional[str]) -> bytes:
+    if username is None or password is None:
+        rauth = b""
+    else:
+        rauth = f"{username}:{password}".encode()
+    return sha224(rauth).hexdigest().encode()
+
+
+def basic_auth(username: str, password: str) -> bytes:
+    return b"Basic " + base64.b64encode(f"{username}:{password}".encode())
+
+
+class UserTable:
+    """
+    Users given inline and loaded from a file, with the credential forms every
+    protocol sends precomputed, so authentication is one dict lookup.
+
+    >>> table = UserTable(users={"alice": "pass1"})
+    >>> table.check("alice", "pass1"), table.check("alice", "pass2")
+    (True, False)
+    >>> table.basic_auth[b"Basic YWxpY2U6cGFzczE="]
+    'alice'
+    >>> table.trojan_digests[trojan_digest("alice", "pass1")]
+    'alice'
+    """
+
+    def __init__(self, path: Optional[str] = None, users: Dict[str, str] = None):
+        self.path = path
+        self.inline = users or {}
+        self._keyring: Optional[KeyRing] = None
+        self.load()
+
+    def __len__(self):
+        return len(self.users)
+
+    def load(self):
+        users = dict(self.inline)
+        if self.path:
+            with open(self.path, "r") as f:
+                users.update(parse_users(f))
+        self.trojan_digests = {trojan_digest(u, p): u for u, p in users.items()}
+        self.basic_auth = {basic_auth(u, p): u for u, p in users.items()}
+        self.users = users
+        if self._keyring is not None:
+            self._keyring.update(users)
+
+    def reload(self):
+        "reload the file, keep the current users if it is broken"
+        try:
+            self.load()
+        except Exception as e:
+            click.secho(f"reload {self.path} failed: {e}", fg="red")
+        else:
+            click.secho(f"reloaded {len(self)} users from {self.path}", fg="green")
+
+    def check(self, username: str, password: str) -> bool:
+        expected = self.users.get(username)
+        return expected is not None and hmac.compare_digest(
+            expected.encode(), password.encode()
+        )
+
+    @property
+    def keyring(self) -> KeyRing:
+        if self._keyring is None:
+            self._keyring = KeyRing(self.users)
+        return self._keyring
@@ -15,3 +15,13 @@ def is_global(host: str) -> bool:
     except ValueError:
         return True
     return address.is_global
+
+
+def format_addr(addr) -> str:
+    """
+    >>> format_addr(("::1", 1080, 0, 0)), format_addr("/run/sp.sock")
+    ('::1:1080', '/run/sp.sock')
+    """
+    if isinstance(addr, str):  # the path of a unix socket
+        return addr
+    return f"{addr[0]}:{addr[1]}"
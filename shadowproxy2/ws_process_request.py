@@ -1,4 +1,5 @@
 import asyncio
+import hmac
 import socket
 import traceback
 import uuid
@@ -59,3 +60,22 @@ async def ws_process_request(path, request_headers):
                 traceback.print_exc()
             return HTTPStatus.SERVICE_UNAVAILABLE, [], str(e).encode()
         return HTTPStatus.OK, [], b"ok"
+    elif path.startswith("/tier") and app.settings.tier_api_token:
+        from .context import named_contexts
+
+        token = app.settings.tier_api_token.encode()
+        authorization = request_headers.get("Authorization", "").encode()
+        if not hmac.compare_digest(authorization, b"Bearer " + token):
+            return HTTPStatus.UNAUTHORIZED, [], b"bad token"
+        query_dict = parse_qs(urlparse(path).query)
+        name = query_dict.get("name")
+        if not name or name[0] not in named_contexts:
+            return HTTPStatus.NOT_FOUND, [], b"no such inbound"
+        try:
+            named_contexts[name[0]].set_tier(
+                ul=query_dict.get("ul", [None])[0],
+                dl=query_dict.get("dl", [None])[0],
+            )
+        except ValueError as e:
+            return HTTPStatus.BAD_REQUEST, [], str(e).encode()
+        return HTTPStatus.OK, [], b"ok"
@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from shadowproxy2.accounting import Accounting, QuotaExceeded
+from shadowproxy2.parsers.base import NullParser
+
+
+def traffic(accounting):
+    return accounting.db.execute(
+        "SELECT * FROM traffic ORDER BY inbound, user"
+    ).fetchall()
+
+
+def test_upsert_adds_to_the_rows():
+    accounting = Accounting(":memory:")
+    for inbound, upload in [("socks5", 10), ("http", 1), ("socks5", 20)]:
+        accounting.usage(inbound, "alice").upload.nbytes += upload
+        accounting._write(accounting._collect())
+    accounting.usage("socks5", "bob").download.nbytes += 5
+    accounting._write(accounting._collect())
+    assert traffic(accounting) == [
+        ("http", "alice", 1, 0),
+        ("socks5", "alice", 30, 0),
+        ("socks5", "bob", 0, 5),
+    ]
+    assert accounting._collect() == []  # nothing new to write
+
+
+def test_flush_forgets_idle_usages(tmp_path):
+    path = str(tmp_path / "traffic.db")
+
+    async def main():
+        accounting = Accounting(path)
+        parser, remote = NullParser(), NullParser()
+        accounting.start("socks5", "alice", parser, remote)
+        parser.counter.nbytes += 100
+        remote.counter.nbytes += 2000
+        await accounting.flush()
+        assert ("socks5", "alice") in accounting.usages  # a parser is alive
+        del parser
+        await accounting.flush()
+        assert accounting.usages == {}
+        accounting.close()
+
+    asyncio.run(main())
+    assert traffic(Accounting(path)) == [("socks5", "alice", 100, 2000)]
+
+
+@pytest.mark.parametrize("cut", [False, True])
+def test_over_quota(cut):
+    closed = []
+
+    class Parser(NullParser):
+        async def close(self):
+            closed.append(self)
+
+    async def main():
+        accounting = Accounting(":memory:", cut=cut)
+        accounting.db.execute("INSERT INTO quota VALUES ('alice', 1000)")
+        parser, remote = Parser(), Parser()
+        accounting.start("socks5", "alice", parser, remote)
+        bob = Parser()  # under no quota, never cut
+        accounting.start("socks5", "bob", bob, Parser())
+        remote.counter.nbytes += 1000
+        await accounting.flush()
+        assert accounting.blocked == {"alice"}
+        with pytest.raises(QuotaExceeded):
+            accounting.start("socks5", "alice", Parser(), Parser())
+        return parser
+
+    parser = asyncio.run(main())
+    assert closed == ([parser] if cut else [])
@@ -4,7 +4,7 @@ import sys
 import time
 
 
-def test_cli():
+def test_cli(tmp_path):
     process = subprocess.Popen(
         [
             sys.executable,
@@ -14,6 +14,7 @@ def test_cli():
             "ss://chacha20-ietf-poly1305:password@:0",
             "socks4://:0",
             "quic+socks5://:0",
+            f"unix+socks5://{tmp_path}/sp.sock",
         ]
     )
     time.sleep(3)
@@ -0,0 +1,592 @@
+import asyncio
+import contextlib
+import socket
+
+import pytest
+
+from shadowproxy2.accounting import Accounting, QuotaExceeded
+from shadowproxy2.aiobuffer import socks5 as s5
+from shadowproxy2.ciphers import ChaCha20IETFPoly1305, KeyRing
+from shadowproxy2.client import Client
+from shadowproxy2.context import ProxyContext
+from shadowproxy2.aiobuffer.buffer import create_buffer
+from shadowproxy2.iofree.exceptions import ParseError
+from shadowproxy2.parsers import (
+    aead,
+    base,
+    http,
+    mixed,
+    socks4,
+    socks5,
+    trojan,
+    tunnel,
+)
+from shadowproxy2.parsers.base import NullParser
+from shadowproxy2.pool import ConnectionPool
+from shadowproxy2.sansio import HandshakeEngine
+from shadowproxy2.throttle import Shaper
+from shadowproxy2.urlparser import URLVisitor, grammar
+from shadowproxy2.users import UserTable, trojan_digest
+
+SOCKS4 = b"\x04\x01\x01\xbb\x00\x00\x00\x01\x00a.com\x00"
+
+
+class Writer:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+
+class Context:
+    "the part of `ProxyContext` used by inbound parsers"
+
+    accounting = None
+    check_quota = ProxyContext.check_quota
+
+    def __init__(self):
+        self.targets = []
+
+    async def create_client(self, target_addr):
+        self.targets.append(target_addr)
+        return NullParser()
+
+    connect_remote = ProxyContext.connect_remote
+
+
+def serve(parser, data, ctx=None):
+    "drive the stream based ``server()`` over ``data``, return the context"
+
+    async def main():
+        reader = create_buffer()
+        reader.feed_data(data)
+        reader.feed_eof()
+        parser.set_rw(reader, Writer())
+        ctx_ = ctx or Context()
+        await parser.server(ctx_)
+        return ctx_
+
+    return asyncio.run(main())
+
+
+def handshake(parser, data, writer=None):
+    "drive the sans-IO ``server_handshake()`` over ``data``, return the target"
+    engine = HandshakeEngine(parser.server_handshake(), writer or Writer())
+    engine.data_received(data)
+    return engine.get_result()
+
+
+@pytest.mark.parametrize(
+    "parser",
+    [
+        lambda: mixed.MixedParser("user", "password"),
+        lambda: mixed.MixedParser(users=UserTable(None, {"user": "password"})),
+    ],
+)
+def test_mixed_refuses_socks4_with_auth(parser):
+    with pytest.raises(mixed.ProtocolError):
+        serve(parser(), SOCKS4)
+    with pytest.raises(ParseError) as info:
+        handshake(parser(), SOCKS4)
+    assert isinstance(info.value.__context__, mixed.ProtocolError)
+
+
+def test_mixed_socks4_without_auth():
+    assert serve(mixed.MixedParser(), SOCKS4).targets == [("a.com", 443)]
+    assert handshake(mixed.MixedParser(), SOCKS4) == ("a.com", 443)
+
+
+def test_mixed_socks5_with_auth():
+    data = (
+        s5.Handshake(..., [s5.AuthMethod.user_auth]).binary
+        + s5.UsernameAuth(..., "user", "password").binary
+        + s5.ClientRequest(..., s5.Cmd.connect, ..., s5.Addr(3, "a.com", 443)).binary
+    )
+    users = UserTable(None, {"user": "password"})
+    ctx = serve(mixed.MixedParser("user", "password", users), data)
+    assert ctx.targets == [("a.com", 443)]
+
+
+def test_over_quota_opens_no_connection():
+    data = (
+        s5.Handshake(..., [s5.AuthMethod.user_auth]).binary
+        + s5.UsernameAuth(..., "user", "password").binary
+        + s5.ClientRequest(..., s5.Cmd.connect, ..., s5.Addr(3, "a.com", 443)).binary
+    )
+    users = UserTable(None, {"user": "password"})
+    ctx = Context()
+    ctx.accounting = Accounting(":memory:")
+    ctx.accounting.blocked.add("user")
+    parser = socks5.Socks5Parser("user", "password", users)
+    with pytest.raises(QuotaExceeded):
+        serve(parser, data, ctx)
+    assert ctx.targets == []
+    assert parser.writer.data.endswith(s5.UsernameAuthReply(..., 0).binary)
+
+
+SOCKS5 = (
+    s5.Handshake(..., [s5.AuthMethod.no_auth]).binary
+    + s5.ClientRequest(..., s5.Cmd.connect, ..., s5.Addr(3, "a.com", 443)).binary
+)
+HANDSHAKES = [
+    (socks5.Socks5Parser, SOCKS5),
+    (socks4.Socks4Parser, SOCKS4),
+    (
+        lambda: http.HTTPParser(None, None),
+        b"CONNECT a.com:443 HTTP/1.1\r\nHost: a.com:443\r\n\r\n",
+    ),
+    (
+        lambda: trojan.TrojanParser(users=UserTable(None, {"user": "password"})),
+        trojan.TrojanSchema(
+            trojan_digest("user", "password"),
+            ...,
+            s5.Cmd.connect,
+            s5.Addr(3, "a.com", 443),
+            ...,
+        ).binary,
+    ),
+    (aead.PlainParser, s5.Addr(3, "a.com", 443).binary),
+]
+
+
+@pytest.mark.parametrize("parser, data", HANDSHAKES)
+def test_server_handshake(parser, data):
+    assert handshake(parser(), data) == ("a.com", 443)
+    # the same bytes arriving one at a time
+    engine = HandshakeEngine(parser().server_handshake(), Writer())
+    for i in range(len(data)):
+        assert not engine.has_result
+        engine.data_received(data[i : i + 1])
+    assert engine.get_result() == ("a.com", 443)
+    assert not engine.has_more_data()
+
+
+def test_server_handshake_replies():
+    writer = Writer()
+    handshake(socks5.Socks5Parser(), SOCKS5, writer)
+    assert writer.data == socks5.NO_AUTH.binary
+
+    data = (
+        s5.Handshake(..., [s5.AuthMethod.user_auth]).binary
+        + s5.UsernameAuth(..., "user", "wrong").binary
+    )
+    writer = Writer()
+    parser = socks5.Socks5Parser(users=UserTable(None, {"user": "password"}))
+    with pytest.raises(ParseError) as info:
+        handshake(parser, data, writer)
+    assert isinstance(info.value.__context__, socks5.ProtocolError)
+    assert writer.data == socks5.USER_AUTH.binary + socks5.NOT_ALLOWED.binary
+
+
+def aead_request(password):
+    salt, encrypt = ChaCha20IETFPoly1305(password).make_encrypter()
+    return salt + encrypt(s5.Addr(3, "a.com", 443).binary + b"payload")
+
+
+@pytest.mark.parametrize("hot_keys", [16, 1])
+def test_multi_user_aead(monkeypatch, hot_keys):
+    "with one hot key the other users are identified in an executor"
+    monkeypatch.setattr(KeyRing, "HOT_KEYS", hot_keys)
+    users = {"alice": "pw1", "bob": "pw2", "carol": "pw3"}
+    data = aead_request("pw3")
+
+    def parser():
+        return aead.MultiUserAEADParser(UserTable(None, users).keyring)
+
+    async def main():
+        parser = aead.MultiUserAEADParser(keyring)
+        reader = create_buffer()
+        parser.set_rw(reader, Writer())
+        reader.feed_data(data)
+        reader.feed_eof()  # waits for the key, the payload is not lost
+        ctx = Context()
+        await parser.server(ctx)
+        return parser.user, ctx.targets, await parser.reader.read()
+
+    keyring = UserTable(None, users).keyring
+    assert asyncio.run(main()) == ("carol", [("a.com", 443)], b"payload")
+    assert list(keyring.ciphers) == ["carol", "alice", "bob"]
+
+    async def sansio():
+        sansio_parser = parser()
+        sansio_parser.connection_made(Writer())
+        engine = HandshakeEngine(sansio_parser.server_handshake(), Writer())
+        engine.data_received(data)
+        for _ in range(500):  # till the executor wakes the engine up
+            if engine.has_result:
+                break
+            await asyncio.sleep(0.01)
+        return engine.get_result()
+
+    assert asyncio.run(sansio()) == ("a.com", 443)
+
+    async def unknown():
+        parser = aead.MultiUserAEADParser(keyring)
+        parser.set_rw(create_buffer(), Writer())
+        parser.reader.feed_data(aead_request("wrong"))
+        await parser.server(Context())
+
+    with pytest.raises(ValueError):
+        asyncio.run(unknown())
+
+
+def test_tunnel_forwards_to_its_target():
+    async def echo(reader, writer):
+        while data := await reader.read(4096):
+            writer.write(data)
+        writer.close()
+
+    async def main():
+        target = await asyncio.start_server(echo, "127.0.0.1", 0)
+        port = target.sockets[0].getsockname()[1]
+        url = f"tunnel://127.0.0.1:0#target=127.0.0.1:{port}"
+        ctx = ProxyContext(URLVisitor().visit(grammar.parse(url)), None)
+        async with contextlib.AsyncExitStack() as ctx.stack:
+            server = await ctx.create_server()
+            reader, writer = await asyncio.open_connection(
+                *server.sockets[0].getsockname()
+            )
+            writer.write(b"ping")
+            data = await asyncio.wait_for(reader.readexactly(4), 5)
+            writer.close()
+        target.close()
+        return data
+
+    assert asyncio.run(main()) == b"ping"
+    assert handshake(tunnel.TunnelParser(("a.com", 443)), b"") == ("a.com", 443)
+
+
+class RedirectedSocket:
+    "a dual stack socket accepted on ``sockname``, redirected from ``dst``"
+
+    family = socket.AF_INET6
+
+    def __init__(self, sockname, dst):
+        self.sockname, self.dst = sockname, dst
+
+    def getsockname(self):
+        return self.sockname
+
+    def getsockopt(self, level, option, size):
+        host, port = self.dst
+        return b"\x02\x00" + port.to_bytes(2, "big") + socket.inet_aton(host) + bytes(8)
+
+
+@pytest.mark.parametrize(
+    "dst, redirected",
+    [(("10.0.0.1", 8080), False), (("10.0.0.2", 8080), True), (("10.0.0.1", 80), True)],
+)
+def test_redirect_of_a_mapped_address(dst, redirected):
+    parser = tunnel.RedirectParser()
+    sock = RedirectedSocket(("::ffff:10.0.0.1", 8080, 0, 0), dst)
+    transport = type("Transport", (), {"get_extra_info": lambda self, name: sock})()
+    if redirected:
+        parser.connection_made(transport)
+        assert parser.target_addr == dst
+    else:
+        with pytest.raises(tunnel.ProtocolError):
+            parser.connection_made(transport)
+
+
+class Origin:
+    "an http server recording the connections it accepts and their requests"
+
+    def __init__(self, requests_per_connection=None):
+        self.connections = []
+        self.requests_per_connection = requests_per_connection
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        requests = []
+        self.connections.append(requests)
+        while len(requests) != self.requests_per_connection:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except asyncio.IncompleteReadError:
+                break
+            if b"chunked" in head.lower():
+                body = line = await reader.readuntil(b"\r\n")
+                while line != b"0\r\n":
+                    body += await reader.readexactly(int(line.split(b";")[0], 16) + 2)
+                    body += (line := await reader.readuntil(b"\r\n"))
+                while line != b"\r\n":  # trailer section
+                    body += (line := await reader.readuntil(b"\r\n"))
+            elif b"content-length: " in head.lower():
+                length = head.lower().split(b"content-length: ")[1].split(b"\r")[0]
+                body = await reader.readexactly(int(length))
+            else:
+                body = b""
+            requests.append(head + body)
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                b"2\r\nok\r\n0\r\n\r\n"
+            )
+        writer.close()
+
+
+class HTTPContext(Context):
+    "the part of `ProxyContext` used to forward plain http requests"
+
+    def __init__(self):
+        super().__init__()
+        pool = ConnectionPool()
+        self.container = type("Container", (), {"http_pool": lambda: pool})
+
+    async def create_client(self, target_addr):
+        self.targets.append(target_addr)
+        parser = NullParser()
+        parser.set_rw(*await asyncio.open_connection(*target_addr))
+        return parser
+
+    def start_accounting(self, parser, remote_parser):
+        pass
+
+    def set_throttles(self, parser, remote_parser):
+        pass
+
+
+class MeteredHTTPContext(HTTPContext):
+    "with the accounting and throttles of `ProxyContext`"
+
+    inbound_name = "http"
+    start_accounting = ProxyContext.start_accounting
+    set_throttles = ProxyContext.set_throttles
+
+    def __init__(self):
+        super().__init__()
+        self.accounting = Accounting(":memory:")
+        pool = self.container.http_pool()
+        upload_shaper, download_shaper = Shaper(conn_rate=1 << 30), Shaper()
+        self.container = type(
+            "Container",
+            (),
+            {
+                "http_pool": lambda: pool,
+                "upload_shaper": lambda: upload_shaper,
+                "download_shaper": lambda: download_shaper,
+            },
+        )
+
+
+def forward(*requests, ctx=None, origin=None, parser=None):
+    "requests to an `Origin` through `HTTPParser`: responses, origin, error"
+
+    async def main():
+        origin_ = origin or Origin()
+        port = await origin_.start()
+        reader = create_buffer()
+        reader.feed_data(b"".join(requests).replace(b"PORT", b"%d" % port))
+        reader.feed_eof()
+        parser_ = parser or http.HTTPParser(None, None)
+        writer = Writer()
+        parser_.set_rw(reader, writer)
+        ctx_ = ctx or HTTPContext()
+        error = None
+        try:
+            await parser_.server(ctx_)
+        except http.ProtocolError as e:
+            error = e
+        ctx_.container.http_pool().close()
+        origin_.server.close()
+        await asyncio.sleep(0)
+        return bytes(writer.data), origin_.connections, error
+
+    return asyncio.run(main())
+
+
+def test_http_keep_alive():
+    get = b"GET http://127.0.0.1:PORT/ HTTP/1.1\r\n\r\n"
+    responses, connections, error = forward(get, get)
+    assert error is None
+    assert responses.count(b"HTTP/1.1 200 OK\r\n") == 2
+    assert responses.count(b"Connection: keep-alive") == 2
+    # the second request is sent over the pooled connection
+    assert [len(requests) for requests in connections] == [2]
+
+
+@pytest.mark.parametrize("requests_per_connection", [None, 1])
+def test_http_forward_meters(monkeypatch, requests_per_connection):
+    "counted and throttled over keep-alive requests and a retry"
+    post = b"POST http://127.0.0.1:PORT/ HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello"
+    get = b"GET http://127.0.0.1:PORT/ HTTP/1.1\r\n\r\n"
+    throttles = []
+    set_throttle = http.HTTPParser.set_throttle
+
+    def recording_set_throttle(parser, throttle):
+        if throttle is not None:
+            throttles.append(throttle)
+        set_throttle(parser, throttle)
+
+    monkeypatch.setattr(http.HTTPParser, "set_throttle", recording_set_throttle)
+    ctx = MeteredHTTPContext()
+    responses, connections, error = forward(
+        post, get, ctx=ctx, origin=Origin(requests_per_connection)
+    )
+    assert error is None
+    assert responses.count(b"HTTP/1.1 200 OK\r\n") == 2
+    assert len(connections) == (2 if requests_per_connection else 1)
+    assert len(throttles) == 1  # the client side keeps its throttle
+    usage = ctx.accounting.usages[("http", "")]
+    assert (usage.upload.nbytes, usage.download.nbytes) == (5, 8)
+
+
+def test_mixed_forwards_http_with_a_body():
+    post = b"POST http://127.0.0.1:PORT/ HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello"
+    responses, connections, error = forward(post, post, parser=mixed.MixedParser())
+    assert error is None
+    assert responses.count(b"HTTP/1.1 200 OK\r\n") == 2
+    (requests,) = connections
+    assert all(request.endswith(b"\r\n\r\nhello") for request in requests)
+
+
+def test_http_forward_over_quota():
+    ctx, origin = MeteredHTTPContext(), Origin()
+    ctx.accounting.blocked.add("")
+    with pytest.raises(QuotaExceeded):
+        forward(b"GET http://127.0.0.1:PORT/ HTTP/1.1\r\n\r\n", ctx=ctx, origin=origin)
+    assert ctx.targets == [] and origin.connections == []
+
+
+def test_http_chunked():
+    body = b"5;ext\r\nhello\r\n0\r\nX-Trailer: 1\r\n\r\n"
+    responses, connections, error = forward(
+        b"POST http://127.0.0.1:PORT/x HTTP/1.1\r\n"
+        b"Transfer-Encoding: chunked\r\n\r\n" + body
+    )
+    assert error is None
+    assert connections[0][0].endswith(b"\r\n\r\n" + body)
+    assert responses.endswith(b"\r\n\r\n2\r\nok\r\n0\r\n\r\n")
+
+
+def test_http_drops_content_length_next_to_chunked():
+    responses, connections, error = forward(
+        b"POST http://127.0.0.1:PORT/ HTTP/1.1\r\nContent-Length: 5\r\n"
+        b"Transfer-Encoding: chunked\r\n\r\n0\r\n\r\n"
+    )
+    assert error is None
+    assert b"content-length" not in connections[0][0].lower()
+
+
+@pytest.mark.parametrize(
+    "headers",
+    [
+        b"Content-Length: 1\r\nContent-Length: 2",
+        b"Content-Length: 1, 2",
+        b"Content-Length: -1",
+        b"Content-Length: +1",
+        b"Transfer-Encoding: chunked, identity",
+        b"Transfer-Encoding: xchunked",
+        b"Content-Length : 4",
+        b"Content-Length\t: 4",
+    ],
+)
+def test_http_refuses_ambiguous_body(headers):
+    responses, connections, error = forward(
+        b"POST http://127.0.0.1:PORT/ HTTP/1.1\r\n%s\r\n\r\n"
+        b"0\r\n\r\nGET /smuggled HTTP/1.1\r\n\r\n" % headers
+    )
+    assert isinstance(error, http.ProtocolError)
+    assert connections == []
+
+
+@pytest.mark.parametrize(
+    "header", [b"Cookie: a=hi :)", b"Referer: http://x/?q=a :b", b"X-A: b :c"]
+)
+def test_http_space_before_a_colon_in_a_value(header):
+    responses, connections, error = forward(
+        b"GET http://127.0.0.1:PORT/ HTTP/1.1\r\n%s\r\n\r\n" % header
+    )
+    assert error is None
+    assert header in connections[0][0]
+
+
+def test_http_refuses_bad_chunk_size():
+    responses, connections, error = forward(
+        b"POST http://127.0.0.1:PORT/ HTTP/1.1\r\n"
+        b"Transfer-Encoding: chunked\r\n\r\n0x5\r\nhello\r\n0\r\n\r\n"
+    )
+    assert isinstance(error, http.ProtocolError)
+
+
+def test_hold_joins_the_first_payload():
+    async def main():
+        parser = NullParser()
+        parser.set_rw(create_buffer(), Writer())
+        parser.hold(b"header")
+        await parser.write(b"payload")
+        await asyncio.sleep(base.PIPELINE_DELAY * 2)
+        return parser.writer.data
+
+    assert asyncio.run(main()) == b"headerpayload"
+
+
+def test_hold_is_sent_alone_after_a_delay():
+    async def main():
+        parser = NullParser()
+        parser.set_rw(create_buffer(), Writer())
+        parser.hold(b"header")
+        assert parser.writer.data == b""
+        await asyncio.sleep(base.PIPELINE_DELAY * 2)
+        await parser.write(b"payload")
+        return parser.writer.data
+
+    assert asyncio.run(main()) == b"headerpayload"
+
+
+def test_finish_handshake():
+    async def refused():
+        raise ConnectionRefusedError
+
+    async def main():
+        parser = NullParser()
+        await parser.finish_handshake()  # nothing pending
+        parser.pending_reply = refused()
+        with pytest.raises(ConnectionRefusedError):
+            await parser.finish_handshake()
+        assert parser.pending_reply is None
+        await parser.finish_handshake()
+
+    asyncio.run(main())
+
+
+def test_client_connect_reads_pipelined_replies():
+    async def handler(reader, writer):
+        parser = socks5.Socks5Parser()
+        parser.set_rw(reader, writer)
+        await parser.server(Context())
+        while data := await parser.read_func(4096):
+            await parser.write(data)
+        await parser.close()
+
+    async def main():
+        server = await asyncio.start_server(handler, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        parser = await Client(f"socks5://127.0.0.1:{port}#pipeline=1").connect(
+            "example.com", 80
+        )
+        await parser.write(b"ping")
+        data = await parser.read_func(4096)
+        await parser.close()
+        server.close()
+        return data
+
+    assert asyncio.run(main()) == b"ping"
@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+from websockets.datastructures import Headers
+
+from shadowproxy2 import app, context
+from shadowproxy2.throttle import HierarchicalThrottle, Shaper
+from shadowproxy2.ws_process_request import ws_process_request
+
+
+def send(nodes, seconds=20.0, chunk=100):
+    """
+    bytes per second each of ``nodes`` gets on a virtual clock, sending a
+    ``chunk`` whenever the wait of its previous one is over
+    """
+    start = max(node.last_check for node in nodes)
+    next_send = dict.fromkeys(nodes, start)
+    sent = dict.fromkeys(nodes, 0)
+    while True:
+        node = min(nodes, key=next_send.get)
+        now = next_send[node]
+        if now >= start + seconds:
+            return [sent[node] / seconds for node in nodes]
+        next_send[node] = now + node.charge(chunk, now)
+        sent[node] += chunk
+
+
+@pytest.mark.parametrize("rate", [1000, 50_000, 10 << 20])
+def test_rate_accuracy(rate):
+    # the first time window of tokens comes on top of the rate
+    (achieved,) = send([HierarchicalThrottle(rate)], chunk=max(rate // 100, 1))
+    assert rate <= achieved <= rate * 1.05
+
+
+def test_idle_sibling_share_is_borrowed():
+    root = HierarchicalThrottle(1000)
+    busy, idle = (HierarchicalThrottle(parent=root) for _ in range(2))
+    assert busy.assured_rate == idle.assured_rate == 500
+    (achieved,) = send([busy])
+    assert 1000 <= achieved <= 1050
+
+
+def test_busy_siblings_share_the_parent():
+    root = HierarchicalThrottle(1000)
+    a, b = (HierarchicalThrottle(parent=root) for _ in range(2))
+    for achieved in send([a, b]):
+        assert 475 <= achieved <= 550
+
+
+def test_ceil_caps_borrowing():
+    root = HierarchicalThrottle(10000)
+    user = HierarchicalThrottle(1000, root)
+    capped = HierarchicalThrottle(300, user)
+    greedy = HierarchicalThrottle(parent=user)
+    capped_rate, greedy_rate = send([capped, greedy])
+    assert 300 <= capped_rate <= 315
+    assert 1000 <= capped_rate + greedy_rate <= 1050
+
+
+def test_release():
+    shaper = Shaper(user_rate=1000)
+    first, second = shaper.connection("alice"), shaper.connection("alice")
+    bob = shaper.connection("bob")
+    user = shaper.users["alice"]
+    assert first.assured_rate == 500
+    first.close()
+    first.close()  # closing twice releases once
+    assert shaper.users["alice"] is user and second.assured_rate == 1000
+    second.close()
+    assert list(shaper.users) == ["bob"] and user not in shaper.root.children
+    bob.close()
+    assert shaper.users == {} and not shaper.root.children
+
+
+def test_live_shaper_throttles_unlimited_connections():
+    shaper = Shaper(live=True)
+    node = shaper.connection("alice")
+    now = node.last_check
+    assert node.charge(1 << 20, now) == 0
+    shaper.update_rates(user_rate=1000)
+    # the megabyte sent before is not owed to the new rate
+    assert node.charge(500, now) == 0
+    assert node.charge(1000, now) == 1.0
+
+
+def test_tier_reaches_connections_made_without_user_rate():
+    shaper = Shaper(conn_rate=10000)
+    node = shaper.connection("alice")
+    now = node.last_check
+    shaper.update_rates(user_rate=1000)
+    assert node.parent is shaper.users["alice"]
+    assert node.charge(1500, now) == 1.0
+    node.close()
+    assert shaper.users == {}
+
+
+def test_tier_api_needs_the_token(monkeypatch):
+    tiers = []
+
+    class Context:
+        def set_tier(self, ul=None, dl=None):
+            tiers.append((ul, dl))
+
+    monkeypatch.setattr(app.settings, "tier_api_token", "secret")
+    monkeypatch.setitem(context.named_contexts, "x", Context())
+
+    def request(authorization=None):
+        headers = Headers()
+        if authorization:
+            headers["Authorization"] = authorization
+        return asyncio.run(ws_process_request("/tier?name=x&dl=720p", headers))[0]
+
+    assert request() == 401
+    assert request("Bearer wrong") == 401
+    assert request("Bearer secret") == 200
+    assert tiers == [(None, "720p")]
@@ -0,0 +1,370 @@
+import asyncio
+import contextlib
+import os
+import socket
+import stat
+
+import pytest
+import websockets
+from pydantic import ValidationError
+
+from shadowproxy2.ciphers import ChaCha20IETFPoly1305
+from shadowproxy2.context import ProxyContext
+from shadowproxy2.parsers.aead import AEADParser
+from shadowproxy2.transport import kcp, ws
+from shadowproxy2.transport.h2 import H2Client, H2Connection
+from shadowproxy2.urlparser import URLVisitor, grammar
+from shadowproxy2.urlparser.models import BoundNamespace
+
+
+async def echo(reader, writer):
+    while data := await reader.read(65536):
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+def test_h2_paused_stream_leaves_others_flowing():
+    async def main():
+        loop = asyncio.get_running_loop()
+        streams = []
+
+        def on_stream(reader, writer):
+            streams.append(writer)
+            if len(streams) > 1:  # the first one is never read
+                loop.create_task(echo(reader, writer))
+
+        server = await loop.create_server(
+            lambda: H2Connection(client_side=False, on_stream=on_stream),
+            "127.0.0.1",
+            0,
+        )
+        client = H2Client(server.sockets[0].getsockname()[:2], None)
+        try:
+            stalled = await client.open_stream()
+            stalled.write(b"x" * (6 << 20))
+            while len(stalled.pending) > 2 << 20:  # till its window is used up
+                await asyncio.sleep(0.01)
+            stream = await client.open_stream()
+            stream.write(b"ping")
+            data = await asyncio.wait_for(stream.reader.readexactly(4), 5)
+            assert data == b"ping"
+            assert len(client.connections) == 1
+        finally:
+            client.close()
+            server.close()
+
+    asyncio.run(main())
+
+
+def first_segment(conv, data=b"x", length=None):
+    "what anyone can send to open a kcp session: a PUSH with sn 0"
+    length = len(data) if length is None else length
+    return kcp.HEADER.pack(conv, kcp.CMD_PUSH, 0, 1024, 0, 0, 0, length) + data
+
+
+def run_endpoint(test):
+    "run ``test`` with a server `KCPEndpoint` and the readers it accepted"
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        readers = []
+        transport, endpoint = await loop.create_datagram_endpoint(
+            lambda: kcp.KCPEndpoint({}, lambda r, w: readers.append(r)),
+            local_addr=("127.0.0.1", 0),
+        )
+        try:
+            await test(endpoint, readers)
+        finally:
+            transport.close()
+
+    asyncio.run(main())
+
+
+def test_kcp_session_caps(monkeypatch):
+    monkeypatch.setattr(kcp, "MAX_SESSIONS", 8)
+    monkeypatch.setattr(kcp, "MAX_ADDR_SESSIONS", 3)
+
+    async def test(endpoint, readers):
+        for conv in range(5):
+            endpoint.datagram_received(first_segment(conv), ("127.0.0.2", 1))
+        assert len(endpoint.sessions) == 3
+        for port in range(2, 10):
+            endpoint.datagram_received(first_segment(0), ("127.0.0.2", port))
+        assert len(endpoint.sessions) == len(readers) == 8
+        assert endpoint.addr_sessions[("127.0.0.2", 1)] == 3
+
+    run_endpoint(test)
+
+
+def test_kcp_handshake_timeout(monkeypatch):
+    monkeypatch.setattr(kcp, "HANDSHAKE_TIMEOUT", 0.01)
+
+    async def test(endpoint, readers):
+        addr = ("127.0.0.2", 1)
+        endpoint.datagram_received(first_segment(1), addr)
+        # a length beyond the packet, no byte reaches the reader
+        endpoint.datagram_received(first_segment(2, length=100), addr)
+        await asyncio.sleep(0.05)
+        endpoint._tick()
+        assert list(endpoint.sessions) == [(addr, 1)]
+        assert endpoint.addr_sessions == {addr: 1}
+        assert readers[1].at_eof()
+        # late packets of the closed session open nothing
+        endpoint.datagram_received(first_segment(2), addr)
+        assert list(endpoint.sessions) == [(addr, 1)]
+
+    run_endpoint(test)
+
+
+def test_kcp_tick_skips_idle_sessions():
+    async def test(endpoint, readers):
+        endpoint.datagram_received(first_segment(1), ("127.0.0.2", 1))
+        (session,) = endpoint.sessions.values()
+        assert not session.kcp.idle  # the ack is pending
+        endpoint._tick()
+        assert session.kcp.idle and not session.kcp.acklist
+
+        def flush():
+            raise AssertionError("an idle session is flushed")
+
+        session.kcp.flush = flush
+        endpoint._tick()
+        session.write(b"reply")
+        assert not session.kcp.idle
+
+    run_endpoint(test)
+
+
+@pytest.mark.parametrize("option", [{"interval": 0}, {"wnd": 0}, {"interval": -10}])
+def test_kcp_options_positive(option):
+    with pytest.raises(ValidationError):
+        BoundNamespace(transport="kcp", proxy="ss", host="", port=8388, **option)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_ws_listener(urls, test):
+    """
+    start the inbounds of ``urls`` (PORT replaced by a free port), each
+    recording the paths routed to it, then run ``test`` with the base url
+    """
+
+    async def main():
+        port = free_port()
+        async with contextlib.AsyncExitStack() as stack:
+            ProxyContext.stack = stack
+            contexts = []
+            for url in urls:
+                ns = URLVisitor().visit(grammar.parse(url.replace("PORT", str(port))))
+                ctx = ProxyContext(ns, None)
+                ctx.paths = []
+
+                async def handler(ws, path, paths=ctx.paths):
+                    paths.append(path)
+
+                ctx.ws_handler = handler
+                await ctx.create_server()
+                contexts.append(ctx)
+            await test(f"ws://127.0.0.1:{port}", contexts)
+
+    asyncio.run(main())
+
+
+async def ws_status(url, **kwargs):
+    "the status of a websocket handshake with ``url``, 101 if it succeeded"
+    try:
+        async with websockets.connect(url, **kwargs) as ws:
+            await ws.wait_closed()
+    except websockets.InvalidStatusCode as e:
+        return e.status_code
+    return 101
+
+
+def test_ws_routes_by_path():
+    async def test(base, contexts):
+        auth = {"extra_headers": [("Authorization", "Basic dXNlcjpwdw==")]}
+        wrong = {"extra_headers": [("Authorization", "Basic dXNlcjp4eA==")]}
+        assert await ws_status(base + "/a") == 101
+        assert await ws_status(base + "/b?x=1", **auth) == 101
+        assert await ws_status(base + "/b") == 401
+        assert await ws_status(base + "/b", **wrong) == 401
+        assert await ws_status(base + "/c") == 404
+        assert [ctx.paths for ctx in contexts] == [["/a"], ["/b?x=1"]]
+
+    run_ws_listener(
+        [
+            "ws+socks5://127.0.0.1:PORT/a",
+            "ws+socks5://127.0.0.1:PORT/b#user=user,pw=pw",
+        ],
+        test,
+    )
+
+
+def test_ws_default_route():
+    async def test(base, contexts):
+        assert await ws_status(base + "/a") == 101
+        assert await ws_status(base + "/anything") == 101
+        assert [ctx.paths for ctx in contexts] == [["/anything"], ["/a"]]
+
+    run_ws_listener(
+        ["ws+socks5://127.0.0.1:PORT", "ws+socks5://127.0.0.1:PORT/a"], test
+    )
+
+
+@pytest.mark.parametrize(
+    "url, error",
+    [
+        ("wss+socks5://127.0.0.1:PORT/b", "already a ws port"),
+        ("ws+socks5://127.0.0.1:PORT/a", "path /a of 127.0.0.1:"),
+    ],
+)
+def test_ws_listener_conflicts(url, error):
+    async def test(base, contexts):
+        pass
+
+    with pytest.raises(Exception, match=error):
+        run_ws_listener(["ws+socks5://127.0.0.1:PORT/a", url], test)
+
+
+class FakeWebsocket:
+    "receives ``messages`` then a normal close, records what is sent"
+
+    def __init__(self, messages=(), on_send=None):
+        self.messages = list(messages)
+        self.sent = []
+        self.on_send = on_send
+
+    async def recv(self):
+        if not self.messages:
+            raise websockets.ConnectionClosedOK(None, None)
+        return self.messages.pop(0)
+
+    async def send(self, data):
+        await asyncio.sleep(0)
+        self.sent.append(data)
+        if self.on_send:
+            self.on_send(self)
+
+
+def test_ws_reader_hands_messages_over():
+    async def main():
+        reader = ws.WebsocketReader(FakeWebsocket([b"one", b"two"]))
+        return [await reader.read(4096), await reader.read(2), await reader.read(9)]
+
+    assert asyncio.run(main()) == [b"one", b"tw", b"o"]
+
+
+def test_ws_reader_of_an_aead_parser():
+    cipher = ChaCha20IETFPoly1305("password")
+    salt, encrypt = cipher.make_encrypter()
+    ciphertext = salt + encrypt(b"hello")
+
+    async def main():
+        parser = AEADParser(cipher)
+        reader = ws.WebsocketReader(FakeWebsocket([ciphertext[:20], ciphertext[20:]]))
+        parser.set_rw(reader, None)
+        assert not parser.reader.direct
+        return await parser.reader.read(4096)
+
+    assert asyncio.run(main()) == b"hello"
+
+
+def test_ws_reader_refuses_text():
+    async def main():
+        reader = ws.WebsocketReader(FakeWebsocket(["text"]))
+        await reader.read(4096)
+
+    with pytest.raises(ws.ProtocolError):
+        asyncio.run(main())
+
+
+def test_ws_drain_waits_for_writes_made_meanwhile():
+    frame = b"x" * ws.FRAME_SIZE
+
+    def write_more(websocket):
+        "another writer fills a frame after the first one was sent"
+        if len(websocket.sent) == 1:
+            loop = asyncio.get_running_loop()
+            loop.call_soon(lambda: writer.write(frame * 2).close())
+
+    async def main():
+        await writer.write(frame)
+        return len(writer.buffer), len(websocket.sent)
+
+    websocket = FakeWebsocket(on_send=write_more)
+    writer = ws.WebsocketWriter(websocket)
+    assert asyncio.run(main()) == (0, 3)
+
+
+def unix_inbound(path, fragment=""):
+    ns = URLVisitor().visit(grammar.parse(f"unix+socks5://{path}{fragment}"))
+    ctx = ProxyContext(ns, None)
+    ctx.tcp_handler = echo
+    return ctx
+
+
+def test_unix_socket_left_by_a_previous_run_is_replaced(tmp_path):
+    path = str(tmp_path / "sp.sock")
+    with socket.socket(socket.AF_UNIX) as stale:
+        stale.bind(path)  # bound, never listened on: refuses connections
+
+    async def main():
+        async with contextlib.AsyncExitStack() as stack:
+            ProxyContext.stack = stack
+            await unix_inbound(path, "#mode=660").create_server()
+            assert stat.S_IMODE(os.stat(path).st_mode) == 0o660
+            reader, writer = await asyncio.open_unix_connection(path)
+            writer.write(b"ping")
+            assert await reader.readexactly(4) == b"ping"
+            writer.close()
+        assert not os.path.exists(path)
+
+    asyncio.run(main())
+
+
+def test_unix_socket_in_use_is_left_alone(tmp_path):
+    path = str(tmp_path / "sp.sock")
+
+    async def main():
+        live = await asyncio.start_unix_server(echo, path)
+        try:
+            with pytest.raises(Exception, match="in use"):
+                async with contextlib.AsyncExitStack() as stack:
+                    ProxyContext.stack = stack
+                    await unix_inbound(path).create_server()
+            reader, writer = await asyncio.open_unix_connection(path)
+            writer.close()
+        finally:
+            live.close()
+
+    asyncio.run(main())
+
+
+def test_unix_socket_of_a_successor_survives_shutdown(tmp_path):
+    path = str(tmp_path / "sp.sock")
+
+    async def main():
+        async with contextlib.AsyncExitStack() as stack:
+            ProxyContext.stack = stack
+            server = await unix_inbound(path).create_server()
+            server.close()
+            os.unlink(path)  # the successor replaces the socket file
+            successor = await asyncio.start_unix_server(echo, path)
+        assert os.path.exists(path)
+        successor.close()
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize(
+    "option", [{"mode": "999"}, {"mode": "660", "transport": "tcp", "port": 1080}]
+)
+def test_unix_mode_checked(option):
+    option = {"transport": "unix", "path": "/run/sp.sock", **option}
+    with pytest.raises(ValidationError):
+        BoundNamespace(proxy="socks5", host="", **option)
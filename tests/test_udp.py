@@ -0,0 +1,312 @@
+import asyncio
+import socket
+
+from shadowproxy2 import app
+from shadowproxy2.accounting import Accounting
+from shadowproxy2.aiobuffer import socks5
+from shadowproxy2.ciphers import ChaCha20IETFPoly1305
+from shadowproxy2.context import ProxyContext
+from shadowproxy2.parsers.socks5 import Socks5Parser
+from shadowproxy2.parsers.trojan import TrojanDatagramClient, TrojanParser
+from shadowproxy2.throttle import Shaper
+from shadowproxy2.udp import DirectClient, SSClient, SSUDPRelay
+
+
+class EchoProtocol(asyncio.DatagramProtocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.transport.sendto(data, addr)
+
+
+class ClientProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.received = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.received.put_nowait(data)
+
+
+class Context:
+    "the part of `ProxyContext` used by a udp associate"
+
+    inbound_name = "test"
+    check_quota = ProxyContext.check_quota
+    create_meter = ProxyContext.create_meter
+
+    def __init__(self, accounting=None, upload_shaper=None):
+        self.accounting = accounting
+        upload_shaper = upload_shaper or Shaper()
+        download_shaper = Shaper()
+        self.container = type(
+            "Container",
+            (),
+            {
+                "upload_shaper": lambda: upload_shaper,
+                "download_shaper": lambda: download_shaper,
+            },
+        )
+
+    def datagram_client_factory(self):
+        return lambda on_received: DirectClient(on_received).open()
+
+
+async def associate(ctx=None, count=100):
+    "ping an echo server ``count`` times over a socks5 associate"
+    loop = asyncio.get_running_loop()
+    echo, _ = await loop.create_datagram_endpoint(
+        EchoProtocol, local_addr=("127.0.0.1", 0)
+    )
+    echo_addr = echo.get_extra_info("sockname")
+
+    async def handler(reader, writer):
+        parser = Socks5Parser()
+        parser.set_rw(reader, writer)
+        await parser.server(ctx or Context())
+
+    server = await asyncio.start_server(handler, "127.0.0.1", 0)
+    reader, writer = await asyncio.open_connection(
+        *server.sockets[0].getsockname()
+    )
+    writer.write(
+        socks5.Handshake(..., [socks5.AuthMethod.no_auth]).binary
+        + socks5.ClientRequest(
+            ..., socks5.Cmd.associate, ..., socks5.Addr(1, "0.0.0.0", 0)
+        ).binary
+    )
+    await reader.readexactly(2)
+    reply, _ = socks5.Reply.parse_from(await reader.read(4096))
+    if reply.rep is not socks5.Rep.succeeded:
+        echo.close()
+        server.close()
+        return reply.rep
+    relay_addr = reply.bind_addr.host, reply.bind_addr.port
+
+    transport, client = await loop.create_datagram_endpoint(
+        ClientProtocol, local_addr=("127.0.0.1", 0)
+    )
+    header = b"\x00\x00\x00" + socks5.Addr.from_tuple(echo_addr).binary
+    payloads = [b"ping %d" % i for i in range(count)]
+    for payload in payloads:
+        transport.sendto(header + payload, relay_addr)
+    received = []
+    try:
+        while len(received) < count:
+            received.append(await asyncio.wait_for(client.received.get(), 0.5))
+    except asyncio.TimeoutError:
+        pass  # dropped
+    transport.sendto(
+        b"\x00\x00\x00" + socks5.Addr(3, "localhost", echo_addr[1]).binary + b"dns",
+        relay_addr,
+    )
+    by_name = await asyncio.wait_for(client.received.get(), 3)
+
+    writer.close()
+    transport.close()
+    echo.close()
+    server.close()
+    await server.wait_closed()
+    return header, payloads, received, by_name
+
+
+def test_udp_associate():
+    header, payloads, received, by_name = asyncio.run(associate())
+    assert all(data.startswith(header) for data in received)
+    assert sorted(data[len(header) :] for data in received) == sorted(payloads)
+    assert by_name.endswith(b"dns")
+
+
+def test_udp_associate_counted():
+    accounting = Accounting(":memory:")
+    asyncio.run(associate(Context(accounting), count=10))
+    usage = accounting.usage("test", "")
+    sent = sum(len(b"ping %d" % i) for i in range(10)) + len(b"dns")
+    assert (usage.upload.nbytes, usage.download.nbytes) == (sent, sent)
+    accounting.close()
+
+
+def test_udp_associate_over_quota():
+    accounting = Accounting(":memory:")
+    accounting.blocked = {""}
+    assert asyncio.run(associate(Context(accounting))) is socks5.Rep.not_allowed
+    accounting.close()
+
+
+def test_udp_associate_throttled():
+    # 50 bytes per half second window, the rest of a burst is dropped
+    result = asyncio.run(associate(Context(upload_shaper=Shaper(user_rate=100))))
+    header, payloads, received, by_name = result
+    assert 0 < len(received) < 10
+
+
+async def trojan_associate(ctx=None):
+    loop = asyncio.get_running_loop()
+    echo, _ = await loop.create_datagram_endpoint(
+        EchoProtocol, local_addr=("127.0.0.1", 0)
+    )
+    echo_addr = echo.get_extra_info("sockname")
+    other, _ = await loop.create_datagram_endpoint(
+        EchoProtocol, local_addr=("127.0.0.1", 0)
+    )
+    other_addr = other.get_extra_info("sockname")
+
+    async def handler(reader, writer):
+        parser = TrojanParser()
+        parser.set_rw(reader, writer)
+        try:
+            await parser.server(ctx or Context())
+        finally:
+            await parser.close()
+
+    server = await asyncio.start_server(handler, "127.0.0.1", 0)
+    server_addr = server.sockets[0].getsockname()
+
+    async def connect(target_addr):
+        parser = TrojanParser("user", "password")
+        parser.set_rw(*await asyncio.open_connection(*server_addr))
+        return parser
+
+    received = asyncio.Queue()
+    client = TrojanDatagramClient(
+        lambda data, addr: received.put_nowait((data, addr)), connect
+    ).open()
+    for i in range(10):
+        client.send(b"ping %d" % i, echo_addr)
+    client.send(b"other", other_addr)
+    results = []
+    try:
+        while len(results) < 11:
+            results.append(await asyncio.wait_for(received.get(), 0.5))
+    except asyncio.TimeoutError:
+        pass
+
+    client.close()
+    echo.close()
+    other.close()
+    server.close()
+    await server.wait_closed()
+    return echo_addr, other_addr, results
+
+
+def test_trojan_associate():
+    echo_addr, other_addr, results = asyncio.run(trojan_associate())
+    assert sorted(results) == sorted(
+        [(b"ping %d" % i, echo_addr) for i in range(10)] + [(b"other", other_addr)]
+    )
+
+
+def test_trojan_associate_counted():
+    accounting = Accounting(":memory:")
+    asyncio.run(trojan_associate(Context(accounting)))
+    usage = accounting.usage("test", "")
+    sent = sum(len(b"ping %d" % i) for i in range(10)) + len(b"other")
+    assert (usage.upload.nbytes, usage.download.nbytes) == (sent, sent)
+    accounting.close()
+
+
+def test_trojan_associate_over_quota():
+    accounting = Accounting(":memory:")
+    accounting.blocked = {""}
+    assert asyncio.run(trojan_associate(Context(accounting)))[2] == []
+    assert accounting.usage("test", "").upload.nbytes == 0
+    accounting.close()
+
+
+def test_trojan_associate_throttled():
+    ctx = Context(upload_shaper=Shaper(user_rate=100))
+    assert 0 < len(asyncio.run(trojan_associate(ctx))[2]) < 11
+
+
+def test_trojan_datagram_client_logs_errors(monkeypatch, capsys):
+    async def connect(target_addr):
+        raise ConnectionRefusedError("refused")
+
+    async def main():
+        client = TrojanDatagramClient(lambda data, addr: None, connect).open()
+        client.send(b"ping", ("127.0.0.1", 53))
+        await client.task
+
+    monkeypatch.setattr(app.settings, "verbose", 1)
+    asyncio.run(main())
+    assert "trojan udp to ('127.0.0.1', 53): refused" in capsys.readouterr().out
+
+
+def test_direct_client_blocked():
+    async def main():
+        received = []
+        client = DirectClient(
+            lambda data, addr: received.append(data), lambda host: False
+        ).open()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        client.send(b"blocked", sock.getsockname())
+        await asyncio.sleep(0.1)
+        sock.setblocking(False)
+        try:
+            sock.recv(100)
+        except BlockingIOError:
+            return True
+        finally:
+            sock.close()
+            client.close()
+        return False
+
+    assert asyncio.run(main())
+
+
+async def ss_relay(ctx, count=10):
+    "ping an echo server ``count`` times through a udp+ss inbound"
+    loop = asyncio.get_running_loop()
+    echo, _ = await loop.create_datagram_endpoint(
+        EchoProtocol, local_addr=("127.0.0.1", 0)
+    )
+    echo_addr = echo.get_extra_info("sockname")
+    cipher = ChaCha20IETFPoly1305("password")
+    relay, _ = await loop.create_datagram_endpoint(
+        lambda: SSUDPRelay(
+            cipher,
+            ctx.datagram_client_factory(),
+            create_meter=lambda addr: ctx.create_meter(None, addr[0]),
+        ),
+        local_addr=("127.0.0.1", 0),
+    )
+    received = asyncio.Queue()
+    client = SSClient(
+        lambda data, addr: received.put_nowait(data),
+        cipher,
+        relay.get_extra_info("sockname"),
+    ).open()
+    for i in range(count):
+        client.send(b"ping %d" % i, echo_addr)
+    results = []
+    try:
+        while len(results) < count:
+            results.append(await asyncio.wait_for(received.get(), 0.5))
+    except asyncio.TimeoutError:
+        pass
+    client.close()
+    relay.close()
+    echo.close()
+    return results
+
+
+def test_ss_relay_counted():
+    accounting = Accounting(":memory:")
+    assert len(asyncio.run(ss_relay(Context(accounting)))) == 10
+    usage = accounting.usage("test", "")
+    sent = sum(len(b"ping %d" % i) for i in range(10))
+    assert (usage.upload.nbytes, usage.download.nbytes) == (sent, sent)
+    accounting.close()
+
+
+def test_ss_relay_over_quota():
+    accounting = Accounting(":memory:")
+    accounting.blocked = {""}
+    assert asyncio.run(ss_relay(Context(accounting))) == []
+    accounting.close()
+
+
+def test_ss_relay_throttled():
+    ctx = Context(upload_shaper=Shaper(user_rate=100))
+    assert 0 < len(asyncio.run(ss_relay(ctx))) < 10
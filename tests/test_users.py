@@ -0,0 +1,64 @@
+import asyncio
+import os
+import signal
+
+from shadowproxy2 import server
+from shadowproxy2.ciphers import KeyRing
+from shadowproxy2.users import UserTable
+
+
+def test_keyring_update():
+    ring = KeyRing({"alice": "pw1", "bob": "pw2", "carol": "pw3"})
+    ring.hit("carol")
+    bob = ring.ciphers["bob"]
+    ring.update({"alice": "new", "bob": "pw2", "carol": "pw3", "dave": "pw4"})
+    # unchanged users keep their cipher and hit order, the others follow
+    assert list(ring.ciphers) == ["carol", "bob", "alice", "dave"]
+    assert ring.ciphers["bob"] is bob
+    ring.update({"bob": "pw2"})
+    assert list(ring.ciphers) == ["bob"]
+
+
+def test_user_table_reload(tmp_path):
+    path = tmp_path / "users"
+    path.write_text("alice:pw1\n")
+    table = UserTable(str(path), {"admin": "pw0"})
+    keyring = table.keyring
+    assert table.check("alice", "pw1") and not table.check("bob", "pw2")
+
+    path.write_text("# alice left\nbob:pw2\n")
+    table.reload()
+    assert not table.check("alice", "pw1")
+    assert table.check("bob", "pw2") and table.check("admin", "pw0")
+    assert table.keyring is keyring
+    assert sorted(keyring.ciphers) == ["admin", "bob"]
+
+    path.write_text("broken\n")
+    table.reload()  # the current users stay
+    assert table.check("bob", "pw2")
+
+
+def test_sighup_reloads_every_inbound():
+    reloaded = []
+
+    class Context:
+        inbound_ns = outbound_ns = "test"
+
+        def __init__(self, name):
+            self.name = name
+
+        async def create_server(self):
+            pass
+
+        def reload(self):
+            reloaded.append(self.name)
+            if len(reloaded) == 2:
+                os.kill(os.getpid(), signal.SIGINT)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.01, os.kill, os.getpid(), signal.SIGHUP)
+        await asyncio.wait_for(server.run_server([Context("a"), Context("b")]), 5)
+
+    asyncio.run(main())
+    assert reloaded == ["a", "b"]